@@ -0,0 +1,42 @@
+from .client import (
+    API_URL,
+    EXHAUSTED,
+    NUM_PHRASES,
+    OK,
+    PERMANENT,
+    RETRYABLE,
+    USER_INFO_URL,
+    FetchResult,
+    WordstatClient,
+    WordstatError,
+)
+from .batch import BatchJob, QuotaScheduler, run_batch
+from .cache import ResponseCache
+from .crawler import CrawlStats, Crawler
+from .engine import DEFAULT_CONCURRENCY, DEFAULT_QPS, CrawlEngine
+from .ratelimit import TokenBucket
+from .tokens import TokenPool
+
+__all__ = [
+    "API_URL",
+    "BatchJob",
+    "CrawlEngine",
+    "CrawlStats",
+    "Crawler",
+    "DEFAULT_CONCURRENCY",
+    "DEFAULT_QPS",
+    "EXHAUSTED",
+    "FetchResult",
+    "NUM_PHRASES",
+    "OK",
+    "PERMANENT",
+    "QuotaScheduler",
+    "RETRYABLE",
+    "ResponseCache",
+    "TokenBucket",
+    "TokenPool",
+    "USER_INFO_URL",
+    "WordstatClient",
+    "WordstatError",
+    "run_batch",
+]
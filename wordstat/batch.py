@@ -0,0 +1,162 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from .crawler import MAX_ERRORS, STOP_CANCELLED, STOP_FIRST_FAILED, Crawler
+from .db import region_key
+from .engine import DEFAULT_CONCURRENCY, DEFAULT_QPS
+from .ratelimit import TokenBucket
+
+
+@dataclass
+class BatchJob:
+    """Задание пакетного режима: исходная фраза и список регионов (None — без региона)."""
+    seed: str
+    regions: tuple = None
+
+
+def store_path(store_dir, regions):
+    """
+    Файл общего хранилища для набора регионов. Фразы дедуплицируются по паре
+    (фраза, регионы): все задания с одинаковыми регионами пишут в одну БД.
+    """
+    return os.path.join(store_dir, f"regions_{region_key(regions)}.db")
+
+
+def load_jobs(path):
+    """
+    Читает задания из текстового файла: по одному на строку,
+    «фраза<TAB>регионы через запятую». Регионы можно не указывать.
+    Пустые строки и строки, начинающиеся с #, пропускаются.
+    """
+    jobs = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            seed, _, regions = line.partition("\t")
+            regions = tuple(int(r) for r in regions.replace(" ", "").split(",") if r)
+            jobs.append(BatchJob(seed.strip(), regions or None))
+    return jobs
+
+
+class JobQuota:
+    """Доля общего бюджета запросов, выделенная одному заданию (интерфейс quota для CrawlEngine)."""
+
+    def __init__(self, scheduler, allocation):
+        self.scheduler = scheduler
+        self.allocation = allocation
+        self.used = 0
+
+    def acquire(self):
+        with self.scheduler.lock:
+            if self.used < self.allocation:
+                self.used += 1
+                return True
+            # Своя доля исчерпана — берем из остатков завершенных заданий
+            if self.scheduler.free > 0:
+                self.scheduler.free -= 1
+                self.allocation += 1
+                self.used += 1
+                return True
+            return False
+
+    def release(self):
+        """Возвращает неиспользованный запрос (например, ответ пришел из кэша)."""
+        with self.scheduler.lock:
+            self.used = max(0, self.used - 1)
+
+    def finish(self):
+        """Задание завершено: неиспользованный остаток доли отдается остальным."""
+        with self.scheduler.lock:
+            self.scheduler.free += self.allocation - self.used
+            self.allocation = self.used
+
+
+class QuotaScheduler:
+    """
+    Делит общий бюджет запросов поровну между заданиями. Задание, которое
+    закончило раньше (очередь исчерпана), возвращает остаток в общий пул,
+    и его забирают задания, которым своей доли не хватило.
+    """
+
+    def __init__(self, budget, n_jobs):
+        self.budget = max(0, int(budget))
+        self.lock = threading.Lock()
+        self._share = self.budget // n_jobs if n_jobs else 0
+        self.free = self.budget - self._share * n_jobs
+
+    def job_quota(self):
+        return JobQuota(self, self._share)
+
+    @property
+    def used(self):
+        return self.budget - self.free
+
+
+def run_batch(client, jobs, store_dir, budget=None, reserve=0, parallel_jobs=4, policy="fifo",
+              concurrency=DEFAULT_CONCURRENCY, qps=DEFAULT_QPS, max_errors=MAX_ERRORS,
+              on_progress=None, on_event=None, dedup=None, collapse=True, max_depth=None,
+              max_branch_requests=None, min_branch_yield=None, edges=True, terms=True,
+              min_yield=None):
+    """
+    Парсит задания `jobs` (список BatchJob) параллельно в общее хранилище `store_dir`.
+
+    Бюджет запросов — `budget` или суммарный по токенам клиента остаток дневной
+    квоты из /v1/userInfo (dailyLimitRemaining) за вычетом `reserve`; он делится
+    между заданиями через QuotaScheduler. Все задания делят один лимит `qps`
+    на токен (общий лимит — `qps`, умноженный на число токенов).
+
+    on_progress(job, stats) и on_event(job, level, message) вызываются
+    из потоков заданий, поэтому должны быть потокобезопасными.
+    dedup, collapse, ограничения обхода, edges и min_yield передаются в Crawler каждого задания.
+    terms=True — после всех заданий один раз дополнить индекс лемм каждой БД хранилища.
+    Возвращает список пар (BatchJob, CrawlStats) в порядке `jobs`.
+    """
+    if budget is None:
+        budget = client.refresh_quota()
+    budget = max(0, budget - reserve)
+    os.makedirs(store_dir, exist_ok=True)
+
+    scheduler = QuotaScheduler(budget, len(jobs))
+    bucket = TokenBucket(qps * getattr(client, "token_count", 1))
+    crawlers = {}  # БД хранилища -> Crawler одного из ее заданий (для обновления индекса лемм)
+
+    def run_job(job):
+        quota = scheduler.job_quota()
+        crawler = Crawler(
+            client,
+            store_path(store_dir, job.regions),
+            regions=job.regions,
+            policy=policy,
+            concurrency=concurrency,
+            max_errors=max_errors,
+            on_progress=(lambda stats: on_progress(job, stats)) if on_progress else None,
+            on_event=(lambda level, message: on_event(job, level, message)) if on_event else None,
+            shared_store=True,
+            bucket=bucket,
+            dedup=dedup,
+            collapse=collapse,
+            max_depth=max_depth,
+            max_branch_requests=max_branch_requests,
+            min_branch_yield=min_branch_yield,
+            edges=edges,
+            terms=terms,
+            min_yield=min_yield,
+        )
+        crawlers[crawler.db_path] = crawler
+        try:
+            return job, crawler.run(job.seed, budget, quota=quota)
+        finally:
+            quota.finish()
+
+    with ThreadPoolExecutor(max_workers=max(1, parallel_jobs)) as pool:
+        results = list(pool.map(run_job, jobs))
+    # Индекс каждой БД — один раз после всех ее заданий, а не после каждого (см. Crawler.refresh_terms)
+    updated = {store_path(store_dir, job.regions) for job, stats in results
+               if stats.stop_reason not in (STOP_CANCELLED, STOP_FIRST_FAILED)}
+    for db_path in sorted(updated):
+        crawlers[db_path].refresh_terms()
+    return results
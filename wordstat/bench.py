@@ -0,0 +1,234 @@
+"""
+Воспроизводимый замер скорости парсинга без расхода квоты: полный цикл Crawler
+(CrawlEngine, WordstatClient, запись в SQLite) против wordstat.mockserver,
+запущенного в отдельном процессе.
+
+    python -m wordstat.bench -n 500 --latency 0.02 --json bench.json
+    python -m wordstat.bench -n 500 --baseline bench.json   # код возврата 1 при регрессии
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from .client import NUM_PHRASES, WordstatClient
+from .crawler import Crawler
+from .db import get_db_phrase_count, setup_db
+from .dedup import DEDUP_KINDS
+from .engine import DEFAULT_CONCURRENCY
+from .metrics import Metrics, profiled
+from .mockserver import MockWordstatServer
+from .scheduling import POLICIES
+from .terms import refresh_index
+
+DEFAULT_TOLERANCE = 0.2
+# Метрики для сравнения с эталоном: True — чем больше, тем лучше
+COMPARED_METRICS = {
+    "requests_per_sec": True,
+    "rows_per_sec": True,
+    "latency_p50_ms": False,
+    "latency_p99_ms": False,
+    "peak_rss_mb": False,
+}
+
+
+def _serve(conn, options):
+    server = MockWordstatServer(**options)
+    conn.send(server.url)
+    server.httpd.serve_forever()
+
+
+def peak_rss_mb():
+    """Пиковый RSS текущего процесса в МБ (None, если платформа не позволяет узнать)."""
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset / 1024 / 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS — байты
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def percentile(values, q):
+    """Перцентиль `q` (0–100) методом ближайшего ранга."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+
+class _TimedClient:
+    """Обертка клиента: время и число строк каждого ответа topRequests."""
+
+    def __init__(self, client):
+        self.client = client
+        self.latencies = []
+        self.rows = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def top_requests(self, phrase, regions=None, max_age=None):
+        started = time.perf_counter()
+        result = self.client.top_requests(phrase, regions, max_age)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.latencies.append(elapsed)
+            if result.ok:
+                self.rows += len(result.items)
+        return result
+
+
+def run_benchmark(requests=300, seed_phrase="тест", tokens=1, concurrency=DEFAULT_CONCURRENCY, qps=1000,
+                  policy="fifo", dedup=None, num_phrases=NUM_PHRASES, db_path=None, server_options=None,
+                  profile=None):
+    """
+    Запускает mock-сервер в отдельном процессе и парсинг до `requests` запросов
+    в новую БД. Возвращает словарь с метриками, включая время по стадиям
+    (см. wordstat.metrics). Индекс лемм строится после замера (стадия terms)
+    и в elapsed не входит. server_options — аргументы MockWordstatServer,
+    profile — файл профиля прогона (см. metrics.profiled).
+    """
+    server_options = dict(server_options or {})
+    ctx = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = ctx.Pipe()
+    process = ctx.Process(target=_serve, args=(child_conn, server_options), daemon=True)
+    process.start()
+    tmp_dir = None
+    try:
+        url = parent_conn.recv()
+        if db_path is None:
+            tmp_dir = tempfile.mkdtemp(prefix="wordstat-bench-")
+            db_path = os.path.join(tmp_dir, "bench.db")
+
+        metrics = Metrics()
+        client = WordstatClient([f"bench-token-{i}" for i in range(tokens)], num_phrases=num_phrases,
+                                pool_size=concurrency, qps_per_token=qps, base_url=url, backoff_base=0.05,
+                                metrics=metrics)
+        timed = _TimedClient(client)
+        if server_options.get("daily_limit") is not None:
+            client.refresh_quota()
+        crawler = Crawler(timed, db_path, policy=policy, concurrency=concurrency, qps=qps, dedup=dedup)
+        try:
+            started = time.perf_counter()
+            with profiled(profile):
+                stats = crawler.run(seed_phrase, requests)
+            elapsed = time.perf_counter() - started
+        finally:
+            client.close()
+
+        conn = setup_db(db_path)
+        try:
+            phrases = get_db_phrase_count(conn)
+            with metrics.timer("terms"):
+                refresh_index(conn)
+        finally:
+            conn.close()
+        latencies_ms = [latency * 1000 for latency in timed.latencies]
+        rss = peak_rss_mb()
+        snapshot = metrics.snapshot()
+        return {
+            "config": {"requests": requests, "seed_phrase": seed_phrase, "tokens": tokens,
+                       "concurrency": concurrency, "qps": qps, "policy": policy, "dedup": dedup,
+                       "num_phrases": num_phrases, "server": server_options},
+            "requests": stats.requests,
+            "errors": stats.errors,
+            "stop_reason": stats.stop_reason,
+            "phrases": phrases,
+            "elapsed": round(elapsed, 3),
+            "requests_per_sec": round(len(latencies_ms) / elapsed, 2) if elapsed else 0.0,
+            "rows_per_sec": round(timed.rows / elapsed, 1) if elapsed else 0.0,
+            "latency_p50_ms": round(percentile(latencies_ms, 50), 2),
+            "latency_p99_ms": round(percentile(latencies_ms, 99), 2),
+            "latency_max_ms": round(max(latencies_ms, default=0.0), 2),
+            "peak_rss_mb": round(rss, 1) if rss is not None else None,
+            "counters": snapshot["counters"],
+            "stages": snapshot["stages"],
+        }
+    finally:
+        process.terminate()
+        process.join()
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def compare(result, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Сравнивает метрики с эталоном. Возвращает список строк с регрессиями (пустой — регрессий нет)."""
+    regressions = []
+    for metric, higher_is_better in COMPARED_METRICS.items():
+        current, reference = result.get(metric), baseline.get(metric)
+        if current is None or not reference:
+            continue
+        if higher_is_better and current < reference * (1 - tolerance):
+            regressions.append(f"{metric}: {current} < {reference} - {tolerance:.0%}")
+        elif not higher_is_better and current > reference * (1 + tolerance):
+            regressions.append(f"{metric}: {current} > {reference} + {tolerance:.0%}")
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m wordstat.bench",
+                                     description="Замер скорости парсинга на локальном mock-сервере Wordstat.")
+    parser.add_argument("-n", "--requests", type=int, default=300, help="запросов к API за прогон")
+    parser.add_argument("--phrase", default="тест", help="исходная фраза")
+    parser.add_argument("--tokens", type=int, default=1, help="сколько токенов в пуле клиента")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--qps", type=float, default=1000, help="лимит клиента на токен (по умолчанию не мешает замеру)")
+    parser.add_argument("--policy", choices=list(POLICIES), default="fifo")
+    parser.add_argument("--dedup", choices=DEDUP_KINDS)
+    parser.add_argument("--num-phrases", type=int, default=NUM_PHRASES)
+    parser.add_argument("--db", help="сохранить БД прогона в файл (по умолчанию — временная)")
+
+    server = parser.add_argument_group("mock-сервер")
+    server.add_argument("--seed", type=int, default=0, help="seed синтетического графа фраз")
+    server.add_argument("--vocab-size", type=int, default=500)
+    server.add_argument("--latency", type=float, default=0.02, help="задержка ответа, сек")
+    server.add_argument("--jitter", type=float, default=0.5, help="разброс задержки (доля от latency)")
+    server.add_argument("--error-429", type=float, default=0.0, help="доля ответов 429")
+    server.add_argument("--error-503", type=float, default=0.0, help="доля ответов 503")
+    server.add_argument("--retry-after", type=float, default=0.1, help="Retry-After для 429, сек")
+    server.add_argument("--server-qps", type=float, help="лимит сервера в секунду на токен")
+    server.add_argument("--daily-limit", type=int, help="дневная квота сервера на токен")
+
+    report = parser.add_argument_group("отчет")
+    report.add_argument("--json", dest="json_path", help="записать результат в JSON-файл")
+    report.add_argument("--profile", help="профиль прогона: *.html — pyinstrument, иначе файл cProfile")
+    report.add_argument("--baseline", help="JSON прошлого прогона: при регрессии код возврата 1")
+    report.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="допустимое ухудшение метрик относительно эталона")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    server_options = {"seed": args.seed, "vocab_size": args.vocab_size, "latency": args.latency,
+                      "jitter": args.jitter, "error_429": args.error_429, "error_503": args.error_503,
+                      "retry_after": args.retry_after, "qps": args.server_qps, "daily_limit": args.daily_limit}
+    result = run_benchmark(args.requests, args.phrase, tokens=args.tokens, concurrency=args.concurrency,
+                           qps=args.qps, policy=args.policy, dedup=args.dedup, num_phrases=args.num_phrases,
+                           db_path=args.db, server_options=server_options, profile=args.profile)
+    print(json.dumps(result, ensure_ascii=False), flush=True)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"Регрессия: {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+DEFAULT_TTL = 30 * 24 * 3600  # Wordstat отдает данные за последние 30 дней
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+
+def normalize_cache_phrase(phrase):
+    """Нормализация фразы для ключа кэша: регистр и лишние пробелы не важны."""
+    return " ".join(phrase.casefold().split())
+
+
+def cache_key(phrase, regions, num_phrases):
+    regions_part = ",".join(str(int(r)) for r in sorted(regions)) if regions else ""
+    raw = f"{normalize_cache_phrase(phrase)}|{regions_part}|{num_phrases}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Общий дисковый кэш ответов /v1/topRequests (один файл SQLite на все БД фраз).
+
+    Ключ — нормализованная фраза, список регионов и numPhrases. Записи старше
+    `ttl` секунд считаются устаревшими; при превышении `max_bytes` удаляются
+    давно не использованные записи. Безопасен для вызова из нескольких потоков.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                phrase TEXT,
+                payload BLOB,
+                size INTEGER,
+                created_at REAL,
+                accessed_at REAL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed_responses ON responses (accessed_at)")
+        self._conn.commit()
+        self.purge_expired()
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get(self, phrase, regions, num_phrases, max_age=None):
+        """Возвращает список topRequests из кэша или None. max_age — не старше, сек (строже ttl)."""
+        key = cache_key(phrase, regions, num_phrases)
+        now = time.time()
+        ttl = self.ttl if max_age is None else min(self.ttl, max_age)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > ttl:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, phrase, regions, num_phrases, items):
+        key = cache_key(phrase, regions, num_phrases)
+        payload = zlib.compress(json.dumps(items, ensure_ascii=False).encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, phrase, payload, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, phrase, payload, len(payload), now, now),
+            )
+            self._size += len(payload) - (old[0] if old else 0)
+            if self._size > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """Удаляет давно не использованные записи, пока размер не станет ниже 90% лимита."""
+        target = self.max_bytes * 0.9
+        rows = self._conn.execute("SELECT key, size FROM responses ORDER BY accessed_at")
+        doomed = []
+        for key, size in rows:
+            if self._size <= target:
+                break
+            doomed.append((key,))
+            self._size -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+
+    def purge_expired(self):
+        """Удаляет устаревшие записи. Возвращает количество удаленных."""
+        with self._lock:
+            cur = self._conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,))
+            self._conn.commit()
+            self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            return cur.rowcount
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size_bytes": self._size,
+        }
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
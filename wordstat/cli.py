@@ -0,0 +1,231 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from dataclasses import asdict
+from multiprocessing import Pool
+
+from .batch import BatchJob, load_jobs, run_batch, store_path
+from .cache import DEFAULT_TTL, ResponseCache
+from .client import NUM_PHRASES, WordstatClient
+from .crawler import MAX_ERRORS, Crawler
+from .db import sanitize_filename
+from .dedup import DEDUP_KINDS
+from .engine import DEFAULT_CONCURRENCY, DEFAULT_QPS
+from .metrics import DEFAULT_EXPORT_INTERVAL, JsonLinesWriter, Metrics, profiled, write_prometheus
+from .scheduling import POLICIES
+
+TOKEN_ENV = "WORDSTAT_TOKEN"
+DEFAULT_CACHE_PATH = "wordstat_cache.sqlite"
+DEFAULT_STORE_DIR = "wordstat_store"
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m wordstat",
+        description="Рекурсивный парсинг Yandex Wordstat API в SQLite (по одной БД на исходную фразу "
+                    "или в общее хранилище в пакетном режиме).",
+    )
+    parser.add_argument("phrases", nargs="*", help="исходные запросы")
+    parser.add_argument("-n", "--max-requests", type=int, default=5, help="максимум рекурсивных запросов на фразу")
+    parser.add_argument("--region", type=int, action="append", dest="regions",
+                        help="ID региона (можно несколько раз); по умолчанию — без региона")
+    parser.add_argument("--db", help="файл БД (только для одной фразы); по умолчанию — по имени фразы")
+    parser.add_argument("--token", action="append", dest="tokens",
+                        help=f"OAuth-токен; можно указать несколько раз для пула токенов "
+                             f"(по умолчанию — из переменной {TOKEN_ENV}, несколько через запятую)")
+    parser.add_argument("--base-url", help="адрес API, например локального python -m wordstat.mockserver")
+    parser.add_argument("--policy", choices=list(POLICIES), default="fifo", help="порядок обхода очереди")
+    parser.add_argument("--concurrency", type=int,
+                        help=f"запросов одновременно (по умолчанию {DEFAULT_CONCURRENCY} на токен)")
+    parser.add_argument("--qps", type=float, default=DEFAULT_QPS, help="лимит запросов в секунду на токен")
+    parser.add_argument("--max-errors", type=int, default=MAX_ERRORS)
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH, help="файл кэша ответов")
+    parser.add_argument("--no-cache", action="store_true", help="не использовать кэш ответов")
+    parser.add_argument("--cache-ttl-days", type=float, default=DEFAULT_TTL / 86400)
+    parser.add_argument("--dedup", choices=DEDUP_KINDS,
+                        help="отсеивать повторы в памяти до записи в очередь SQLite: fingerprint — 64-битные "
+                             "отпечатки (~16 байт на фразу), bloom — фильтр Блума (~2 байта на фразу); "
+                             "фразы, сочтенные известными, сверяются с БД, поэтому новые не теряются")
+    parser.add_argument("--no-collapse", action="store_true",
+                        help="раскрывать все фразы, даже различающиеся только порядком слов, регистром, "
+                             "«ё/е» и операторами Wordstat")
+    parser.add_argument("-p", "--processes", type=int, default=1,
+                        help="сколько фраз парсить параллельно (отдельными процессами)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="не выводить прогресс")
+    parser.add_argument("--no-terms", action="store_true",
+                        help="не обновлять индекс лемм после парсинга (python -m wordstat.terms)")
+
+    limits = parser.add_argument_group("ограничения обхода")
+    limits.add_argument("--max-depth", type=int,
+                        help="не раскрывать фразы глубже N (0 — только исходная фраза, 1 — и фразы из ее ответа...)")
+    limits.add_argument("--max-branch-requests", type=int,
+                        help="не больше N запросов на ветку (ветка — фраза из ответа на исходную фразу)")
+    limits.add_argument("--min-branch-yield", type=float,
+                        help="не раскрывать ветки, которые приносят меньше N новых фраз на запрос")
+    limits.add_argument("--min-yield", type=float,
+                        help="остановить парсинг, когда последние 20 запросов приносят в среднем меньше N новых "
+                             "фраз (прогноз: python -m wordstat.planner)")
+    limits.add_argument("--no-edges", action="store_true",
+                        help="не записывать граф обхода (таблица edges: родитель, фраза, глубина, позиция)")
+
+    recrawl = parser.add_argument_group("повторный обход")
+    recrawl.add_argument("--recrawl", action="store_true",
+                         help="не расширять очередь, а заново раскрыть уже обработанные фразы БД "
+                              "и обновить их показы (история сохраняется)")
+    recrawl.add_argument("--max-age-days", type=float,
+                         help="обновлять фразы, показы которых получены больше N дней назад")
+    recrawl.add_argument("--min-count", type=int, help="обновлять только фразы с показами не меньше N")
+
+    telemetry = parser.add_argument_group("метрики")
+    telemetry.add_argument("--metrics", help="дописывать снимки метрик (время стадий, счетчики) в файл JSON-строками")
+    telemetry.add_argument("--metrics-interval", type=float, default=DEFAULT_EXPORT_INTERVAL,
+                           help="как часто писать снимок метрик, сек")
+    telemetry.add_argument("--prometheus", help="по завершении записать метрики в файл в формате Prometheus "
+                                                "(одна фраза или пакетный режим)")
+    telemetry.add_argument("--profile", help="профиль запуска: *.html — pyinstrument, иначе файл cProfile")
+
+    batch = parser.add_argument_group("пакетный режим")
+    batch.add_argument("--jobs", help="файл заданий: «фраза<TAB>регионы через запятую» на строку")
+    batch.add_argument("--store", default=DEFAULT_STORE_DIR,
+                       help="каталог общего хранилища (одна БД на набор регионов)")
+    batch.add_argument("--budget", type=int,
+                       help="общий бюджет запросов; по умолчанию — dailyLimitRemaining из /v1/userInfo")
+    batch.add_argument("--reserve", type=int, default=0, help="сколько запросов квоты оставить нетронутыми")
+    batch.add_argument("--parallel-jobs", type=int, default=4, help="сколько заданий выполнять одновременно")
+    return parser
+
+
+def crawl_one(args, phrase, db_path):
+    """Парсит одну фразу и возвращает словарь со статистикой."""
+    cache = None if args.no_cache else ResponseCache(args.cache, ttl=args.cache_ttl_days * 86400)
+    metrics = Metrics() if args.metrics or args.prometheus else None
+    writer = JsonLinesWriter(args.metrics, args.metrics_interval, phrase=phrase) if args.metrics else None
+    client = WordstatClient(args.tokens, num_phrases=NUM_PHRASES, pool_size=args.concurrency, cache=cache,
+                            qps_per_token=args.qps, base_url=args.base_url, metrics=metrics)
+    last_report = [0.0]
+
+    def on_progress(stats):
+        if writer is not None:
+            writer.write(metrics)
+        now = time.monotonic()
+        if args.quiet or now - last_report[0] < 1:
+            return
+        last_report[0] = now
+        print(f"[{phrase}] Запрос {stats.requests}/{stats.max_requests} | Фраз: {stats.phrases} "
+              f"| Осталось ~ {stats.eta:.1f} сек", file=sys.stderr)
+
+    def on_event(level, message):
+        if not args.quiet or level == "error":
+            print(f"[{phrase}] {message}", file=sys.stderr)
+
+    crawler = Crawler(client, db_path, regions=args.regions, policy=args.policy, concurrency=args.concurrency,
+                      qps=args.qps, max_errors=args.max_errors, on_progress=on_progress, on_event=on_event,
+                      dedup=args.dedup, collapse=not args.no_collapse, max_depth=args.max_depth,
+                      max_branch_requests=args.max_branch_requests, min_branch_yield=args.min_branch_yield,
+                      edges=not args.no_edges, terms=not args.no_terms, min_yield=args.min_yield)
+    try:
+        if args.recrawl:
+            max_age = args.max_age_days * 86400 if args.max_age_days is not None else None
+            stats = crawler.recrawl(args.max_requests, max_age=max_age, min_count=args.min_count)
+        else:
+            stats = crawler.run(phrase, args.max_requests)
+        crawler.refresh_terms(stats)
+        summary = {"phrase": phrase, "db": db_path, **asdict(stats), "elapsed": round(stats.elapsed, 3)}
+        if cache is not None:
+            summary["cache"] = cache.stats()
+        if metrics is not None:
+            summary["metrics"] = metrics.snapshot()
+        return summary
+    finally:
+        if writer is not None:
+            writer.write(metrics, force=True)
+        if args.prometheus:
+            write_prometheus(metrics, args.prometheus, phrase=phrase)
+        client.close()
+        if cache is not None:
+            cache.close()
+
+
+def _crawl_job(job):
+    return crawl_one(*job)
+
+
+def crawl_batch(args, jobs):
+    """Пакетный режим: все задания в общее хранилище с общим бюджетом. Печатает JSON по каждому."""
+    cache = None if args.no_cache else ResponseCache(args.cache, ttl=args.cache_ttl_days * 86400)
+    pool_size = args.concurrency * max(1, args.parallel_jobs)
+    metrics = Metrics() if args.metrics or args.prometheus else None
+    writer = JsonLinesWriter(args.metrics, args.metrics_interval) if args.metrics else None
+    client = WordstatClient(args.tokens, num_phrases=NUM_PHRASES, pool_size=pool_size, cache=cache,
+                            qps_per_token=args.qps, base_url=args.base_url, metrics=metrics)
+    lock = threading.Lock()
+
+    def on_event(job, level, message):
+        if not args.quiet or level == "error":
+            with lock:
+                print(f"[{job.seed}] {message}", file=sys.stderr)
+
+    try:
+        results = run_batch(client, jobs, args.store, budget=args.budget, reserve=args.reserve,
+                            parallel_jobs=args.parallel_jobs, policy=args.policy, concurrency=args.concurrency,
+                            qps=args.qps, max_errors=args.max_errors, on_event=on_event, dedup=args.dedup,
+                            on_progress=(lambda job, stats: writer.write(metrics)) if writer else None,
+                            collapse=not args.no_collapse, max_depth=args.max_depth,
+                            max_branch_requests=args.max_branch_requests, min_branch_yield=args.min_branch_yield,
+                            edges=not args.no_edges, terms=not args.no_terms, min_yield=args.min_yield)
+    finally:
+        client.close()
+        if cache is not None:
+            cache.close()
+        if writer is not None:
+            writer.write(metrics, force=True)
+        if args.prometheus:
+            write_prometheus(metrics, args.prometheus)
+    for job, stats in results:
+        summary = {"phrase": job.seed, "regions": list(job.regions or []),
+                   "db": store_path(args.store, job.regions), **asdict(stats), "elapsed": round(stats.elapsed, 3)}
+        print(json.dumps(summary, ensure_ascii=False), flush=True)
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if not args.tokens:
+        args.tokens = [t.strip() for t in os.environ.get(TOKEN_ENV, "").split(",") if t.strip()]
+    if not args.tokens:
+        parser.error(f"не задан токен: укажите --token или переменную окружения {TOKEN_ENV}")
+    if args.concurrency is None:
+        args.concurrency = DEFAULT_CONCURRENCY * len(args.tokens)
+    if args.recrawl and args.db and not args.phrases:
+        args.phrases = [args.db]  # для повторного обхода достаточно файла БД
+    if not args.phrases and not args.jobs:
+        parser.error("укажите исходные запросы или файл заданий --jobs")
+    if args.db and len(args.phrases) > 1:
+        parser.error("--db можно указать только для одной фразы")
+    if args.recrawl and args.jobs:
+        parser.error("--recrawl работает с БД отдельных фраз, а не с пакетным режимом")
+    if args.prometheus and not args.jobs and len(args.phrases) > 1:
+        parser.error("--prometheus можно указать для одной фразы или в пакетном режиме")
+    if args.profile and args.processes > 1 and not args.jobs and len(args.phrases) > 1:
+        parser.error("--profile профилирует текущий процесс и несовместим с --processes")
+
+    with profiled(args.profile):
+        if args.jobs:
+            regions = tuple(args.regions) if args.regions else None
+            jobs = load_jobs(args.jobs) + [BatchJob(phrase, regions) for phrase in args.phrases]
+            crawl_batch(args, jobs)
+            return 0
+
+        jobs = [(args, phrase, args.db or sanitize_filename(phrase)) for phrase in args.phrases]
+        if args.processes > 1 and len(jobs) > 1:
+            with Pool(min(args.processes, len(jobs))) as pool:
+                summaries = pool.imap(_crawl_job, jobs)
+                for summary in summaries:
+                    print(json.dumps(summary, ensure_ascii=False), flush=True)
+        else:
+            for job in jobs:
+                print(json.dumps(_crawl_job(job), ensure_ascii=False), flush=True)
+    return 0
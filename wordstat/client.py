@@ -0,0 +1,292 @@
+import copy
+import random
+import time
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import NULL_METRICS
+from .tokens import DEFAULT_TOKEN_QPS, TokenPool
+
+API_URL = "https://api.wordstat.yandex.net/v1/topRequests"
+USER_INFO_URL = "https://api.wordstat.yandex.net/v1/userInfo"
+NUM_PHRASES = 2000
+
+# Исходы запроса
+OK = "OK"
+RETRYABLE = "RETRYABLE"  # 429/5xx/сетевые ошибки: фразу стоит повторить позже
+PERMANENT = "PERMANENT"  # 4xx: повтор не поможет, квоту тратить не нужно
+EXHAUSTED = "EXHAUSTED"  # дневная квота всех токенов исчерпана
+
+RETRYABLE_CODES = {429, 500, 502, 503, 504}
+
+
+class WordstatError(Exception):
+    """Ошибка запроса к Wordstat API."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@dataclass
+class FetchResult:
+    """Результат запроса к /v1/topRequests."""
+    status: str
+    items: list = field(default_factory=list)
+    status_code: int = None
+    error: str = None
+    attempts: int = 1
+    cached: bool = False  # ответ взят из ResponseCache, квота не потрачена
+
+    @property
+    def ok(self):
+        return self.status == OK
+
+    @property
+    def retryable(self):
+        return self.status == RETRYABLE
+
+    @property
+    def error_code(self):
+        """
+        Короткий код ошибки для очереди: HTTP-код, json (некорректный ответ),
+        network (сетевая ошибка), request (некорректный запрос) или exhausted.
+        """
+        if self.ok:
+            return None
+        if self.status == EXHAUSTED:
+            return "exhausted"
+        if self.status_code:
+            return "json" if self.status_code == 200 else str(self.status_code)
+        return "network" if self.retryable else "request"
+
+
+def parse_retry_after(value):
+    """Разбирает заголовок Retry-After (секунды или HTTP-дата). Возвращает секунды или None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class WordstatClient:
+    """
+    Клиент Wordstat API с общим пулом соединений (keep-alive).
+
+    Повторяет 429/5xx и сетевые ошибки с экспоненциальной задержкой и джиттером,
+    соблюдает Retry-After. После 429 токен ставится на паузу для всех потоков,
+    которые используют клиент, чтобы не тратить запросы, пока API нас ограничивает.
+    Если передан `cache` (ResponseCache), успешные ответы берутся из него и сохраняются в него.
+
+    `token` — один OAuth-токен или список токенов. Запросы распределяются
+    через TokenPool: у каждого токена свой лимит `qps_per_token`, запрос уходит
+    с токеном, у которого больше всего запаса квоты (см. refresh_quota()).
+
+    `base_url` — адрес другого сервера с тем же API (например, wordstat.mockserver).
+    `metrics` — wordstat.metrics.Metrics для времени запросов, повторов и ответов кэша.
+    """
+
+    def __init__(self, token, num_phrases=NUM_PHRASES, pool_size=10, max_retries=4,
+                 backoff_base=0.5, backoff_max=30.0, timeout=30, cache=None, qps_per_token=DEFAULT_TOKEN_QPS,
+                 base_url=None, metrics=None):
+        self.api_url = base_url.rstrip("/") + "/v1/topRequests" if base_url else API_URL
+        self.user_info_url = base_url.rstrip("/") + "/v1/userInfo" if base_url else USER_INFO_URL
+        tokens = [token] if isinstance(token, str) else list(token)
+        self.tokens = TokenPool(tokens, qps=qps_per_token)
+        self.cache = cache
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+        self.num_phrases = num_phrases
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Accept-Language": "ru",
+            "Content-Type": "application/json; charset=utf-8",
+        })
+
+    @property
+    def token(self):
+        """Первый токен пула."""
+        return self.tokens.states[0].token
+
+    @property
+    def token_count(self):
+        return len(self.tokens)
+
+    def with_metrics(self, metrics):
+        """
+        Клиент с теми же токенами, соединениями и кэшем, но своими метриками —
+        например, для одного задания исполнителя, когда клиент общий на несколько заданий.
+        """
+        client = copy.copy(self)
+        client.metrics = metrics
+        return client
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _backoff(self, attempt):
+        """Full jitter: случайная задержка от 0 до base * 2^attempt."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    # -------------------
+    # Методы API
+    # -------------------
+    def _post(self, url, body=None, token_state=None):
+        """
+        POST с повторами. Если `token_state` не задан, токен для каждой попытки
+        выбирается из пула, а успешный запрос списывается с его квоты.
+        Возвращает (status, response | None, error | None, attempts).
+        """
+        error = None
+        resp = None
+        metrics = self.metrics
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                metrics.inc("retries")
+            if token_state is None:
+                with metrics.timer("token"):
+                    state = self.tokens.acquire()
+            else:
+                state = token_state
+            if state is None:
+                return EXHAUSTED, resp, "Дневная квота всех токенов исчерпана", attempt + 1
+            charged = False
+            started = time.perf_counter()
+            try:
+                resp = self.session.post(url, json=body, timeout=self.timeout,
+                                         headers={"Authorization": f"Bearer {state.token}"})
+            except ValueError as e:
+                # Некорректный URL или заголовок (например, токен не в latin-1) — повтор не поможет
+                return PERMANENT, None, str(e), attempt + 1
+            except requests.RequestException as e:
+                metrics.observe("http", time.perf_counter() - started)
+                metrics.inc("network_errors")
+                resp = None
+                error = str(e)
+                delay = self._backoff(attempt)
+            else:
+                metrics.observe("http", time.perf_counter() - started)
+                metrics.inc(f"http_{resp.status_code}")
+                if resp.status_code == 200:
+                    charged = True
+                    metrics.inc("requests")
+                    return OK, resp, None, attempt + 1
+                error = f"HTTP {resp.status_code}"
+                if resp.status_code not in RETRYABLE_CODES:
+                    return PERMANENT, resp, error, attempt + 1
+                retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                delay = retry_after if retry_after is not None else self._backoff(attempt)
+                if resp.status_code == 429:
+                    self.tokens.pause(state, delay)
+            finally:
+                if token_state is None:
+                    self.tokens.release(state, charged)
+
+            if attempt < self.max_retries:
+                with metrics.timer("backoff"):
+                    time.sleep(delay)
+        return RETRYABLE, resp, error, self.max_retries + 1
+
+    def top_requests(self, phrase, regions=None, max_age=None):
+        """
+        Запрашивает /v1/topRequests. regions — список ID регионов или None (без региона).
+        max_age — максимальный возраст ответа из кэша в секундах (0 — не брать из кэша).
+        """
+        cached = self.cached_top_requests(phrase, regions, max_age)
+        if cached is not None:
+            return cached
+
+        body = {"phrase": phrase, "numPhrases": self.num_phrases}
+        if regions:
+            body["regions"] = [int(r) for r in regions]
+
+        status, resp, error, attempts = self._post(self.api_url, body)
+        status_code = resp.status_code if resp is not None else None
+        if status != OK:
+            return FetchResult(status, status_code=status_code, error=error, attempts=attempts)
+        try:
+            with self.metrics.timer("json"):
+                items = resp.json().get("topRequests", [])
+        except ValueError as e:
+            return FetchResult(RETRYABLE, status_code=status_code, error=f"Некорректный JSON: {e}", attempts=attempts)
+        self.metrics.inc("rows_received", len(items))
+        if self.cache is not None:
+            with self.metrics.timer("cache"):
+                self.cache.put(phrase, regions, self.num_phrases, items)
+        return FetchResult(OK, items, status_code=status_code, attempts=attempts)
+
+    def cached_top_requests(self, phrase, regions=None, max_age=None):
+        """
+        Ответ /v1/topRequests из кэша без запроса к API или None, если кэш не подключен,
+        ответа нет или он старше `max_age` секунд (max_age=0 — всегда None).
+        """
+        if self.cache is None or max_age == 0:
+            return None
+        with self.metrics.timer("cache"):
+            items = self.cache.get(phrase, regions, self.num_phrases, max_age)
+        if items is None:
+            return None
+        self.metrics.inc("cache_hits")
+        return FetchResult(OK, items, status_code=200, attempts=0, cached=True)
+
+    def user_info(self, token=None):
+        """
+        Возвращает словарь userInfo из /v1/userInfo для токена `token`
+        (по умолчанию — первого в пуле). При ошибке бросает WordstatError.
+        """
+        state = self._state(token)
+        if not state.token:
+            raise WordstatError("Токен API пуст.")
+        status, resp, error, _ = self._post(self.user_info_url, token_state=state)
+        status_code = resp.status_code if resp is not None else None
+        if status != OK:
+            raise WordstatError(f"Не удалось получить информацию о квоте: {error}", status_code)
+        try:
+            info = resp.json().get("userInfo", {})
+        except ValueError as e:
+            raise WordstatError(f"Некорректный JSON в /v1/userInfo: {e}", status_code)
+        self.tokens.set_remaining(state, info.get("dailyLimitRemaining"))
+        return info
+
+    def refresh_quota(self):
+        """
+        Запрашивает /v1/userInfo для каждого токена пула и обновляет остатки квоты.
+        Возвращает суммарный остаток по всем токенам (токены с ошибкой не учитываются).
+        """
+        total = 0
+        for state in self.tokens.states:
+            try:
+                total += self.user_info(state.token).get("dailyLimitRemaining") or 0
+            except WordstatError:
+                continue
+        return total
+
+    def _state(self, token):
+        if token is None:
+            return self.tokens.states[0]
+        for state in self.tokens.states:
+            if state.token == token:
+                return state
+        raise ValueError("Токен не входит в пул клиента")
@@ -0,0 +1,409 @@
+import sqlite3
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+from .client import EXHAUSTED, NUM_PHRASES, PERMANENT
+from .db import (STALE, get_db_phrase_count, ingest_response, insert_result_and_queue, mark_stale, record_regions,
+                 record_run, region_key, setup_db)
+from .dedup import make_known_set
+from .engine import DEFAULT_CONCURRENCY, DEFAULT_QPS, CrawlEngine
+from .frontier import SQLiteFrontier
+from .metrics import NULL_METRICS
+from .scheduling import get_policy
+
+MAX_ERRORS = 3  # Максимальное количество последовательных ошибок API
+QUEUE_DEPTH_INTERVAL = 5  # как часто обновлять метрику длины очереди (SELECT COUNT), сек
+YIELD_WINDOW = 20  # по скольким последним ответам считается текущая отдача для min_yield
+PAGE_PER_SLOT = 4  # сколько фраз на один одновременный запрос брать в аренду за раз (SQLiteFrontier.page_size)
+
+# Причины остановки парсинга
+STOP_LIMIT = "limit"  # исчерпан лимит запросов
+STOP_EXHAUSTED = "exhausted"  # очередь обработана полностью
+STOP_ERRORS = "errors"  # слишком много ошибок подряд
+STOP_FIRST_FAILED = "first_failed"  # первый запрос не удался
+STOP_QUOTA = "quota"  # дневная квота всех токенов исчерпана
+STOP_CANCELLED = "cancelled"  # остановлен вызовом Crawler.stop()
+STOP_SATURATED = "saturated"  # отдача упала ниже min_yield новых фраз на запрос
+STOP_PRUNED = "pruned"  # в очереди остались только фразы за ограничениями обхода (глубина, ветки)
+STOP_LEASED = "leased"  # свободных фраз нет, остаток очереди в работе у другого процесса
+
+
+@dataclass
+class CrawlStats:
+    """Состояние парсинга; передается в on_progress после каждого ответа."""
+    max_requests: int
+    requests: int = 0  # рекурсивные запросы к API (первый запрос не считается, как и в UI)
+    cached: int = 0  # ответы из кэша
+    errors: int = 0
+    consecutive_errors: int = 0
+    phrases: int = 0  # всего фраз в results
+    new_phrases: int = 0  # добавлено в этом запуске
+    dedup_skipped: int = 0  # фраз отсеяно множеством известных фраз до SQLite
+    dedup_bytes: int = 0  # память множества известных фраз
+    collapsed: int = 0  # близких дублей не поставлено в очередь — сэкономлено запросов к API
+    stale: int = 0  # фраз отобрано для повторного обхода (Crawler.recrawl)
+    started_at: float = field(default_factory=time.time)
+    stop_reason: str = None
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started_at
+
+    @property
+    def eta(self):
+        """Оценка оставшегося времени в секундах по среднему времени запроса."""
+        if not self.requests or self.requests >= self.max_requests:
+            return 0.0
+        return self.elapsed / self.requests * (self.max_requests - self.requests)
+
+
+class Crawler:
+    """
+    Рекурсивный парсинг Wordstat в БД SQLite без привязки к UI.
+
+    on_progress(stats) вызывается после каждого ответа API,
+    on_event(level, message) — для сообщений ("info", "warning", "error").
+    Оба колбэка выполняются в потоке, вызвавшем run().
+
+    shared_store=True — БД общая для нескольких исходных фраз (пакетный режим):
+    очередь каждого запуска ограничена фразами, найденными от его исходной фразы.
+    bucket — общий TokenBucket, если несколько Crawler работают с одним клиентом.
+    qps — лимит на один токен; общий лимит умножается на число токенов клиента.
+    dedup — "fingerprint" или "bloom": держать в памяти компактное множество
+    фраз из results и отсеивать повторы в ответах до записи в SQLite
+    (см. wordstat.dedup); None — дедупликация только средствами SQLite.
+    collapse=True — раскрывать только одну фразу на канонический ключ (см. wordstat.normalize).
+    metrics — wordstat.metrics.Metrics (по умолчанию — метрики клиента): время записи
+    в SQLite и колбэков, записанные строки, отсеянные дубли, длина очереди, остаток квоты.
+    max_depth, max_branch_requests, min_branch_yield — ограничения обхода по глубине
+    и по веткам (см. SQLiteFrontier); edges=False — не записывать граф обхода (таблица edges).
+    terms=False — refresh_terms() не обновляет индекс лемм (см. wordstat.terms); индекс дополняет
+    вызывающий код один раз на БД после завершения заданий, а не каждый run().
+    min_yield — остановить парсинг (STOP_SATURATED), когда последние YIELD_WINDOW ответов
+    приносят в среднем меньше min_yield новых фраз: квота не тратится на исчерпанную тему.
+    Итоги каждого запуска сохраняются в таблицу runs (история для wordstat.planner).
+
+    stop() из другого потока останавливает запуск: новые запросы не отправляются,
+    ответы на уже отправленные сохраняются, необработанные фразы остаются в очереди.
+    """
+
+    def __init__(self, client, db_path, regions=None, policy="fifo", concurrency=DEFAULT_CONCURRENCY,
+                 qps=DEFAULT_QPS, max_errors=MAX_ERRORS, on_progress=None, on_event=None,
+                 shared_store=False, bucket=None, dedup=None, collapse=True, metrics=None, max_depth=None,
+                 max_branch_requests=None, min_branch_yield=None, edges=True, terms=True, min_yield=None):
+        self.client = client
+        self.db_path = db_path
+        self.regions = list(regions) if regions else None
+        self.policy = get_policy(policy) if isinstance(policy, str) else policy
+        self.concurrency = concurrency
+        self.qps = qps
+        self.max_errors = max_errors
+        self.on_progress = on_progress
+        self.on_event = on_event
+        self.shared_store = shared_store
+        self.bucket = bucket
+        self.dedup = dedup
+        self.collapse = collapse
+        self.metrics = metrics if metrics is not None else getattr(client, "metrics", NULL_METRICS)
+        self.limits = {"max_depth": max_depth, "max_branch_requests": max_branch_requests,
+                       "min_branch_yield": min_branch_yield}
+        self.edges = edges
+        self.terms = terms
+        self.min_yield = min_yield
+        self._lemmatizer = None
+        self._gauges_at = 0.0
+        self._stop = threading.Event()
+
+    def stop(self):
+        """Просит остановить текущий (или ближайший) запуск; причина остановки — STOP_CANCELLED."""
+        self._stop.set()
+
+    def _event(self, level, message):
+        if self.on_event is not None:
+            self.on_event(level, message)
+
+    def _load_known(self, conn, max_requests):
+        """Множество фраз из results для отсечения повторов до SQLite (None, если dedup не задан)."""
+        if self.dedup is None:
+            return None
+        size = get_db_phrase_count(conn)
+        expected = max_requests * getattr(self.client, "num_phrases", NUM_PHRASES)
+        known = make_known_set(self.dedup, size, expected)
+        for (phrase,) in conn.execute("SELECT phrase FROM results"):
+            known.add(phrase)
+        return known
+
+    def _ingest(self, conn, phrase, items, stats, known, seed, refresh=False):
+        """ingest_response с учетом фраз, отсеянных множеством known, и близких дублей."""
+        with self.metrics.timer("sqlite"):
+            added, collapsed, skipped = ingest_response(conn, phrase, items, self.policy, seed=seed, known=known,
+                                               collapse=self.collapse, refresh=refresh, edges=self.edges)
+        stats.collapsed += collapsed
+        self.metrics.inc("rows_inserted", added)
+        self.metrics.inc("collapsed", collapsed)
+        if known is not None:
+            stats.dedup_skipped += skipped
+            stats.dedup_bytes = known.nbytes
+            self.metrics.inc("dedup_hits", skipped)
+            self.metrics.set("dedup_bytes", known.nbytes)
+        return added
+
+    def _record_run(self, conn, kind, seed, stats):
+        """Итоги запуска — в runs; запуск без единого ответа не записывается."""
+        if not stats.requests and not stats.cached and not stats.new_phrases:
+            return
+        try:
+            record_run(conn, kind, seed, stats.started_at, stats.requests, stats.cached, stats.new_phrases,
+                       stats.errors, self.concurrency, stats.stop_reason)
+        except sqlite3.OperationalError as e:
+            self._event("warning", f"⚠️ Итоги запуска не сохранены: {e}.")
+
+    def _record_regions(self, conn):
+        """Запоминает регионы БД; запуск по другим регионам смешает показы — об этом предупреждаем."""
+        recorded, current = record_regions(conn, self.regions), region_key(self.regions)
+        if recorded != current:
+            self._event("warning", f"⚠️ БД собиралась по регионам «{recorded}», а запуск — по «{current}»: "
+                                   f"показы разных регионов окажутся в одной таблице.")
+
+    def refresh_terms(self, stats=None):
+        """
+        Дополняет индекс лемм БД фразами, найденными после прошлого обновления.
+        Ничего не делает при terms=False и после запуска `stats`, остановленного
+        или не начавшегося (STOP_CANCELLED, STOP_FIRST_FAILED): новых фраз нет или
+        индекс не нужен прямо сейчас. Ошибка записи не прерывает завершение.
+        """
+        if not self.terms or (stats is not None and stats.stop_reason in (STOP_CANCELLED, STOP_FIRST_FAILED)):
+            return
+        # Импорт здесь, чтобы python -m wordstat.terms не загружал модуль повторно через пакет
+        from .terms import Lemmatizer, refresh_index
+        if self._lemmatizer is None:
+            self._lemmatizer = Lemmatizer()
+        conn = setup_db(self.db_path)
+        try:
+            with self.metrics.timer("terms"):
+                refresh_index(conn, self._lemmatizer)
+        except sqlite3.OperationalError as e:
+            self._event("warning", f"⚠️ Индекс лемм не обновлен: {e}. Он дополнится при следующем запуске.")
+        finally:
+            conn.close()
+
+    def _update_gauges(self, frontier, force=False):
+        """Длина очереди и остаток квоты — не чаще раза в QUEUE_DEPTH_INTERVAL секунд."""
+        now = time.monotonic()
+        if not force and now - self._gauges_at < QUEUE_DEPTH_INTERVAL:
+            return
+        self._gauges_at = now
+        self.metrics.set("queue_depth", frontier.pending_count())
+        tokens = getattr(self.client, "tokens", None)
+        if tokens is not None:
+            self.metrics.set("quota_remaining", tokens.remaining_total)
+
+    def _needs_seed(self, conn, phrase, frontier):
+        if not frontier.is_empty():
+            return False
+        if frontier.leased_elsewhere():
+            # Очередь этой БД сейчас разбирает другой процесс — исходная фраза уже раскрыта
+            return False
+        if frontier.held_back():
+            # Очередь не пуста, ее закрыли ограничения обхода — повторный запрос исходной фразы глубже не пустит
+            return False
+        if not self.shared_store:
+            return True
+        # В общей БД фраза могла быть уже обработана другим заданием — повторять запрос незачем
+        row = conn.execute("SELECT status FROM queue WHERE phrase = ?", (phrase,)).fetchone()
+        return row is None or row[0] == 'PENDING'
+
+    def _seed(self, conn, phrase, stats, quota=None, known=None):
+        """Первый запрос для пустой очереди (квота на него уже взята). Возвращает False, если он не удался."""
+        result = self.client.top_requests(phrase, self.regions)
+        if result.cached and quota is not None:
+            quota.release()
+        if not result.ok or not result.items:
+            self._event("error", f"❌ Первый запрос завершился ошибкой ({result.error or 'пустой ответ'}). "
+                                 f"Парсинг не может быть начат.")
+            return False
+
+        # Частотность исходной фразы (она должна быть первой в массиве)
+        first = result.items
+        initial_count = first[0].get('count', 0) if first[0].get('phrase') == phrase else 0
+
+        # Исходная фраза сразу PROCESSED, затем одной транзакцией ВСЕ фразы ответа
+        seed = phrase if self.shared_store else None
+        insert_result_and_queue(conn, phrase, initial_count, is_processed=True, seed=seed)
+        if known is not None:
+            known.add(phrase)
+        self._ingest(conn, phrase, first, stats, known, seed)
+        return True
+
+    def run(self, phrase, max_requests, quota=None):
+        """
+        Парсит от фразы `phrase` (или продолжает очередь из БД). Возвращает CrawlStats.
+        quota — общий бюджет запросов (см. CrawlEngine.run); на него расходуется и первый запрос.
+        """
+        stats = CrawlStats(max_requests=max_requests)
+        seed = phrase if self.shared_store else None
+        conn = setup_db(self.db_path)
+        frontier = None
+        try:
+            self._record_regions(conn)
+            frontier = SQLiteFrontier(conn, self.policy, page_size=self.concurrency * PAGE_PER_SLOT, seed=seed,
+                                      **self.limits)
+            known = self._load_known(conn, max_requests)
+            if known is not None:
+                stats.dedup_bytes = known.nbytes
+
+            if self._stop.is_set():
+                stats.stop_reason = STOP_CANCELLED
+                return stats
+            if self._needs_seed(conn, phrase, frontier):
+                if quota is not None and not quota.acquire():
+                    stats.stop_reason = STOP_LIMIT
+                    return stats
+                if not self._seed(conn, phrase, stats, quota, known):
+                    stats.stop_reason = STOP_FIRST_FAILED
+                    return stats
+            elif not frontier.is_empty():
+                self._event("info", f"Возобновление парсинга. Очередь: {frontier.pending_count()} фраз.")
+            elif frontier.held_back():
+                self._event("info", f"В очереди {frontier.held_back()} фраз, но все они за ограничениями обхода. "
+                                    f"Чтобы продолжить, ослабьте ограничения.")
+            stats.phrases = get_db_phrase_count(conn)
+
+            return self._crawl(conn, frontier, stats, max_requests, quota, known, seed)
+        finally:
+            if frontier is not None:
+                frontier.release()
+            self._record_run(conn, "crawl", phrase, stats)
+            conn.close()
+
+    def recrawl(self, max_requests, max_age=None, min_count=None, quota=None):
+        """
+        Повторный обход: заново раскрывает только обработанные фразы, показы которых
+        получены больше `max_age` секунд назад и не меньше `min_count` (см. db.mark_stale).
+        Показы обновляются, прежние значения остаются в истории (observations).
+        Новые найденные фразы встают в очередь PENDING для обычного парсинга, а отобранные,
+        но не раскрытые из-за лимита фразы остаются STALE до следующего запуска.
+        """
+        stats = CrawlStats(max_requests=max_requests)
+        conn = setup_db(self.db_path)
+        frontier = None
+        try:
+            self._record_regions(conn)
+            stats.stale = mark_stale(conn, max_age, min_count)
+            stats.phrases = get_db_phrase_count(conn)
+            self._event("info", f"Повторный обход: фраз для обновления — {stats.stale}.")
+            frontier = SQLiteFrontier(conn, self.policy, page_size=self.concurrency * PAGE_PER_SLOT, status=STALE,
+                                      **self.limits)
+            # Ответы из кэша принимаются, только если они моложе того же порога max_age
+            return self._crawl(conn, frontier, stats, max_requests, quota, None, None,
+                               refresh=True, max_age=max_age or 0)
+        finally:
+            if frontier is not None:
+                frontier.release()
+            self._record_run(conn, "recrawl", None, stats)
+            conn.close()
+
+    def _crawl(self, conn, frontier, stats, max_requests, quota, known, seed, refresh=False, max_age=None):
+        """Раскрывает фразы из `frontier`, пока не исчерпан лимит, очередь или квота."""
+        self._gauges_at = 0.0
+        if self.metrics is not NULL_METRICS:
+            self._update_gauges(frontier, force=True)
+        recent = deque(maxlen=YIELD_WINDOW)  # новых фраз в последних ответах
+
+        def handle_result(current_phrase, result, elapsed):
+            if result.status == EXHAUSTED:
+                # Запрос не отправлялся: квота всех токенов исчерпана
+                if stats.stop_reason is None:
+                    stats.stop_reason = STOP_QUOTA
+                    self._event("error", f"❌ {result.error}. Парсинг остановлен до сброса квоты (полночь по МСК).")
+                frontier.retry(current_phrase)
+                return False
+
+            if result.cached:
+                stats.cached += 1
+            else:
+                stats.requests += 1
+
+            # Повторы с задержкой уже выполнил клиент
+            if result.status == PERMANENT:
+                # Повтор не поможет (например, 400) — убираем фразу из очереди
+                stats.errors += 1
+                self._event("warning", f"⚠️ Фраза '{current_phrase}' отклонена API ({result.error}). Пропускаем.")
+                frontier.fail(current_phrase, result.error_code)
+                return True
+
+            if result.retryable:
+                stats.errors += 1
+                stats.consecutive_errors += 1
+                # Попытка и код ошибки записываются в queue; фраза остается за этим процессом
+                requeued = frontier.retry(current_phrase, result.error_code)
+                if stats.consecutive_errors >= self.max_errors:
+                    # Ответы на уже отправленные запросы еще приходят — сообщаем об остановке один раз
+                    if stats.stop_reason is None:
+                        stats.stop_reason = STOP_ERRORS
+                        self._event("error", f"❌ Достигнут лимит последовательных ошибок ({self.max_errors}). "
+                                             f"Парсинг остановлен.")
+                    return False
+                if requeued:
+                    # Фраза возвращается в конец очереди
+                    self._event("warning", f"⚠️ Ошибка API ({result.error}). Фраза '{current_phrase}' осталась "
+                                           f"в очереди. Счет: {stats.consecutive_errors}/{self.max_errors}.")
+                else:
+                    self._event("warning", f"⚠️ Ошибка API ({result.error}). Фраза '{current_phrase}' исключена "
+                                           f"из очереди: исчерпаны попытки.")
+                return True
+
+            stats.consecutive_errors = 0
+            # Одной транзакцией сохраняем ВСЕ фразы ответа и помечаем текущую как PROCESSED
+            added = self._ingest(conn, current_phrase, result.items, stats, known, seed, refresh)
+            stats.phrases += added
+            stats.new_phrases += added
+            frontier.done(current_phrase)
+
+            if self.metrics is not NULL_METRICS:
+                self._update_gauges(frontier)
+            if self.on_progress is not None:
+                with self.metrics.timer("callback"):
+                    self.on_progress(stats)
+
+            # При повторном обходе новых фраз почти нет — отдача не проверяется
+            if self.min_yield is not None and not refresh:
+                recent.append(added)
+                if len(recent) == YIELD_WINDOW and sum(recent) / YIELD_WINDOW < self.min_yield:
+                    if stats.stop_reason is None:
+                        stats.stop_reason = STOP_SATURATED
+                        self._event("info", f"Отдача упала ниже {self.min_yield:g} новых фраз на запрос "
+                                            f"(последние {YIELD_WINDOW} ответов). Парсинг остановлен.")
+                    return False
+            return True
+
+        def on_result(current_phrase, result, elapsed):
+            proceed = handle_result(current_phrase, result, elapsed)
+            if self._stop.is_set():
+                if stats.stop_reason is None:
+                    stats.stop_reason = STOP_CANCELLED
+                    self._event("info", "Парсинг остановлен. Необработанные фразы остались в очереди.")
+                return False
+            return proceed
+
+        # Кэш проверяется до лимита QPS, поэтому сам запрос к API идет мимо кэша (max_age=0)
+        engine = CrawlEngine(lambda p: self.client.top_requests(p, self.regions, 0),
+                             concurrency=self.concurrency, qps=self.qps * getattr(self.client, "token_count", 1),
+                             bucket=self.bucket, metrics=self.metrics,
+                             lookup=lambda p: self.client.cached_top_requests(p, self.regions, max_age))
+        engine.run(frontier.pop, on_result, max_requests, quota=quota)
+        if self.metrics is not NULL_METRICS:
+            self._update_gauges(frontier, force=True)
+
+        if stats.stop_reason is None:
+            if not frontier.is_empty():
+                stats.stop_reason = STOP_LIMIT
+            elif frontier.leased_elsewhere():
+                # Очередь не исчерпана: ее остаток раскрывает другой процесс и может еще пополнить
+                stats.stop_reason = STOP_LEASED
+                self._event("info", "Свободных фраз нет: остаток очереди в работе у другого процесса.")
+            else:
+                stats.stop_reason = STOP_PRUNED if frontier.held_back() else STOP_EXHAUSTED
+        return stats
@@ -0,0 +1,466 @@
+import os
+import re
+import socket
+import sqlite3
+import time
+import uuid
+
+from .normalize import canonical_key
+
+# Настройки соединения: WAL позволяет читать БД во время записи,
+# synchronous=NORMAL в режиме WAL безопасен и не делает fsync на каждый коммит.
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -65536",  # 64 МБ
+    "PRAGMA temp_store = MEMORY",
+)
+# Статус фразы, которая не раскрывается: фраза с тем же каноническим ключом уже в очереди
+DUPLICATE = 'DUPLICATE'
+# Статус обработанной фразы, отобранной для повторного раскрытия (см. mark_stale)
+STALE = 'STALE'
+# Статус фразы, выданной в работу одному из процессов (аренда, см. claim_phrases)
+IN_PROGRESS = 'IN_PROGRESS'
+LEASE_SECONDS = 300  # срок аренды фразы; продлевается, пока процесс жив
+MAX_ATTEMPTS = 5  # после стольких неудачных попыток фраза получает статус ERROR
+REGIONS_KEY = "regions"  # ключ meta: набор регионов, по которому собраны показы (см. region_key)
+
+
+def sanitize_filename(phrase):
+    """Очищает фразу для использования в качестве имени файла."""
+    phrase = re.sub(r'[\\/:*?"<>|]', '', phrase)
+    return phrase.strip().replace(' ', '_')[:50] + ".db"
+
+
+def region_key(regions):
+    """Ключ набора регионов: "all" без регионов или ID по возрастанию через "_"."""
+    if not regions:
+        return "all"
+    return "_".join(str(r) for r in sorted({int(r) for r in regions}))
+
+
+def setup_db(db_name, timeout=30):
+    """
+    Подключается к БД и создает таблицы results и queue, а также observations —
+    историю показов: при изменении count в results прежнее значение со временем
+    его получения (updated_at) переносится в observations (триггер). Вся история
+    фразы, включая текущее значение, — представление count_history.
+
+    Граф обхода: edges — какая фраза в ответе какой фразы встретилась (глубина
+    дочерней фразы и позиция в topRequests), branch_stats — отдача веток: сколько
+    запросов потрачено на ветку и сколько новых фраз она принесла. Ветка — фраза
+    первого уровня (из ответа на исходную фразу), от которой найдена фраза.
+
+    История для прогнозов (wordstat.planner): runs — итоги запусков, а в queue
+    для каждой раскрытой фразы — когда она раскрыта и сколько новых фраз принесла.
+
+    meta — свойства БД «ключ → значение», например набор регионов (REGIONS_KEY),
+    по которому собраны показы: БД с разными регионами нельзя сливать в одну.
+    """
+    conn = sqlite3.connect(db_name, timeout=timeout)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS results (
+            phrase TEXT PRIMARY KEY,
+            count INTEGER
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS queue (
+            phrase TEXT PRIMARY KEY,
+            status TEXT DEFAULT 'PENDING' 
+        )
+    """)
+    # updated_at — когда показы фразы получены из API последний раз
+    add_missing_columns(conn, "results", {"updated_at": "REAL"})
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS observations (
+            phrase TEXT,
+            count INTEGER,
+            observed_at REAL
+        )
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_results_count AFTER UPDATE OF count ON results
+        WHEN NEW.count IS NOT OLD.count
+        BEGIN
+            INSERT INTO observations (phrase, count, observed_at) VALUES (OLD.phrase, OLD.count, OLD.updated_at);
+        END
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS edges (
+            parent TEXT,
+            child TEXT,
+            depth INTEGER,
+            rank INTEGER,
+            PRIMARY KEY (parent, child)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS branch_stats (
+            branch TEXT PRIMARY KEY,
+            requests INTEGER DEFAULT 0,
+            new_phrases INTEGER DEFAULT 0
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT,
+            seed TEXT,
+            started_at REAL,
+            finished_at REAL,
+            requests INTEGER,
+            cached INTEGER,
+            new_phrases INTEGER,
+            errors INTEGER,
+            concurrency INTEGER,
+            stop_reason TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE VIEW IF NOT EXISTS count_history AS
+        SELECT phrase, count, observed_at FROM observations
+        UNION ALL
+        SELECT phrase, count, updated_at FROM results
+    """)
+    # Приоритет и глубина фразы (столбцы добавляются и в БД, созданные до их появления).
+    # seed — исходная фраза задания, которое нашло фразу (в общем хранилище пакетного режима).
+    # canon — канонический ключ фразы (см. wordstat.normalize).
+    # lease_* — кто и до какого времени обрабатывает фразу IN_PROGRESS и из какого статуса она взята;
+    # attempts и error_code — число неудачных попыток и код последней ошибки (HTTP-код, network...).
+    # processed_at и new_phrases — когда фраза раскрыта и сколько новых фраз принес ответ на нее.
+    added = add_missing_columns(conn, "queue", {
+        "priority": "REAL DEFAULT 0",
+        "depth": "INTEGER DEFAULT 0",
+        "seed": "TEXT",
+        "canon": "TEXT",
+        "lease_owner": "TEXT",
+        "lease_expires": "REAL",
+        "lease_from": "TEXT",
+        "attempts": "INTEGER DEFAULT 0",
+        "error_code": "TEXT",
+        "branch": "TEXT",
+        "processed_at": "REAL",
+        "new_phrases": "INTEGER",
+    })
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_status_queue ON queue (status)")
+    # Сортировка и фильтрация по показам в просмотре результатов
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_count_results ON results (count DESC)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_updated_results ON results (updated_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_phrase_observations ON observations (phrase, observed_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_priority_queue ON queue (status, priority DESC)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_depth_queue ON queue (status, depth, priority DESC)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_seed_queue ON queue (seed, status, priority DESC)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_canon_queue ON queue (canon)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_lease_queue ON queue (lease_owner)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_branch_queue ON queue (branch)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_child_edges ON edges (child)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_processed_queue ON queue (processed_at)")
+    if "canon" in added:
+        backfill_canon(conn)
+    conn.commit()
+    return conn
+
+
+def backfill_canon(conn):
+    """
+    Заполняет канонические ключи фраз, записанных до появления столбца canon, и
+    исключает из очереди близкие дубли: PENDING-фраза становится DUPLICATE, если
+    фраза с тем же ключом уже обработана или стоит в очереди раньше нее.
+    """
+    conn.create_function("canonical_key", 1, canonical_key, deterministic=True)
+    conn.execute("UPDATE queue SET canon = canonical_key(phrase)")
+    conn.execute(f"""
+        UPDATE queue SET status = '{DUPLICATE}'
+        WHERE status = 'PENDING' AND EXISTS (
+            SELECT 1 FROM queue AS other
+            WHERE other.canon = queue.canon AND (other.status = 'PROCESSED' OR other.rowid < queue.rowid)
+        )
+    """)
+
+
+def add_missing_columns(conn, table, columns):
+    """Добавляет в таблицу отсутствующие столбцы: {имя: определение}. Возвращает имена добавленных."""
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    added = []
+    for name, definition in columns.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+            added.append(name)
+    return added
+
+
+def insert_result_and_queue(conn, phrase, count, is_processed=False, seed=None):
+    """Вставляет фразу в results и в queue."""
+    conn.execute("INSERT OR IGNORE INTO results (phrase, count, updated_at) VALUES (?, ?, ?)",
+                 (phrase, count, time.time()))
+    status = 'PROCESSED' if is_processed else 'PENDING'
+    conn.execute("INSERT OR IGNORE INTO queue (phrase, status, seed, canon) VALUES (?, ?, ?, ?)",
+                 (phrase, status, seed, canonical_key(phrase)))
+
+
+def update_queue_status(conn, phrase, status='PROCESSED'):
+    """Обновляет статус фразы в таблице queue."""
+    conn.execute("UPDATE queue SET status = ? WHERE phrase = ?", (status, phrase))
+
+
+def find_canon(conn, canons, chunk_size=500):
+    """Возвращает фразы queue с ключами из `canons` в виде пар (phrase, canon)."""
+    canons = list(canons)
+    found = []
+    for start in range(0, len(canons), chunk_size):
+        chunk = canons[start:start + chunk_size]
+        found += conn.execute(f"SELECT phrase, canon FROM queue WHERE canon IN ({', '.join('?' * len(chunk))})",
+                              chunk).fetchall()
+    return found
+
+
+def ingest_response(conn, phrase, items, policy=None, seed=None, known=None, collapse=True, refresh=False,
+                    edges=True):
+    """
+    Записывает ответ API для `phrase` одной транзакцией: все фразы из `items`
+    попадают в results и в queue (PENDING), сама `phrase` помечается PROCESSED.
+    Новым фразам в queue проставляются глубина (глубина `phrase` + 1),
+    приоритет по политике обхода `policy` (см. wordstat.scheduling), `seed`
+    и ветка. Запрос и новые фразы засчитываются ветке `phrase` в branch_stats
+    (кроме повторного обхода). edges=True — все пары (phrase, фраза ответа)
+    с позицией в ответе записываются в edges.
+
+    known — множество уже записанных фраз (см. wordstat.dedup), новые фразы
+    добавляются в него. Фразы, которых в нем точно нет, идут обычным путем;
+    «возможно известные» проверяются вставкой в results по уникальному ключу,
+    и дальше (очередь, близкие дубли) идут только те, что действительно новые.
+    Ложное срабатывание known поэтому не теряет фразу, а лишь стоит лишней проверки.
+
+    collapse=True — близкие дубли (тот же канонический ключ, см. wordstat.normalize)
+    попадают в queue со статусом DUPLICATE и не раскрываются: в API уходит
+    только первая фраза с данным ключом.
+
+    refresh=True (повторный обход) — показы уже известных фраз обновляются,
+    прежние значения сохраняются в observations.
+
+    Возвращает тройку (added, collapsed, skipped): сколько фраз впервые добавлено
+    в results (чтобы вести счетчик фраз без SELECT COUNT на каждой итерации), сколько
+    новых фраз не поставлено в очередь как дубли — столько запросов к API сэкономлено,
+    и сколько известных фраз отсеяно множеством known до записи в очередь.
+    """
+    edge_rows = [(phrase, item["phrase"], rank) for rank, item in enumerate(items) if item["phrase"] != phrase]
+    rows = [(item["phrase"], item["count"]) for item in items]
+    maybe_known = []
+    if known is not None:
+        new_rows = []
+        for row in rows:
+            (new_rows if known.add(row[0]) else maybe_known).append(row)
+        rows = new_rows
+    parent = conn.execute("SELECT depth, branch FROM queue WHERE phrase = ?", (phrase,)).fetchone()
+    parent_depth = (parent[0] or 0) if parent else 0
+    depth = parent_depth + 1
+    # Фразы первого уровня начинают свои ветки, глубже — наследуют ветку родителя
+    branch = (parent[1] or phrase) if parent_depth else None
+    now = time.time()
+    with conn:
+        before = conn.total_changes
+        conn.executemany("INSERT OR IGNORE INTO results (phrase, count, updated_at) VALUES (?, ?, ?)",
+                         [(p, c, now) for p, c in rows])
+        # «Возможно известные» фразы проверяет уникальный ключ results: вставившиеся — ложные срабатывания
+        rescued = [(p, c) for p, c in maybe_known
+                   if conn.execute("INSERT OR IGNORE INTO results (phrase, count, updated_at) VALUES (?, ?, ?)",
+                                   (p, c, now)).rowcount]
+        rows = rows + rescued
+        added = conn.total_changes - before
+        skipped = len(maybe_known) - len(rescued)
+        if edges:
+            conn.executemany("INSERT OR IGNORE INTO edges (parent, child, depth, rank) VALUES (?, ?, ?, ?)",
+                             [(parent_phrase, child, depth, rank) for parent_phrase, child, rank in edge_rows])
+        if branch is not None and not refresh:
+            conn.execute("""
+                INSERT INTO branch_stats (branch, requests, new_phrases) VALUES (?, 1, ?)
+                ON CONFLICT(branch) DO UPDATE SET requests = requests + 1,
+                                                  new_phrases = new_phrases + excluded.new_phrases
+            """, (branch, added))
+        if refresh:
+            conn.executemany("UPDATE results SET count = ?, updated_at = ? WHERE phrase = ?",
+                             [(c, now, p) for p, c in rows])
+        queue_rows = []
+        collapsed = 0
+        canons = {p: canonical_key(p) for p, _ in rows}
+        queued = set()
+        seen = set()
+        if collapse:
+            for p, canon in find_canon(conn, set(canons.values())):
+                queued.add(p)
+                seen.add(canon)
+        for p, c in rows:
+            if p in queued:
+                continue
+            queued.add(p)
+            status = 'PENDING'
+            if collapse:
+                if canons[p] in seen:
+                    status = DUPLICATE
+                    collapsed += 1
+                seen.add(canons[p])
+            priority = 0 if policy is None else policy.priority(c, depth, added)
+            queue_rows.append((p, status, priority, depth, seed, canons[p], branch or p))
+        conn.executemany(
+            "INSERT OR IGNORE INTO queue (phrase, status, priority, depth, seed, canon, branch) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            queue_rows)
+        # Отдача фразы записывается при первом раскрытии; повторный обход ее не меняет
+        conn.execute("""
+            INSERT INTO queue (phrase, status, canon, processed_at, new_phrases) VALUES (?, 'PROCESSED', ?, ?, ?)
+            ON CONFLICT(phrase) DO UPDATE SET status = 'PROCESSED', lease_owner = NULL, lease_expires = NULL,
+                                              lease_from = NULL,
+                                              processed_at = COALESCE(excluded.processed_at, processed_at),
+                                              new_phrases = COALESCE(excluded.new_phrases, new_phrases)
+        """, (phrase, canonical_key(phrase), None if refresh else now, None if refresh else added))
+    return added, collapsed, skipped
+
+
+def lease_owner():
+    """Уникальный идентификатор владельца аренды: хост, PID и случайный суффикс (один на очередь)."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def claim_phrases(conn, owner, where, params, order_by, limit, lease=LEASE_SECONDS):
+    """
+    Атомарно берет в работу до `limit` фраз queue, подходящих под условие `where`,
+    в порядке `order_by`: они получают статус IN_PROGRESS с владельцем `owner` и
+    сроком аренды. Транзакция BEGIN IMMEDIATE не дает двум процессам взять одну фразу.
+    Возвращает список фраз.
+    """
+    if conn.in_transaction:
+        conn.commit()
+    expires = time.time() + lease
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        phrases = [row[0] for row in conn.execute(
+            f"SELECT phrase FROM queue WHERE {where} ORDER BY {order_by} LIMIT ?", (*params, limit))]
+        conn.executemany(
+            f"UPDATE queue SET lease_from = status, status = '{IN_PROGRESS}', lease_owner = ?, lease_expires = ? "
+            f"WHERE phrase = ?", [(owner, expires, phrase) for phrase in phrases])
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return phrases
+
+
+def renew_leases(conn, owner, lease=LEASE_SECONDS):
+    """Продлевает аренду всех фраз владельца `owner`."""
+    with conn:
+        conn.execute(f"UPDATE queue SET lease_expires = ? WHERE lease_owner = ? AND status = '{IN_PROGRESS}'",
+                     (time.time() + lease, owner))
+
+
+def release_phrases(conn, owner, phrases=None):
+    """Возвращает фразы владельца `owner` (все или только `phrases`) в статус, из которого они взяты."""
+    sql = (f"UPDATE queue SET status = COALESCE(lease_from, 'PENDING'), lease_owner = NULL, lease_expires = NULL, "
+           f"lease_from = NULL WHERE lease_owner = ? AND status = '{IN_PROGRESS}'")
+    with conn:
+        if phrases is None:
+            conn.execute(sql, (owner,))
+        else:
+            conn.executemany(sql + " AND phrase = ?", [(owner, phrase) for phrase in phrases])
+
+
+def reclaim_expired(conn, max_attempts=MAX_ATTEMPTS):
+    """
+    Возвращает в очередь фразы с истекшей арендой (процесс упал, не обработав их).
+    Это считается неудачной попыткой с кодом lease_expired; фраза, исчерпавшая
+    `max_attempts` попыток, получает статус ERROR. Возвращает число фраз.
+    """
+    with conn:
+        cursor = conn.execute(f"""
+            UPDATE queue SET attempts = attempts + 1, error_code = 'lease_expired',
+                status = CASE WHEN attempts + 1 >= ? THEN 'ERROR' ELSE COALESCE(lease_from, 'PENDING') END,
+                lease_owner = NULL, lease_expires = NULL, lease_from = NULL
+            WHERE status = '{IN_PROGRESS}' AND lease_expires < ?
+        """, (max_attempts, time.time()))
+    return cursor.rowcount
+
+
+def record_failure(conn, phrase, error_code, permanent=False, max_attempts=MAX_ATTEMPTS):
+    """
+    Учитывает неудачную попытку раскрыть фразу: attempts + 1 и код ошибки.
+    permanent=True или исчерпанные `max_attempts` попыток — фраза получает статус
+    ERROR и больше не выдается. Возвращает True, если фраза переведена в ERROR.
+    """
+    with conn:
+        conn.execute("UPDATE queue SET attempts = attempts + 1, error_code = ? WHERE phrase = ?",
+                     (error_code, phrase))
+        row = conn.execute("SELECT attempts FROM queue WHERE phrase = ?", (phrase,)).fetchone()
+        failed = permanent or (row is not None and row[0] >= max_attempts)
+        if failed:
+            conn.execute("UPDATE queue SET status = 'ERROR', lease_owner = NULL, lease_expires = NULL, "
+                         "lease_from = NULL WHERE phrase = ?", (phrase,))
+    return failed
+
+
+def mark_stale(conn, max_age=None, min_count=None):
+    """
+    Отбирает обработанные фразы для повторного раскрытия: показы получены больше
+    `max_age` секунд назад (или неизвестно когда) и не меньше `min_count`.
+    Незаданный порог не ограничивает выборку. Отобранные фразы получают статус
+    STALE. Возвращает количество фраз STALE в очереди.
+    """
+    conditions = ["queue.status = 'PROCESSED'"]
+    params = []
+    if max_age is not None:
+        conditions.append("(results.updated_at IS NULL OR results.updated_at < ?)")
+        params.append(time.time() - max_age)
+    if min_count is not None:
+        conditions.append("results.count >= ?")
+        params.append(min_count)
+    with conn:
+        conn.execute(f"""
+            UPDATE queue SET status = '{STALE}'
+            WHERE phrase IN (
+                SELECT queue.phrase FROM queue JOIN results ON results.phrase = queue.phrase
+                WHERE {' AND '.join(conditions)}
+            )
+        """, params)
+    return conn.execute(f"SELECT COUNT(*) FROM queue WHERE status = '{STALE}'").fetchone()[0]
+
+
+def get_db_phrase_count(conn):
+    """Возвращает текущее количество уникальных фраз из таблицы results."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(phrase) FROM results")
+    return cursor.fetchone()[0]
+
+
+def record_run(conn, kind, seed, started_at, requests, cached, new_phrases, errors, concurrency, stop_reason):
+    """Сохраняет итоги запуска в runs (история для прогнозов wordstat.planner)."""
+    with conn:
+        conn.execute(
+            "INSERT INTO runs (kind, seed, started_at, finished_at, requests, cached, new_phrases, errors, "
+            "concurrency, stop_reason) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (kind, seed, started_at, time.time(), requests, cached, new_phrases, errors, concurrency, stop_reason))
+
+
+def get_meta(conn, key, schema="main"):
+    """Значение meta по ключу или None (в том числе для БД без таблицы meta, schema — имя ATTACH)."""
+    if not conn.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE type = 'table' AND name = 'meta'").fetchone():
+        return None
+    row = conn.execute(f"SELECT value FROM {schema}.meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def record_regions(conn, regions):
+    """
+    Запоминает набор регионов БД при первом запуске. Возвращает ключ, записанный
+    в БД раньше, — он отличается от region_key(regions), если БД собиралась по другим регионам.
+    """
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)", (REGIONS_KEY, region_key(regions)))
+    return get_meta(conn, REGIONS_KEY)
@@ -0,0 +1,244 @@
+"""
+Компактные структуры для дедупликации фраз в памяти.
+
+Вместо множества/словаря строк хранятся 64-битные отпечатки фраз в массивах
+с открытой адресацией (~16 байт на фразу против ~150 байт у set/dict строк),
+а сами фразы, если они нужны, — одной строкой UTF-8 с массивом смещений.
+"""
+import hashlib
+import math
+from array import array
+
+EMPTY = 0
+DEDUP_KINDS = ("fingerprint", "bloom")
+
+
+def fingerprint(phrase):
+    """64-битный отпечаток фразы (0 зарезервирован под пустую ячейку)."""
+    fp = int.from_bytes(hashlib.blake2b(phrase.encode("utf-8"), digest_size=8).digest(), "little")
+    return fp or 1
+
+
+class FingerprintSet:
+    """
+    Множество отпечатков фраз: хеш-таблица с открытой адресацией в array('Q').
+    Вероятность коллизии двух разных фраз — около n² / 2^65 (≈ 3·10⁻⁶ на 10 млн фраз).
+    """
+
+    def __init__(self, capacity=1024):
+        size = 1 << max(4, math.ceil(math.log2(max(capacity, 8) * 2)))
+        self._keys = array("Q", bytes(8 * size))
+        self._mask = size - 1
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def _slot(self, fp):
+        i = fp & self._mask
+        keys = self._keys
+        while keys[i] != EMPTY and keys[i] != fp:
+            i = (i + 1) & self._mask
+        return i
+
+    def _grow(self):
+        old = self._keys
+        size = len(old) * 2
+        self._keys = array("Q", bytes(8 * size))
+        self._mask = size - 1
+        for fp in old:
+            if fp != EMPTY:
+                self._keys[self._slot(fp)] = fp
+        return old
+
+    def add_fingerprint(self, fp):
+        """Добавляет отпечаток. Возвращает True, если его еще не было."""
+        i = self._slot(fp)
+        if self._keys[i] == fp:
+            return False
+        self._keys[i] = fp
+        self._len += 1
+        if self._len * 2 > len(self._keys):
+            self._grow()
+        return True
+
+    def add(self, phrase):
+        return self.add_fingerprint(fingerprint(phrase))
+
+    def __contains__(self, phrase):
+        fp = fingerprint(phrase)
+        return self._keys[self._slot(fp)] == fp
+
+    @property
+    def nbytes(self):
+        return self._keys.itemsize * len(self._keys)
+
+
+class BloomFilter:
+    """
+    Фильтр Блума: ~1.8 байта на фразу при доле ложных срабатываний 0.1% (по умолчанию).
+    Ложное срабатывание означает, что новая фраза сочтена «возможно известной»;
+    отрицательный ответ («точно нет») всегда верен. После заполнения сверх capacity
+    доля ложных срабатываний растет.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(1, int(capacity))
+        bits = math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        self.num_bits = max(64, bits)
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def _positions(self, fp):
+        # Двойное хеширование: h1 + i * h2 из двух половин 64-битного отпечатка
+        h1 = fp & 0xFFFFFFFF
+        h2 = (fp >> 32) | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add_fingerprint(self, fp):
+        """Добавляет отпечаток. Возвращает True, если его точно не было."""
+        new = False
+        for pos in self._positions(fp):
+            byte, bit = divmod(pos, 8)
+            if not self._bits[byte] & (1 << bit):
+                self._bits[byte] |= 1 << bit
+                new = True
+        if new:
+            self._len += 1
+        return new
+
+    def add(self, phrase):
+        return self.add_fingerprint(fingerprint(phrase))
+
+    def __contains__(self, phrase):
+        return all(self._bits[pos // 8] & (1 << (pos % 8)) for pos in self._positions(fingerprint(phrase)))
+
+    @property
+    def nbytes(self):
+        return len(self._bits)
+
+
+def make_known_set(kind, size=0, expected=0, error_rate=0.001):
+    """
+    Множество известных фраз: "fingerprint" (FingerprintSet, растет по мере заполнения)
+    или "bloom" (BloomFilter на size + expected фраз с долей ложных срабатываний error_rate).
+    Ответ «есть» у обоих вероятностный, поэтому им можно только экономить работу:
+    такие фразы ingest_response проверяет по уникальному ключу SQLite.
+    """
+    if kind == "fingerprint":
+        return FingerprintSet(size)
+    if kind == "bloom":
+        return BloomFilter(size + expected, error_rate)
+    raise ValueError(f"Неизвестный тип дедупликации: {kind}. Доступны: {', '.join(DEDUP_KINDS)}")
+
+
+class PhraseIndex:
+    """
+    Словарь «фраза → показы» с целочисленными ID фраз (интернирование).
+
+    Фразы хранятся одной строкой UTF-8 со смещениями, показы — в array('q'),
+    поиск по отпечатку — в открытой адресации с параллельным массивом ID.
+    """
+
+    def __init__(self, capacity=1024):
+        size = 1 << max(4, math.ceil(math.log2(max(capacity, 8) * 2)))
+        self._keys = array("Q", bytes(8 * size))
+        self._ids = array("l", bytes(array("l").itemsize * size))
+        self._mask = size - 1
+        self._text = bytearray()
+        self._offsets = array("Q", [0])
+        self._counts = array("q")
+
+    def __len__(self):
+        return len(self._counts)
+
+    def _slot(self, fp):
+        i = fp & self._mask
+        keys = self._keys
+        while keys[i] != EMPTY and keys[i] != fp:
+            i = (i + 1) & self._mask
+        return i
+
+    def _grow(self):
+        old_keys, old_ids = self._keys, self._ids
+        size = len(old_keys) * 2
+        self._keys = array("Q", bytes(8 * size))
+        self._ids = array("l", bytes(old_ids.itemsize * size))
+        self._mask = size - 1
+        for fp, phrase_id in zip(old_keys, old_ids):
+            if fp != EMPTY:
+                i = self._slot(fp)
+                self._keys[i] = fp
+                self._ids[i] = phrase_id
+
+    def add(self, phrase, count):
+        """Добавляет фразу. Возвращает (id, True) для новой фразы или (id, False) для известной."""
+        fp = fingerprint(phrase)
+        i = self._slot(fp)
+        if self._keys[i] == fp:
+            return self._ids[i], False
+        phrase_id = len(self._counts)
+        self._keys[i] = fp
+        self._ids[i] = phrase_id
+        self._text += phrase.encode("utf-8")
+        self._offsets.append(len(self._text))
+        self._counts.append(count)
+        if len(self._counts) * 2 > len(self._keys):
+            self._grow()
+        return phrase_id, True
+
+    def __contains__(self, phrase):
+        fp = fingerprint(phrase)
+        return self._keys[self._slot(fp)] == fp
+
+    def phrase(self, phrase_id):
+        return self._text[self._offsets[phrase_id]:self._offsets[phrase_id + 1]].decode("utf-8")
+
+    def count(self, phrase_id):
+        return self._counts[phrase_id]
+
+    def items(self):
+        """Итератор по парам (фраза, показы) в порядке добавления."""
+        for phrase_id in range(len(self._counts)):
+            yield self.phrase(phrase_id), self._counts[phrase_id]
+
+    @property
+    def nbytes(self):
+        return (len(self._text) + self._keys.itemsize * len(self._keys) + self._ids.itemsize * len(self._ids)
+                + self._offsets.itemsize * len(self._offsets) + self._counts.itemsize * len(self._counts))
+
+
+class IdQueue:
+    """FIFO-очередь целочисленных ID в array('l'): O(1) амортизированно, 8 байт на элемент."""
+
+    def __init__(self):
+        self._items = array("l")
+        self._head = 0
+
+    def __len__(self):
+        return len(self._items) - self._head
+
+    def append(self, item):
+        self._items.append(item)
+
+    def popleft(self):
+        if self._head >= len(self._items):
+            raise IndexError("pop from an empty IdQueue")
+        item = self._items[self._head]
+        self._head += 1
+        # Сжимаем, когда прочитанная часть занимает больше половины массива
+        if self._head > 1024 and self._head * 2 > len(self._items):
+            del self._items[:self._head]
+            self._head = 0
+        return item
+
+    @property
+    def nbytes(self):
+        return self._items.itemsize * len(self._items)
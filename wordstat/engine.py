@@ -0,0 +1,102 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .metrics import NULL_METRICS
+from .ratelimit import TokenBucket
+
+# Лимиты API: 10 запросов/сек на токен
+DEFAULT_QPS = 10
+DEFAULT_CONCURRENCY = 10
+
+
+class CrawlEngine:
+    """
+    Держит до `concurrency` запросов к API одновременно и не превышает `qps`.
+
+    Сетевые вызовы выполняются в пуле потоков, а обработка ответов
+    (запись в SQLite, обновление очереди и UI) — в потоке, вызвавшем run(),
+    поэтому соединение с БД и виджеты Streamlit остаются однопоточными.
+    Ожидание лимита QPS попадает в стадию "throttle" метрик `metrics`.
+
+    lookup(phrase) — необязательный ответ без запроса к API (из кэша) или None;
+    он проверяется до `fetch`, и ответ из кэша не ждет и не расходует лимит QPS.
+    """
+
+    def __init__(self, fetch, concurrency=DEFAULT_CONCURRENCY, qps=DEFAULT_QPS, bucket=None, metrics=None,
+                 lookup=None):
+        if concurrency < 1:
+            raise ValueError("concurrency должен быть не меньше 1")
+        self.fetch = fetch
+        self.concurrency = int(concurrency)
+        # Общий bucket позволяет нескольким движкам делить один лимит QPS токена
+        self.bucket = bucket if bucket is not None else TokenBucket(qps)
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+        self.lookup = lookup
+
+    def _call(self, phrase):
+        if self.lookup is not None:
+            started = time.monotonic()
+            result = self.lookup(phrase)
+            if result is not None:
+                return result, time.monotonic() - started
+        with self.metrics.timer("throttle"):
+            self.bucket.acquire()
+        started = time.monotonic()
+        result = self.fetch(phrase)
+        return result, time.monotonic() - started
+
+    def run(self, next_phrase, on_result, max_requests, quota=None):
+        """
+        Выполняет до `max_requests` запросов.
+
+        next_phrase() — возвращает следующую фразу из очереди или None,
+        если очередь (пока) пуста.
+        on_result(phrase, result, elapsed) — вызывается для каждого ответа;
+        может пополнять очередь. Если вернет False, новые запросы больше
+        не отправляются, а уже отправленные дорабатываются.
+
+        Ответы из кэша (result.cached) квоту не тратят и в `max_requests`
+        не засчитываются.
+
+        quota — необязательный общий бюджет запросов (см. wordstat.batch.JobQuota)
+        с методами acquire() -> bool и release(); если acquire() вернул False,
+        новые запросы больше не отправляются.
+
+        Возвращает количество выполненных запросов к API.
+        """
+        done = 0
+        submitted = 0
+        stopped = False
+        inflight = {}
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            while True:
+                while not stopped and submitted < max_requests and len(inflight) < self.concurrency:
+                    if quota is not None and not quota.acquire():
+                        stopped = True
+                        break
+                    phrase = next_phrase()
+                    if phrase is None:
+                        if quota is not None:
+                            quota.release()
+                        break
+                    inflight[pool.submit(self._call, phrase)] = phrase
+                    submitted += 1
+
+                if not inflight:
+                    break
+
+                finished, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    phrase = inflight.pop(future)
+                    result, elapsed = future.result()
+                    if getattr(result, "cached", False):
+                        submitted -= 1
+                        if quota is not None:
+                            quota.release()
+                    else:
+                        done += 1
+                    if on_result(phrase, result, elapsed) is False:
+                        stopped = True
+
+        return done
@@ -0,0 +1,94 @@
+import re
+from functools import lru_cache
+
+# Допустимые сортировки: имя -> ORDER BY (по индексам idx_count_results и первичному ключу)
+ORDERS = {
+    "count_desc": "count DESC, phrase",
+    "count_asc": "count ASC, phrase",
+    "phrase_asc": "phrase ASC",
+    "phrase_desc": "phrase DESC",
+}
+
+
+@lru_cache(maxsize=64)
+def _compile(pattern):
+    return re.compile(pattern)
+
+
+def _regexp(pattern, value):
+    return value is not None and _compile(pattern).search(value) is not None
+
+
+def enable_regexp(conn):
+    """Регистрирует в соединении оператор REGEXP (в SQLite он есть только как синтаксис)."""
+    conn.create_function("REGEXP", 2, _regexp, deterministic=True)
+
+
+def build_filter(contains=None, regex=None, min_count=None, max_count=None):
+    """
+    Собирает WHERE для фильтрации results. Возвращает (sql, params).
+    Некорректное регулярное выражение — re.error.
+    """
+    clauses = []
+    params = []
+    if contains:
+        # Фразы Wordstat в нижнем регистре, поэтому ищем по нижнему регистру без LIKE
+        clauses.append("instr(phrase, ?) > 0")
+        params.append(contains.lower())
+    if regex:
+        _compile(regex)
+        clauses.append("phrase REGEXP ?")
+        params.append(regex)
+    if min_count is not None:
+        clauses.append("count >= ?")
+        params.append(int(min_count))
+    if max_count is not None:
+        clauses.append("count <= ?")
+        params.append(int(max_count))
+    sql = " WHERE " + " AND ".join(clauses) if clauses else ""
+    return sql, params
+
+
+def query_results(conn, contains=None, regex=None, min_count=None, max_count=None,
+                  order="count_desc", limit=100, offset=0):
+    """
+    Одна страница results с фильтрацией и сортировкой на стороне SQLite.
+    Возвращает (rows, total): строки (phrase, count) и общее число подходящих фраз.
+    """
+    if order not in ORDERS:
+        raise ValueError(f"Неизвестная сортировка: {order}. Доступны: {', '.join(ORDERS)}")
+    if regex:
+        enable_regexp(conn)
+    where, params = build_filter(contains, regex, min_count, max_count)
+    total = conn.execute(f"SELECT COUNT(*) FROM results{where}", params).fetchone()[0]
+    rows = conn.execute(
+        f"SELECT phrase, count FROM results{where} ORDER BY {ORDERS[order]} LIMIT ? OFFSET ?",
+        (*params, int(limit), int(offset)),
+    ).fetchall()
+    return rows, total
+
+
+def branch_yield(conn, limit=50, order="yield"):
+    """
+    Отдача веток обхода из branch_stats: (ветка, запросов, новых фраз, новых фраз
+    на запрос, фраз ветки в очереди). order — "yield" (самые продуктивные первыми),
+    "requests" или "new_phrases".
+    """
+    orders = {"yield": "1.0 * new_phrases / requests DESC", "requests": "requests DESC",
+              "new_phrases": "new_phrases DESC"}
+    if order not in orders:
+        raise ValueError(f"Неизвестная сортировка: {order}. Доступны: {', '.join(orders)}")
+    return conn.execute(f"""
+        SELECT branch, requests, new_phrases, ROUND(1.0 * new_phrases / requests, 1),
+               (SELECT COUNT(*) FROM queue WHERE queue.branch = branch_stats.branch AND queue.status = 'PENDING')
+        FROM branch_stats WHERE requests > 0
+        ORDER BY {orders[order]}, branch LIMIT ?
+    """, (int(limit),)).fetchall()
+
+
+def depth_summary(conn):
+    """Фразы очереди по глубине: (глубина, всего, раскрыто, ждут раскрытия)."""
+    return conn.execute("""
+        SELECT depth, COUNT(*), SUM(status = 'PROCESSED'), SUM(status = 'PENDING')
+        FROM queue GROUP BY depth ORDER BY depth
+    """).fetchall()
@@ -0,0 +1,164 @@
+import argparse
+import csv
+import glob
+import os
+import sqlite3
+import tempfile
+
+CHUNK_SIZE = 50000
+COLUMNS = ("Фраза", "Показы")
+EXCEL_MAX_ROWS = 1048576  # ограничение листа XLSX, включая заголовок
+
+FORMATS = {
+    "csv": "text/csv",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def iter_result_chunks(db_path, chunk_size=CHUNK_SIZE):
+    """Построчно читает results (по убыванию показов) порциями по chunk_size строк."""
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.execute("SELECT phrase, count FROM results ORDER BY count DESC")
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+
+def write_csv(db_path, out_path):
+    with open(out_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for rows in iter_result_chunks(db_path):
+            writer.writerows(rows)
+
+
+def write_xlsx(db_path, out_path):
+    """XLSX в режиме write-only: строки не держатся в памяти; при превышении лимита — новый лист."""
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    sheet, sheet_rows, sheet_no = None, EXCEL_MAX_ROWS, 0
+    for rows in iter_result_chunks(db_path):
+        for row in rows:
+            if sheet_rows >= EXCEL_MAX_ROWS:
+                sheet_no += 1
+                sheet = wb.create_sheet("Wordstat" if sheet_no == 1 else f"Wordstat {sheet_no}")
+                sheet.append(COLUMNS)
+                sheet_rows = 1
+            sheet.append(row)
+            sheet_rows += 1
+    if sheet is None:
+        wb.create_sheet("Wordstat").append(COLUMNS)
+    wb.save(out_path)
+
+
+def write_parquet(db_path, out_path):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Для экспорта в Parquet установите pyarrow: pip install pyarrow")
+
+    schema = pa.schema([(COLUMNS[0], pa.string()), (COLUMNS[1], pa.int64())])
+    with pq.ParquetWriter(out_path, schema) as writer:
+        empty = True
+        for rows in iter_result_chunks(db_path):
+            phrases, counts = zip(*rows)
+            writer.write_table(pa.table([list(phrases), list(counts)], schema=schema))
+            empty = False
+        if empty:
+            writer.write_table(schema.empty_table())
+
+
+WRITERS = {"csv": write_csv, "xlsx": write_xlsx, "parquet": write_parquet}
+
+
+def db_version(db_path):
+    """
+    Версия содержимого БД для ключа кэша: mtime и размер файла БД и WAL-журнала
+    (в режиме WAL изменения попадают в основной файл только при checkpoint).
+    """
+    parts = []
+    for path in (db_path, db_path + "-wal"):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        parts.append(f"{st.st_mtime_ns:x}{st.st_size:x}")
+    return "-".join(parts)
+
+
+def export_results(db_path, fmt, cache_dir=None):
+    """
+    Возвращает путь к файлу экспорта results в формате fmt (csv, xlsx, parquet).
+
+    Файл создается потоково, без загрузки всей таблицы в память, и кэшируется
+    по версии БД: пока БД не изменилась, повторный вызов возвращает готовый файл.
+    Устаревшие экспорты той же БД удаляются.
+    """
+    if fmt not in WRITERS:
+        raise ValueError(f"Неизвестный формат экспорта: {fmt}. Доступны: {', '.join(WRITERS)}")
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(db_path)), "exports")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    stem = os.path.splitext(os.path.basename(db_path))[0]
+    out_path = os.path.join(cache_dir, f"{stem}.{db_version(db_path)}.{fmt}")
+    if os.path.exists(out_path):
+        return out_path
+
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=f".{fmt}.tmp")
+    os.close(fd)
+    try:
+        WRITERS[fmt](db_path, tmp_path)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    for old in glob.glob(os.path.join(glob.escape(cache_dir), f"{glob.escape(stem)}.*.{fmt}")):
+        if old != out_path:
+            os.remove(old)
+    return out_path
+
+
+def remove_exports(db_path, cache_dir=None):
+    """Удаляет все кэшированные экспорты БД."""
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(db_path)), "exports")
+    stem = os.path.splitext(os.path.basename(db_path))[0]
+    for fmt in WRITERS:
+        for path in glob.glob(os.path.join(glob.escape(cache_dir), f"{glob.escape(stem)}.*.{fmt}")):
+            os.remove(path)
+
+
+def checkpoint(db_path):
+    """Переносит WAL-журнал в основной файл, чтобы скачанная БД содержала все данные."""
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m wordstat.export",
+                                     description="Потоковый экспорт результатов из БД SQLite.")
+    parser.add_argument("db", help="файл БД")
+    parser.add_argument("format", choices=list(WRITERS))
+    parser.add_argument("-o", "--output", help="файл результата (по умолчанию — кэш exports/ рядом с БД)")
+    args = parser.parse_args(argv)
+    if args.output:
+        WRITERS[args.format](args.db, args.output)
+        print(args.output)
+    else:
+        print(export_results(args.db, args.format))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
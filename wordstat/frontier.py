@@ -0,0 +1,178 @@
+import time
+from collections import deque
+
+from .db import (IN_PROGRESS, LEASE_SECONDS, MAX_ATTEMPTS, claim_phrases, lease_owner, reclaim_expired,
+                 record_failure, release_phrases, renew_leases)
+from .scheduling import FifoPolicy
+
+PRUNE_AFTER = 5  # сколько запросов на ветку нужно, чтобы судить о ее отдаче (min_branch_yield)
+
+
+class SQLiteFrontier:
+    """
+    Очередь фраз на обработку поверх таблицы queue.
+
+    Фразы PENDING читаются страницами в порядке политики обхода (policy.order_by)
+    по индексу, поэтому при возобновлении не нужно загружать всю таблицу,
+    а каждая выборка из очереди — O(1) без отдельного запроса статуса.
+    Новые фразы, которые ingest_response добавляет в queue, попадают
+    в следующие страницы автоматически.
+
+    Страница берется в аренду одной транзакцией (см. db.claim_phrases): фразы
+    получают статус IN_PROGRESS с владельцем `owner` и сроком аренды `lease`,
+    поэтому несколько процессов могут разбирать одну БД, не раскрывая одну фразу
+    дважды. Аренда продлевается, пока очередь используется; фразы упавшего
+    процесса по истечении аренды возвращаются в очередь (db.reclaim_expired).
+    Невыданные фразы нужно вернуть вызовом release() по окончании работы.
+    Чем меньше page_size, тем быстрее новые фразы с высоким приоритетом
+    обгоняют уже прочитанные.
+
+    Если задан `seed`, выдаются только фразы, найденные заданием с этой
+    исходной фразой (общее хранилище пакетного режима). `status` — статус
+    выдаваемых фраз: PENDING или STALE при повторном обходе (см. db.mark_stale).
+
+    Ограничения обхода (фразы за ними остаются в очереди до запуска с другими лимитами):
+    max_depth — не раскрывать фразы глубже (0 — только исходная фраза);
+    max_branch_requests — не тратить на одну ветку больше запросов;
+    min_branch_yield — не раскрывать ветки, которые после PRUNE_AFTER запросов приносят
+    меньше новых фраз на запрос (см. branch_stats в db.setup_db).
+    Лимиты веток проверяются при выборке страницы и перед выдачей каждой фразы,
+    поэтому ветка может превысить лимит не больше чем на число одновременных запросов.
+    """
+
+    def __init__(self, conn, policy=None, page_size=200, seed=None, status='PENDING', owner=None,
+                 lease=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS, max_depth=None, max_branch_requests=None,
+                 min_branch_yield=None):
+        self.conn = conn
+        self.policy = policy or FifoPolicy()
+        self.page_size = page_size
+        self.seed = seed
+        self.status = status
+        self.owner = owner or lease_owner()
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.max_depth = max_depth
+        self.max_branch_requests = max_branch_requests
+        self.min_branch_yield = min_branch_yield
+        self._buffer = deque()
+        self._retry = deque()
+        self._renewed_at = time.monotonic()
+        reclaim_expired(conn, max_attempts)
+
+    def _where(self, status=None, limits=False):
+        clauses = ["status = ?"]
+        params = [status or self.status]
+        if self.seed is not None:
+            clauses.append("seed = ?")
+            params.append(self.seed)
+        if limits and self.max_depth is not None:
+            clauses.append("depth <= ?")
+            params.append(self.max_depth)
+        if limits and self.max_branch_requests is not None:
+            clauses.append("(branch IS NULL OR branch NOT IN (SELECT branch FROM branch_stats WHERE requests >= ?))")
+            params.append(self.max_branch_requests)
+        if limits and self.min_branch_yield is not None:
+            clauses.append("(branch IS NULL OR branch NOT IN (SELECT branch FROM branch_stats "
+                           "WHERE requests >= ? AND new_phrases < ? * requests))")
+            params += [PRUNE_AFTER, self.min_branch_yield]
+        return " AND ".join(clauses), tuple(params)
+
+    def _fill(self):
+        reclaim_expired(self.conn, self.max_attempts)
+        where, params = self._where(limits=True)
+        self._buffer.extend(claim_phrases(self.conn, self.owner, where, params, self.policy.order_by,
+                                          self.page_size, self.lease))
+
+    def _renew(self):
+        now = time.monotonic()
+        if now - self._renewed_at >= self.lease / 3:
+            self._renewed_at = now
+            renew_leases(self.conn, self.owner, self.lease)
+
+    def _branch_closed(self, phrase):
+        """Ветка фразы исчерпала лимит запросов или оказалась малопродуктивной."""
+        row = self.conn.execute(
+            "SELECT requests, new_phrases FROM queue JOIN branch_stats ON branch_stats.branch = queue.branch "
+            "WHERE queue.phrase = ?", (phrase,)).fetchone()
+        if row is None:
+            return False
+        requests, new_phrases = row
+        if self.max_branch_requests is not None and requests >= self.max_branch_requests:
+            return True
+        return (self.min_branch_yield is not None and requests >= PRUNE_AFTER
+                and new_phrases < self.min_branch_yield * requests)
+
+    def pop(self):
+        """Возвращает следующую фразу или None, если очередь пуста."""
+        self._renew()
+        check_branch = self.max_branch_requests is not None or self.min_branch_yield is not None
+        while True:
+            if not self._buffer:
+                self._fill()
+            if not self._buffer:
+                break
+            phrase = self._buffer.popleft()
+            if check_branch and self._branch_closed(phrase):
+                # Страница выбрана до того, как ветка исчерпала лимит, — фраза возвращается в очередь
+                release_phrases(self.conn, self.owner, [phrase])
+                continue
+            return phrase
+        if self._retry:
+            return self._retry.popleft()
+        return None
+
+    def done(self, phrase):
+        """Фраза обработана: ingest_response уже перевел ее в PROCESSED и снял аренду."""
+
+    def retry(self, phrase, error_code=None):
+        """
+        Возвращает фразу в конец очереди после временной ошибки; аренда сохраняется.
+        error_code — код ошибки (см. FetchResult.error_code), попытка засчитывается;
+        None — запрос не отправлялся. Возвращает False, если попытки исчерпаны
+        и фраза получила статус ERROR.
+        """
+        if error_code is not None and record_failure(self.conn, phrase, error_code,
+                                                     max_attempts=self.max_attempts):
+            return False
+        self._retry.append(phrase)
+        return True
+
+    def fail(self, phrase, error_code):
+        """Повтор не поможет: фраза получает статус ERROR и снимается с аренды."""
+        record_failure(self.conn, phrase, error_code, permanent=True)
+
+    def release(self):
+        """Возвращает невыданные и отложенные фразы в очередь, чтобы их могли взять другие процессы."""
+        self._buffer.clear()
+        self._retry.clear()
+        release_phrases(self.conn, self.owner)
+
+    def is_empty(self):
+        if not self._buffer:
+            self._fill()
+        return not self._buffer and not self._retry
+
+    def pending_count(self):
+        """Количество фраз с нужным статусом в пределах лимитов, включая взятые в работу (любым процессом)."""
+        where, params = self._where(limits=True)
+        leased_where, leased_params = self._where(IN_PROGRESS)
+        return self.conn.execute(
+            f"SELECT COUNT(*) FROM queue WHERE {where} OR ({leased_where} AND lease_from = ?)",
+            (*params, *leased_params, self.status)).fetchone()[0]
+
+    def held_back(self):
+        """Сколько фраз с нужным статусом не выдается из-за ограничений обхода (глубина, ветки)."""
+        if self.max_depth is None and self.max_branch_requests is None and self.min_branch_yield is None:
+            return 0
+        where, params = self._where()
+        limited_where, limited_params = self._where(limits=True)
+        return self.conn.execute(
+            f"SELECT COUNT(*) FROM queue WHERE {where} AND NOT ({limited_where})",
+            (*params, *limited_params)).fetchone()[0]
+
+    def leased_elsewhere(self):
+        """Сколько фраз этой очереди сейчас в работе у других процессов."""
+        where, params = self._where(IN_PROGRESS)
+        return self.conn.execute(
+            f"SELECT COUNT(*) FROM queue WHERE {where} AND lease_from = ? AND lease_owner != ?",
+            (*params, self.status, self.owner)).fetchone()[0]
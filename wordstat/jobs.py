@@ -0,0 +1,197 @@
+"""
+Таблица заданий парсинга в SQLite: интерфейс ставит задания в очередь и читает
+их состояние, фоновый процесс wordstat.worker забирает и выполняет их.
+"""
+import json
+import os
+import socket
+import sqlite3
+import time
+
+from .db import PRAGMAS
+
+DEFAULT_JOBS_DB = "wordstat_jobs.sqlite"
+STALE_AFTER = 60  # сек без heartbeat — исполнитель считается упавшим, задание возвращается в очередь
+
+# Виды заданий
+KIND_CRAWL = "crawl"
+KIND_RECRAWL = "recrawl"
+
+# Статусы заданий
+QUEUED = "QUEUED"
+RUNNING = "RUNNING"
+DONE = "DONE"
+FAILED = "FAILED"
+CANCELLED = "CANCELLED"
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+
+def worker_id(pid=None):
+    """Идентификатор процесса-исполнителя: хост и PID (по умолчанию — текущего процесса)."""
+    return f"{socket.gethostname()}:{pid or os.getpid()}"
+
+
+def setup_jobs_db(path=DEFAULT_JOBS_DB, timeout=30):
+    """Подключается к БД заданий и создает таблицы jobs и workers."""
+    conn = sqlite3.connect(path, timeout=timeout)
+    conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            phrase TEXT,
+            db_path TEXT NOT NULL,
+            params TEXT,
+            status TEXT NOT NULL DEFAULT 'QUEUED',
+            worker TEXT,
+            created_at REAL,
+            started_at REAL,
+            finished_at REAL,
+            heartbeat_at REAL,
+            progress TEXT,
+            message TEXT,
+            result TEXT,
+            error TEXT,
+            cancel_requested INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS workers (
+            id TEXT PRIMARY KEY,
+            pid INTEGER,
+            started_at REAL,
+            heartbeat_at REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_status_jobs ON jobs (status, id)")
+    conn.commit()
+    return conn
+
+
+def _decode(row):
+    if row is None:
+        return None
+    job = dict(row)
+    for key in ("params", "progress", "result"):
+        job[key] = json.loads(job[key]) if job[key] else None
+    return job
+
+
+def submit_job(conn, kind, db_path, phrase=None, **params):
+    """Ставит задание в очередь. params — параметры Crawler.run/recrawl (regions, max_requests, policy...)."""
+    with conn:
+        cursor = conn.execute(
+            "INSERT INTO jobs (kind, phrase, db_path, params, status, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (kind, phrase, db_path, json.dumps(params, ensure_ascii=False), QUEUED, time.time()))
+    return cursor.lastrowid
+
+
+def claim_job(conn, worker):
+    """Атомарно забирает самое старое задание QUEUED для исполнителя `worker`. Возвращает задание или None."""
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            f"SELECT id FROM jobs WHERE status = '{QUEUED}' AND cancel_requested = 0 ORDER BY id LIMIT 1"
+        ).fetchone()
+        if row is None:
+            conn.commit()
+            return None
+        conn.execute(
+            f"UPDATE jobs SET status = '{RUNNING}', worker = ?, started_at = COALESCE(started_at, ?), "
+            f"heartbeat_at = ? WHERE id = ?", (worker, now, now, row["id"]))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return get_job(conn, row["id"])
+
+
+def get_job(conn, job_id):
+    return _decode(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+
+def list_jobs(conn, limit=20, statuses=None):
+    """Последние задания (новые первыми); statuses — фильтр по статусам."""
+    if statuses:
+        rows = conn.execute(
+            f"SELECT * FROM jobs WHERE status IN ({', '.join('?' * len(statuses))}) ORDER BY id DESC LIMIT ?",
+            (*statuses, limit)).fetchall()
+    else:
+        rows = conn.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+    return [_decode(row) for row in rows]
+
+
+def update_progress(conn, job_id, progress, message=None):
+    """Сохраняет прогресс задания (словарь) и, если задано, последнее сообщение."""
+    with conn:
+        conn.execute(
+            "UPDATE jobs SET progress = ?, message = COALESCE(?, message), heartbeat_at = ? WHERE id = ?",
+            (json.dumps(progress, ensure_ascii=False), message, time.time(), job_id))
+
+
+def finish_job(conn, job_id, status, result=None, error=None):
+    with conn:
+        conn.execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, heartbeat_at = ? WHERE id = ?",
+            (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error,
+             time.time(), time.time(), job_id))
+
+
+def requeue_job(conn, job_id, message=None):
+    """Возвращает задание в очередь (исполнитель завершается, не доделав его)."""
+    with conn:
+        conn.execute(f"UPDATE jobs SET status = '{QUEUED}', worker = NULL, message = COALESCE(?, message) "
+                     f"WHERE id = ?", (message, job_id))
+
+
+def request_cancel(conn, job_id):
+    """Просит остановить задание. Задание из очереди отменяется сразу, выполняемое — исполнителем."""
+    with conn:
+        conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+        conn.execute(f"UPDATE jobs SET status = '{CANCELLED}', finished_at = ? WHERE id = ? AND status = '{QUEUED}'",
+                     (time.time(), job_id))
+
+
+def cancel_requested(conn, job_id):
+    row = conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return bool(row and row[0])
+
+
+def heartbeat(conn, worker, job_ids=(), pid=None):
+    """Отмечает, что исполнитель и его задания живы."""
+    now = time.time()
+    with conn:
+        conn.execute(
+            "INSERT INTO workers (id, pid, started_at, heartbeat_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at",
+            (worker, pid or os.getpid(), now, now))
+        conn.executemany("UPDATE jobs SET heartbeat_at = ? WHERE id = ?", [(now, job_id) for job_id in job_ids])
+
+
+def remove_worker(conn, worker):
+    with conn:
+        conn.execute("DELETE FROM workers WHERE id = ?", (worker,))
+
+
+def live_workers(conn, max_age=STALE_AFTER / 4):
+    """Исполнители, приславшие heartbeat за последние `max_age` секунд."""
+    rows = conn.execute("SELECT * FROM workers WHERE heartbeat_at >= ?", (time.time() - max_age,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def reclaim_stale(conn, stale_after=STALE_AFTER):
+    """
+    Возвращает в очередь задания RUNNING, исполнитель которых давно не присылал heartbeat
+    (процесс упал или был убит). Парсинг продолжится с очереди фраз в БД. Возвращает их число.
+    """
+    cutoff = time.time() - stale_after
+    with conn:
+        cursor = conn.execute(
+            f"UPDATE jobs SET status = '{QUEUED}', worker = NULL, message = ? "
+            f"WHERE status = '{RUNNING}' AND heartbeat_at < ?",
+            ("Исполнитель не отвечал — задание возвращено в очередь", cutoff))
+        conn.execute("DELETE FROM workers WHERE heartbeat_at < ?", (cutoff,))
+    return cursor.rowcount
@@ -0,0 +1,242 @@
+"""
+Метрики парсинга: время по стадиям (гистограммы), счетчики и текущие значения.
+
+Стадии горячего пути:
+    http      — одна попытка запроса к API (сеть + ожидание ответа сервера)
+    json      — разбор JSON ответа
+    cache     — чтение и запись ResponseCache
+    token     — ожидание свободного токена (лимит QPS токена, пауза после 429)
+    throttle  — ожидание общего лимита QPS в CrawlEngine
+    backoff   — паузы между повторами
+    sqlite    — запись ответа в SQLite (ingest_response)
+    callback  — on_progress (в приложении — перерисовка Streamlit)
+    terms     — обновление индекса лемм в конце запуска (wordstat.terms)
+
+Экспорт: to_prometheus() (текстовый формат Prometheus, например для textfile
+collector node_exporter) или JsonLinesWriter (снимок метрик на строку).
+"""
+import cProfile
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Границы корзин гистограмм времени, сек
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DEFAULT_EXPORT_INTERVAL = 10
+
+
+def _ms(seconds):
+    """Секунды в миллисекунды для JSON (None вместо бесконечности)."""
+    return None if seconds == float("inf") else round(seconds * 1000, 3)
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами (как histogram в Prometheus)."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # последняя корзина — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля `q` (0–1): верхняя граница корзины, в которую он попадает."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+class Metrics:
+    """Потокобезопасный набор метрик одного запуска (или нескольких — они суммируются)."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.gauges = {}
+        self.stages = {}
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """Обнуляет метрики (перед новым запуском)."""
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.stages.clear()
+            self.started_at = time.time()
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def snapshot(self):
+        """Словарь с текущими значениями; quota_burn_per_min — запросов к API в минуту."""
+        with self._lock:
+            elapsed = time.time() - self.started_at
+            requests = self.counters.get("requests", 0)
+            return {
+                "ts": round(time.time(), 3),
+                "elapsed": round(elapsed, 3),
+                "counters": dict(self.counters),
+                "gauges": {**self.gauges,
+                           "quota_burn_per_min": round(requests / elapsed * 60, 2) if elapsed else 0.0},
+                "stages": {
+                    stage: {
+                        "count": h.count,
+                        "total_sec": round(h.sum, 4),
+                        "avg_ms": round(h.sum / h.count * 1000, 3) if h.count else 0.0,
+                        "p50_ms": _ms(h.quantile(0.5)),
+                        "p99_ms": _ms(h.quantile(0.99)),
+                    }
+                    for stage, h in self.stages.items()
+                },
+            }
+
+    def to_prometheus(self, prefix="wordstat", labels=None):
+        """Метрики в текстовом формате Prometheus."""
+        label_text = ",".join(f'{key}="{_escape_label(value)}"' for key, value in (labels or {}).items())
+
+        def fmt(extra=""):
+            parts = ",".join(part for part in (label_text, extra) if part)
+            return f"{{{parts}}}" if parts else ""
+
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total{fmt()} {value}"]
+        for name, value in sorted(snapshot["gauges"].items()):
+            if value is not None:
+                lines += [f"# TYPE {prefix}_{name} gauge", f"{prefix}_{name}{fmt()} {value}"]
+        with self._lock:
+            stages = {stage: (list(h.counts), h.sum, h.count) for stage, h in self.stages.items()}
+        if stages:
+            lines.append(f"# TYPE {prefix}_stage_seconds histogram")
+        for stage, (counts, total, count) in sorted(stages.items()):
+            stage_label = f'stage="{stage}"'
+            cumulative = 0
+            for bound, bucket_count in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += bucket_count
+                bucket_label = f'{stage_label},le="{bound}"'
+                lines.append(f"{prefix}_stage_seconds_bucket{fmt(bucket_label)} {cumulative}")
+            lines.append(f"{prefix}_stage_seconds_sum{fmt(stage_label)} {total}")
+            lines.append(f"{prefix}_stage_seconds_count{fmt(stage_label)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+class NullMetrics:
+    """Заглушка с тем же интерфейсом: метрики не собираются."""
+
+    def inc(self, name, value=1):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def observe(self, stage, seconds):
+        pass
+
+    @contextmanager
+    def timer(self, stage):
+        yield
+
+
+NULL_METRICS = NullMetrics()
+
+
+class JsonLinesWriter:
+    """Дописывает снимки метрик в файл JSON-строками не чаще раза в `interval` секунд."""
+
+    def __init__(self, path, interval=DEFAULT_EXPORT_INTERVAL, **fields):
+        self.path = path
+        self.interval = interval
+        self.fields = fields  # постоянные поля каждой строки, например phrase
+        self._last = 0.0
+        self._lock = threading.Lock()
+
+    def write(self, metrics, force=False):
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last < self.interval:
+                return
+            self._last = now
+            line = json.dumps({**self.fields, **metrics.snapshot()}, ensure_ascii=False)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+def write_prometheus(metrics, path, **labels):
+    """Записывает метрики в файл целиком (через временный файл, чтобы сборщик не прочитал половину)."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(metrics.to_prometheus(labels=labels))
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def profiled(path):
+    """
+    Профилирует блок: *.html — pyinstrument (если установлен), иначе cProfile
+    (файл для pstats/snakeviz). Профилируется вызывающий поток: разбор ответов,
+    запись в SQLite и колбэки; сетевые запросы идут в потоках CrawlEngine.
+    """
+    if not path:
+        yield
+        return
+    if path.endswith(".html"):
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise RuntimeError("Для профиля в HTML нужен pyinstrument: pip install pyinstrument")
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(profiler.output_html())
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
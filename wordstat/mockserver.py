@@ -0,0 +1,239 @@
+"""
+Локальная замена Wordstat API для тестов и замеров без расхода квоты.
+
+Реализует POST /v1/topRequests и POST /v1/userInfo. Граф фраз синтетический
+и детерминированный: ответ для фразы и показы каждой фразы зависят только
+от `seed`, поэтому прогоны воспроизводимы. Можно задать задержку ответа,
+долю ответов 429/503, лимит запросов в секунду и дневную квоту на токен.
+
+Запуск отдельно: python -m wordstat.mockserver --port 8080 --latency 0.05
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .ratelimit import TokenBucket
+
+SYLLABLES = ("ка", "ло", "ми", "ра", "то", "не", "су", "ве", "да", "пи", "ко", "ру", "ба", "зе", "ны", "го")
+MAX_NUM_PHRASES = 2000
+
+
+class PhraseGraph:
+    """Детерминированный граф «фраза → похожие запросы» над синтетическим словарем."""
+
+    def __init__(self, seed=0, vocab_size=500, max_words=5, permute_rate=0.02):
+        self.seed = seed
+        self.max_words = max_words
+        self.permute_rate = permute_rate
+        rng = random.Random(f"{seed}|vocab")
+        vocab = set()
+        while len(vocab) < vocab_size:
+            vocab.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+        self.vocab = sorted(vocab)
+
+    def _unit(self, phrase):
+        digest = hashlib.blake2b(f"{self.seed}|{phrase}".encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little") / 2 ** 64
+
+    def count(self, phrase):
+        """Показы фразы: тем меньше, чем длиннее фраза (одинаковые во всех ответах)."""
+        words = len(phrase.split())
+        return int(10 ** (6.5 - 1.2 * words + 2 * self._unit(phrase))) + 1
+
+    def related(self, phrase, num_phrases):
+        """Ответ topRequests: сама фраза, затем до `num_phrases` - 1 похожих по убыванию показов."""
+        rng = random.Random(f"{self.seed}|{phrase}")
+        words = phrase.split() or [rng.choice(self.vocab)]
+        found = {phrase}
+        attempts = 0
+        while len(found) < num_phrases and attempts < num_phrases * 4:
+            attempts += 1
+            candidate = list(words)
+            roll = rng.random()
+            if roll < self.permute_rate and len(candidate) > 1:
+                # Близкий дубль: те же слова в другом порядке
+                rng.shuffle(candidate)
+            elif len(candidate) < self.max_words and roll < 0.7:
+                candidate.insert(rng.randint(0, len(candidate)), rng.choice(self.vocab))
+            else:
+                candidate[rng.randrange(len(candidate))] = rng.choice(self.vocab)
+            found.add(" ".join(candidate))
+        found.discard(phrase)
+        counts = {p: self.count(p) for p in found}
+        ordered = sorted(found, key=counts.get, reverse=True)
+        items = [{"phrase": p, "count": counts[p]} for p in ordered]
+        return [{"phrase": phrase, "count": self.count(phrase)}] + items
+
+
+class MockWordstatServer:
+    """
+    HTTP-сервер с API Wordstat в отдельном потоке.
+
+    latency, jitter — задержка ответа: latency * (1 ± jitter) секунд.
+    error_429, error_503 — доля запросов, на которые отвечаем 429 (с Retry-After) или 503.
+    qps — лимит запросов в секунду на токен (превышение — 429), None — без лимита.
+    daily_limit — дневная квота на токен (исчерпана — 429), None — без квоты.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, seed=0, vocab_size=500, latency=0.0, jitter=0.0,
+                 error_429=0.0, error_503=0.0, retry_after=1, qps=None, daily_limit=None):
+        self.graph = PhraseGraph(seed, vocab_size)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_429 = error_429
+        self.error_503 = error_503
+        self.retry_after = retry_after
+        self.qps = qps
+        self.daily_limit = daily_limit
+        self.stats = {"requests": 0, "ok": 0, "429": 0, "503": 0, "401": 0, "400": 0}
+        self._rng = random.Random(f"{seed}|errors")
+        self._buckets = {}
+        self._used = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def remaining(self, token):
+        if self.daily_limit is None:
+            return 1_000_000
+        return max(0, self.daily_limit - self._used.get(token, 0))
+
+    def _admit(self, token):
+        """Проверки до ответа: (код, тело, заголовки) для ошибки или None."""
+        with self._lock:
+            self.stats["requests"] += 1
+            if not token:
+                self.stats["401"] += 1
+                return 401, {"error": "Unauthorized"}, {}
+            roll = self._rng.random()
+            if self.qps is not None:
+                bucket = self._buckets.setdefault(token, TokenBucket(self.qps))
+                if not bucket.try_acquire():
+                    self.stats["429"] += 1
+                    return 429, {"error": "Too many requests"}, {"Retry-After": str(self.retry_after)}
+            if roll < self.error_429:
+                self.stats["429"] += 1
+                return 429, {"error": "Too many requests"}, {"Retry-After": str(self.retry_after)}
+            if roll < self.error_429 + self.error_503:
+                self.stats["503"] += 1
+                return 503, {"error": "Service unavailable"}, {}
+        return None
+
+    def _charge(self, token):
+        """Списывает запрос с квоты токена. Возвращает False, если квота исчерпана."""
+        with self._lock:
+            if self.remaining(token) <= 0:
+                self.stats["429"] += 1
+                return False
+            self._used[token] = self._used.get(token, 0) + 1
+            self.stats["ok"] += 1
+            return True
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, как у настоящего API
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, code, payload, headers=None):
+                body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                token = self.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+                if server.latency:
+                    time.sleep(max(0.0, server.latency * (1 + random.uniform(-server.jitter, server.jitter))))
+
+                error = server._admit(token)
+                if error is not None:
+                    return self._send(*error)
+
+                if self.path == "/v1/userInfo":
+                    return self._send(200, {"userInfo": {
+                        "login": f"mock-{hashlib.sha1(token.encode('utf-8')).hexdigest()[:8]}",
+                        "limitPerSecond": server.qps or 10,
+                        "dailyLimit": server.daily_limit or 1_000_000,
+                        "dailyLimitRemaining": server.remaining(token),
+                    }})
+                if self.path != "/v1/topRequests":
+                    return self._send(404, {"error": "Not found"})
+                try:
+                    body = json.loads(raw or b"{}")
+                    phrase = str(body["phrase"]).strip()
+                    num_phrases = min(int(body.get("numPhrases", 50)), MAX_NUM_PHRASES)
+                except (ValueError, KeyError, TypeError):
+                    with server._lock:
+                        server.stats["400"] += 1
+                    return self._send(400, {"error": "Bad request"})
+                if not server._charge(token):
+                    return self._send(429, {"error": "Daily limit exceeded"})
+                self._send(200, {"requestPhrase": phrase, "topRequests": server.graph.related(phrase, num_phrases)})
+
+        return Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m wordstat.mockserver",
+                                     description="Локальная замена Wordstat API с синтетическими данными.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--vocab-size", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, сек")
+    parser.add_argument("--jitter", type=float, default=0.0, help="разброс задержки (доля от latency)")
+    parser.add_argument("--error-429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--error-503", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--qps", type=float, help="лимит запросов в секунду на токен")
+    parser.add_argument("--daily-limit", type=int, help="дневная квота на токен")
+    args = parser.parse_args(argv)
+    server = MockWordstatServer(args.host, args.port, seed=args.seed, vocab_size=args.vocab_size,
+                                latency=args.latency, jitter=args.jitter, error_429=args.error_429,
+                                error_503=args.error_503, qps=args.qps, daily_limit=args.daily_limit)
+    print(f"Mock Wordstat API: {server.url}", flush=True)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,15 @@
+"""
+Нормализация фраз: канонический ключ, по которому близкие дубли
+(порядок слов, регистр, «ё/е», лишние пробелы, операторы Wordstat)
+считаются одной фразой и раскрываются в API только один раз.
+"""
+import re
+
+# Операторы Wordstat, не меняющие набор слов: +слово, !слово, "фраза", [фраза], (а|б)
+OPERATORS_RE = re.compile(r'[+!"\[\]()|«»]')
+
+
+def canonical_key(phrase):
+    """Канонический ключ фразы: нижний регистр, «ё» → «е», без операторов, слова по алфавиту."""
+    text = OPERATORS_RE.sub(" ", phrase.casefold().replace("ё", "е"))
+    return " ".join(sorted(text.split()))
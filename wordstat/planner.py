@@ -0,0 +1,295 @@
+"""
+Планировщик запусков: сколько новых фраз и времени даст бюджет запросов —
+по истории БД, до того как квота потрачена, — и как разделить общий бюджет
+между исходными фразами.
+
+Модель: отдача (новых фраз на запрос) по мере обхода падает примерно
+экспоненциально. По последним HISTORY_WINDOW раскрытым фразам (queue.new_phrases
+в порядке processed_at) подбирается кривая log(1 + отдача) = a + b·k. Число
+запросов ограничено очередью: раскрытая фраза уходит из нее, новые фразы (кроме
+близких дублей) добавляются. Доля ответов из кэша и скорость берутся из истории
+запусков (runs). Без истории используется оценка по умолчанию (history = 0).
+
+    python -m wordstat.planner фраза.db другая.db --budget 1000 --concurrency 10
+    python -m wordstat.planner --jobs jobs.txt --store wordstat_store --budget 5000
+"""
+import argparse
+import json
+import math
+import os
+from dataclasses import asdict, dataclass, replace
+
+from .client import NUM_PHRASES
+from .engine import DEFAULT_CONCURRENCY, DEFAULT_QPS
+
+HISTORY_WINDOW = 500  # сколько последних раскрытых фраз учитывать в кривой отдачи
+MIN_HISTORY = 10  # меньше — кривая не подбирается
+RUNS_WINDOW = 10  # сколько последних запусков учитывать для доли кэша и скорости
+DEFAULT_START = NUM_PHRASES / 2  # отдача первого запроса без истории
+DEFAULT_DECAY = 0.01  # падение отдачи за запрос без истории (1%)
+DEFAULT_LATENCY = 1.0  # сек на ответ в одном потоке без истории
+
+# Почему прогноз заканчивается раньше бюджета
+LIMIT_BUDGET = "budget"
+LIMIT_FRONTIER = "frontier"  # очередь иссякнет
+LIMIT_MIN_YIELD = "min_yield"  # отдача упадет ниже порога (Crawler остановится сам)
+
+
+@dataclass
+class YieldCurve:
+    """Отдача k-го следующего ответа: exp(intercept + slope·(offset + k)) − 1."""
+    intercept: float
+    slope: float
+    offset: int = 0
+
+    def values(self, n):
+        import numpy as np
+        k = np.arange(int(n)) + self.offset
+        return np.maximum(np.expm1(self.intercept + self.slope * k), 0.0)
+
+
+def fit_curve(yields):
+    """Кривая отдачи по ряду new_phrases в порядке раскрытия (None, если ряд короче MIN_HISTORY)."""
+    import numpy as np
+    y = np.asarray(yields, dtype=np.float64)
+    if len(y) < MIN_HISTORY:
+        return None
+    slope, intercept = np.polyfit(np.arange(len(y)), np.log1p(y), 1)
+    if slope > 0:
+        # Отдача не падает — прогноз не рассчитывает на ее рост
+        slope, intercept = 0.0, float(np.log1p(y).mean())
+    return YieldCurve(float(intercept), float(slope), offset=len(y))
+
+
+@dataclass
+class History:
+    """Что известно о БД (или об исходной фразе в общем хранилище) для прогноза."""
+    curve: YieldCurve
+    history: int  # раскрытых фраз, по которым подобрана кривая (0 — оценка по умолчанию)
+    frontier: int  # фраз в очереди
+    duplicate_rate: float  # доля новых фраз, не попадающих в очередь (близкие дубли)
+    cache_hit_rate: float
+    latency: float  # сек на ответ в одном потоке
+
+
+def default_history():
+    """История новой исходной фразы: оценки по умолчанию, очередь пуста."""
+    return History(YieldCurve(math.log1p(DEFAULT_START), math.log1p(-DEFAULT_DECAY)), 0, 0, 0.0, 0.0,
+                   DEFAULT_LATENCY)
+
+
+def load_history(conn, seed=None):
+    """Собирает историю из queue, branch_stats и runs. seed — исходная фраза в общем хранилище."""
+    where, params = ("AND seed = ?", (seed,)) if seed else ("", ())
+    rows = conn.execute(f"""
+        SELECT new_phrases FROM queue WHERE processed_at IS NOT NULL AND new_phrases IS NOT NULL {where}
+        ORDER BY processed_at DESC LIMIT ?
+    """, (*params, HISTORY_WINDOW)).fetchall()
+    yields = [row[0] for row in reversed(rows)]
+    curve = fit_curve(yields)
+    history = len(yields) if curve is not None else 0
+    if curve is None and not seed:
+        # БД, раскрытые до появления queue.new_phrases: средняя отдача веток
+        requests, new_phrases = conn.execute(
+            "SELECT SUM(requests), SUM(new_phrases) FROM branch_stats").fetchone()
+        if requests and requests >= MIN_HISTORY:
+            curve, history = YieldCurve(math.log1p(new_phrases / requests), 0.0), requests
+    if curve is None:
+        curve = default_history().curve
+
+    frontier, duplicates, total = conn.execute(f"""
+        SELECT SUM(status IN ('PENDING', 'IN_PROGRESS')), SUM(status = 'DUPLICATE'), COUNT(*)
+        FROM queue WHERE 1 {where}
+    """, params).fetchone()
+
+    runs_query = """
+        SELECT requests, cached, finished_at - started_at, concurrency FROM runs
+        WHERE kind = 'crawl' {} ORDER BY id DESC LIMIT ?
+    """
+    runs = conn.execute(runs_query.format(where), (*params, RUNS_WINDOW)).fetchall()
+    if seed and not runs:
+        # Запусков этой фразы еще не было — кэш и задержку оценивают все запуски хранилища
+        runs = conn.execute(runs_query.format(""), (RUNS_WINDOW,)).fetchall()
+    answered = sum(r[0] + r[1] for r in runs)
+    elapsed = sum(r[2] for r in runs)
+    cache_hit_rate = sum(r[1] for r in runs) / answered if answered else 0.0
+    if answered and elapsed > 0:
+        # Сек на ответ в одном потоке: время запуска, умноженное на его параллельность
+        latency = elapsed * sorted(r[3] or 1 for r in runs)[len(runs) // 2] / answered
+    else:
+        latency = DEFAULT_LATENCY
+    return History(curve, history, frontier or 0, (duplicates or 0) / total if total else 0.0,
+                   cache_hit_rate, latency)
+
+
+@dataclass
+class Forecast:
+    """Прогноз запуска с бюджетом `budget` запросов к API."""
+    budget: int
+    quota: int  # запросов с расходом квоты
+    responses: int  # ответов всего (с кэшем) — столько фраз будет раскрыто
+    new_phrases: int
+    seconds: float
+    frontier: int  # фраз в очереди сейчас
+    yield_now: float  # ожидаемая отдача следующего ответа
+    yield_end: float  # отдача последнего ответа прогноза
+    cache_hit_rate: float
+    history: int
+    limit: str  # LIMIT_BUDGET, LIMIT_FRONTIER или LIMIT_MIN_YIELD
+
+
+def _yields(history, budget, min_yield=None):
+    """
+    Ожидаемая отдача каждого следующего ответа в пределах бюджета и причина,
+    по которой ряд заканчивается (очередь, порог отдачи или бюджет).
+    """
+    import numpy as np
+    miss_rate = max(1.0 - history.cache_hit_rate, 0.01)
+    responses = int(math.ceil(budget / miss_rate)) if budget > 0 else 0
+    y = history.curve.values(responses)
+    limit = LIMIT_BUDGET
+    # Перед k-м ответом в очереди: было + добавлено предыдущими ответами − уже раскрыто
+    frontier = max(history.frontier, 1 if not history.history else 0)
+    added = np.concatenate(([0.0], np.cumsum(y * (1.0 - history.duplicate_rate))[:-1]))
+    available = frontier + added - np.arange(responses)
+    empty = np.flatnonzero(available < 1)
+    if len(empty):
+        y, limit = y[:empty[0]], LIMIT_FRONTIER
+    if min_yield is not None:
+        low = np.flatnonzero(y < min_yield)
+        if len(low):
+            y, limit = y[:low[0]], LIMIT_MIN_YIELD
+    return y, limit
+
+
+def forecast(history, budget, concurrency=DEFAULT_CONCURRENCY, qps=DEFAULT_QPS, tokens=1, min_yield=None):
+    """Прогноз новых фраз и времени для бюджета `budget` при заданной параллельности и лимите QPS."""
+    y, limit = _yields(history, budget, min_yield)
+    responses = len(y)
+    quota = min(int(budget), int(round(responses * (1.0 - history.cache_hit_rate))))
+    # Ответы из кэша почти не занимают времени; запросы к API ограничены потоками и QPS
+    rate = min(max(1, concurrency) / history.latency, qps * max(1, tokens))
+    first = history.curve.values(1)
+    return Forecast(
+        budget=int(budget),
+        quota=quota,
+        responses=responses,
+        new_phrases=int(round(float(y.sum()))),
+        seconds=round(quota / rate, 1),
+        frontier=history.frontier,
+        yield_now=round(float(first[0]), 1),
+        yield_end=round(float(y[-1]), 1) if responses else 0.0,
+        cache_hit_rate=round(history.cache_hit_rate, 3),
+        history=history.history,
+        limit=limit,
+    )
+
+
+def forecast_db(db_path, budget, seed=None, **kwargs):
+    """forecast по файлу БД (несуществующая БД — прогноз для новой фразы без истории)."""
+    from .db import setup_db
+
+    if not os.path.exists(db_path):
+        return forecast(default_history(), budget, **kwargs)
+    conn = setup_db(db_path)
+    try:
+        return forecast(load_history(conn, seed), budget, **kwargs)
+    finally:
+        conn.close()
+
+
+def split_budget(histories, budget, min_yield=None):
+    """
+    Делит бюджет между исходными фразами так, чтобы новых фраз было больше всего:
+    запросы достаются ответам с наибольшей ожидаемой отдачей на единицу квоты
+    (кривые убывают, поэтому жадный выбор оптимален). Возвращает бюджет каждой фразы.
+    """
+    import numpy as np
+    if not histories or budget <= 0:
+        return [0] * len(histories)
+    values, costs, owners = [], [], []
+    for i, history in enumerate(histories):
+        y, _ = _yields(history, budget, min_yield)
+        cost = max(1.0 - history.cache_hit_rate, 0.01)
+        values.append(y / cost)
+        costs.append(np.full(len(y), cost))
+        owners.append(np.full(len(y), i))
+    values, costs, owners = np.concatenate(values), np.concatenate(costs), np.concatenate(owners)
+    order = np.argsort(-values, kind="stable")
+    chosen = order[np.cumsum(costs[order]) <= budget]
+    spent = np.bincount(owners[chosen], weights=costs[chosen], minlength=len(histories))
+    return [int(round(value)) for value in spent]
+
+
+def plan(targets, budget, concurrency=DEFAULT_CONCURRENCY, qps=DEFAULT_QPS, tokens=1, min_yield=None):
+    """
+    План для нескольких исходных фраз: targets — список (имя, путь БД, seed или None).
+    Возвращает список (имя, Forecast) с рекомендованным бюджетом каждой фразы.
+    """
+    from .db import setup_db
+
+    histories = []
+    for _, db_path, seed in targets:
+        if not os.path.exists(db_path):
+            histories.append(default_history())
+            continue
+        conn = setup_db(db_path)
+        try:
+            histories.append(load_history(conn, seed))
+        finally:
+            conn.close()
+    budgets = split_budget(histories, budget, min_yield)
+    rows = []
+    for (name, _, _), history, share in zip(targets, histories, budgets):
+        result = forecast(history, share, concurrency, qps, tokens, min_yield)
+        if not result.responses:
+            # Фраза не получила бюджета — причина та же, что ограничивает ее кривую на всем бюджете
+            result = replace(result, limit=_yields(history, budget, min_yield)[1])
+        rows.append((name, result))
+    return rows
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m wordstat.planner",
+                                     description="Прогноз отдачи и времени запуска и распределение бюджета "
+                                                 "запросов между исходными фразами.")
+    parser.add_argument("dbs", nargs="*", help="БД исходных фраз")
+    parser.add_argument("--budget", type=int, required=True, help="общий бюджет запросов к API")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--qps", type=float, default=DEFAULT_QPS, help="лимит запросов в секунду на токен")
+    parser.add_argument("--tokens", type=int, default=1, help="число токенов")
+    parser.add_argument("--min-yield", type=float,
+                        help="порог отдачи (новых фраз на запрос), на котором парсинг остановится")
+    parser.add_argument("--jobs", help="файл заданий пакетного режима («фраза<TAB>регионы»)")
+    parser.add_argument("--store", default="wordstat_store", help="каталог общего хранилища для --jobs")
+    parser.add_argument("--json", action="store_true", help="вывести JSON-строку на каждую фразу")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    targets = [(path, path, None) for path in args.dbs]
+    if args.jobs:
+        from .batch import load_jobs, store_path
+        targets += [(job.seed, store_path(args.store, job.regions), job.seed) for job in load_jobs(args.jobs)]
+    if not targets:
+        parser.error("укажите БД или файл заданий --jobs")
+
+    rows = plan(targets, args.budget, args.concurrency, args.qps, args.tokens, args.min_yield)
+    if args.json:
+        for name, result in rows:
+            print(json.dumps({"target": name, **asdict(result)}, ensure_ascii=False))
+        return 0
+    print("Бюджет\tКвота\tНовых фраз\tСек\tОчередь\tОтдача сейчас→в конце\tКэш\tИстория\tПредел\tФраза")
+    for name, f in rows:
+        print(f"{f.budget}\t{f.quota}\t{f.new_phrases}\t{f.seconds}\t{f.frontier}\t{f.yield_now}→{f.yield_end}\t"
+              f"{f.cache_hit_rate:.0%}\t{f.history}\t{f.limit}\t{name}")
+    total = sum(f.new_phrases for _, f in rows)
+    print(f"Итого: бюджет {sum(f.budget for _, f in rows)} из {args.budget}, новых фраз ~{total}, "
+          f"время ~{max((f.seconds for _, f in rows), default=0):.0f}–{sum(f.seconds for _, f in rows):.0f} сек")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,62 @@
+"""
+Политики порядка обхода очереди.
+
+Политика задает приоритет новой фразы при записи в queue (столбцы priority
+и depth сохраняются в БД, поэтому возобновленный парсинг идет в том же
+порядке) и ORDER BY, по которому frontier выбирает следующие фразы.
+"""
+
+
+class FifoPolicy:
+    """Фразы обрабатываются в порядке обнаружения."""
+    name = "fifo"
+    label = "В порядке обнаружения"
+    order_by = "rowid"
+
+    def priority(self, count, depth, parent_yield):
+        return 0
+
+
+class CountPolicy:
+    """Сначала фразы с наибольшим числом показов."""
+    name = "count"
+    label = "Сначала самые частотные"
+    order_by = "priority DESC, rowid"
+
+    def priority(self, count, depth, parent_yield):
+        return count or 0
+
+
+class BreadthFirstPolicy:
+    """Уровень за уровнем; внутри уровня — по числу показов."""
+    name = "bfs"
+    label = "По уровням (в ширину)"
+    order_by = "depth, priority DESC, rowid"
+
+    def priority(self, count, depth, parent_yield):
+        return count or 0
+
+
+class YieldPolicy:
+    """
+    Сначала дочерние фразы тех запросов, которые принесли больше всего
+    новых фраз (marginal yield). При равенстве — по числу показов.
+    """
+    name = "yield"
+    label = "По отдаче родительского запроса"
+    order_by = "priority DESC, rowid"
+
+    def priority(self, count, depth, parent_yield):
+        # Показы — только для разрешения ничьих: их вклад всегда меньше 1
+        return parent_yield + min(count or 0, 10 ** 9) / 10 ** 10
+
+
+POLICIES = {policy.name: policy for policy in (FifoPolicy(), CountPolicy(), BreadthFirstPolicy(), YieldPolicy())}
+
+
+def get_policy(name):
+    """Возвращает политику по имени (fifo, count, bfs, yield)."""
+    try:
+        return POLICIES[name]
+    except KeyError:
+        raise ValueError(f"Неизвестная политика обхода: {name}. Доступны: {', '.join(POLICIES)}")
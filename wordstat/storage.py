@@ -0,0 +1,515 @@
+"""
+Хранилища набора фраз (phrase, count) для аналитики по многим исходным фразам.
+
+Парсинг всегда пишет в SQLite (очередь, аренды и история требуют транзакций),
+а для сводной аналитики БД отдельных фраз сливаются в одно хранилище без
+повторов — SQLite (схема db.setup_db) или колоночное: каталог Parquet,
+разбитый на партиции по хэшу фразы (его можно читать и из DuckDB:
+SELECT ... FROM 'каталог/*/*.parquet'). Оба хранилища дают одинаковый интерфейс:
+write, iter_chunks, count, top, count_distribution, term_frequency.
+
+Показы зависят от регионов, поэтому в одно хранилище сливаются только БД
+с одинаковым набором регионов (db.REGIONS_KEY в meta или имя regions_<ключ>.db).
+
+    python -m wordstat.storage merge wordstat_store/ *.db -o all.parquet
+    python -m wordstat.storage top all.parquet -n 50 --contains купить
+    python -m wordstat.storage terms all.parquet -n 100
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import zlib
+
+from .db import REGIONS_KEY, add_missing_columns, get_meta, setup_db
+from .export import CHUNK_SIZE, db_version
+
+PARTITIONS = 16  # число файлов Parquet: партиции читаются параллельно
+STORE_KINDS = ("sqlite", "parquet")
+SOURCE_COLUMNS = ("path", "version", "rows", "merged_at", "last_rowid", "last_phrase")
+PARQUET_META_KEY = b"wordstat"  # метаданные схемы Parquet: регионы и слитые БД (JSON)
+REGIONS_FILE_RE = re.compile(r"^regions_(all|\d+(?:_\d+)*)\.db$")
+
+
+def _digits_bucket(digits):
+    """Диапазон показов для числа цифр: 3 -> '100–999'."""
+    return f"{10 ** (digits - 1) if digits > 1 else 0}–{10 ** digits - 1}"
+
+
+def source_regions(db_path):
+    """
+    Ключ регионов БД фраз (db.region_key): из meta, а для БД, собранных до его
+    появления, — из имени файла общего хранилища regions_<ключ>.db. None — неизвестен.
+    """
+    regions = None
+    if os.path.exists(db_path):
+        conn = sqlite3.connect(db_path)
+        try:
+            regions = get_meta(conn, REGIONS_KEY)
+        finally:
+            conn.close()
+    if regions is None:
+        match = REGIONS_FILE_RE.match(os.path.basename(db_path))
+        regions = match.group(1) if match else None
+    return regions
+
+
+def check_regions(sources, store_regions=None):
+    """
+    Проверяет, что все БД `sources` и хранилище собраны по одному набору регионов
+    (неизвестные регионы не проверяются). Иначе — ValueError: показы разных регионов
+    под одной фразой смешались бы.
+    """
+    keys = {path: source_regions(path) for path in sources}
+    if store_regions:
+        keys["хранилище"] = store_regions
+    if len(set(filter(None, keys.values()))) > 1:
+        listing = ", ".join(f"{path} — {key}" for path, key in keys.items() if key)
+        raise ValueError(f"БД собраны по разным регионам ({listing}). Сливайте их в отдельные хранилища.")
+
+
+class SQLiteStore:
+    """
+    Набор фраз в БД SQLite (таблица results). seeds — в скольких исходных БД
+    встретилась фраза; показы берутся из самого свежего наблюдения (updated_at).
+    Слитые БД записываются в таблицу sources с версией файла и последним слитым
+    rowid: неизменившаяся БД повторно не сливается, а дополненная или обновленная —
+    сливается заново без повторного счета уже слитых фраз в seeds.
+    Регионы хранилища (meta) задает первая БД с известными регионами.
+    """
+    kind = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = setup_db(path)
+        add_missing_columns(self.conn, "results", {"seeds": "INTEGER DEFAULT 1"})
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS sources (
+                path TEXT PRIMARY KEY,
+                version TEXT,
+                rows INTEGER,
+                merged_at REAL
+            )
+        """)
+        # last_rowid/last_phrase — последняя слитая строка results источника
+        add_missing_columns(self.conn, "sources", {"last_rowid": "INTEGER", "last_phrase": "TEXT"})
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Свежие показы побеждают, счетчик исходных БД суммируется
+    UPSERT = """
+        ON CONFLICT(phrase) DO UPDATE SET
+            count = CASE WHEN COALESCE(excluded.updated_at, 0) >= COALESCE(results.updated_at, 0)
+                         THEN excluded.count ELSE results.count END,
+            updated_at = MAX(COALESCE(excluded.updated_at, 0), COALESCE(results.updated_at, 0)),
+            seeds = results.seeds + excluded.seeds
+    """
+    # Фразы, уже слитые из той же БД раньше: только свежие показы, seeds не меняется
+    UPSERT_COUNT = """
+        ON CONFLICT(phrase) DO UPDATE SET
+            count = CASE WHEN COALESCE(excluded.updated_at, 0) >= COALESCE(results.updated_at, 0)
+                         THEN excluded.count ELSE results.count END,
+            updated_at = MAX(COALESCE(excluded.updated_at, 0), COALESCE(results.updated_at, 0))
+    """
+
+    def regions(self):
+        """Ключ регионов хранилища или None, если еще не задан."""
+        return get_meta(self.conn, REGIONS_KEY)
+
+    def state(self):
+        """Регионы и слитые БД — для хранилищ, которые пересобираются целиком (Parquet)."""
+        sources = self.conn.execute(f"SELECT {', '.join(SOURCE_COLUMNS)} FROM sources").fetchall()
+        return {"regions": self.regions(), "sources": [dict(zip(SOURCE_COLUMNS, row)) for row in sources]}
+
+    def load_state(self, state):
+        """Восстанавливает регионы и список слитых БД, сохраненные state()."""
+        with self.conn:
+            if state.get("regions"):
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                  (REGIONS_KEY, state["regions"]))
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO sources ({', '.join(SOURCE_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(SOURCE_COLUMNS))})",
+                [tuple(source.get(column) for column in SOURCE_COLUMNS) for source in state.get("sources", [])])
+
+    def write(self, rows):
+        """Дописывает строки (phrase, count, seeds, updated_at) со слиянием повторов."""
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT INTO results (phrase, count, seeds, updated_at) VALUES (?, ?, ?, ?) {self.UPSERT}", rows)
+
+    def _merged_rowid(self, previous):
+        """
+        До какого rowid results источника (ATTACH src) фразы уже слиты: 0 — БД сливается
+        впервые. Если rowid изменились (VACUUM) или БД слита до появления отметки,
+        уже слитые фразы не отличить — тогда ни одна из них seeds повторно не увеличит.
+        """
+        if previous is None:
+            return 0
+        _, last_rowid, last_phrase = previous
+        if last_rowid is not None:
+            row = self.conn.execute("SELECT phrase FROM src.results WHERE rowid = ?", (last_rowid,)).fetchone()
+            if row is not None and row[0] == last_phrase:
+                return last_rowid
+        return self.conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM src.results").fetchone()[0]
+
+    def merge_db(self, db_path):
+        """
+        Сливает results другой БД средствами SQLite (ATTACH, без чтения строк в Python).
+        Возвращает число строк в ней или None, если БД не изменилась с прошлого слияния.
+        Изменившаяся БД сливается заново: показы обновляются, а seeds растет только
+        у фраз, добавленных в нее после прошлого слияния. БД с другими регионами,
+        чем у хранилища, не сливается (ValueError).
+        """
+        source = os.path.abspath(db_path)
+        version = db_version(source)
+        previous = self.conn.execute("SELECT version, last_rowid, last_phrase FROM sources WHERE path = ?",
+                                     (source,)).fetchone()
+        if previous is not None and previous[0] == version:
+            return None
+        regions = source_regions(source)
+        check_regions([source], self.regions())
+        self.conn.execute("ATTACH DATABASE ? AS src", (source,))
+        try:
+            columns = {row[1] for row in self.conn.execute("PRAGMA src.table_info(results)")}
+            updated_at = "updated_at" if "updated_at" in columns else "NULL"
+            seeds = "seeds" if "seeds" in columns else "1"
+            merged_rowid = self._merged_rowid(previous)
+            with self.conn:
+                rows, last_rowid = self.conn.execute("SELECT COUNT(*), MAX(rowid) FROM src.results").fetchone()
+                last_phrase = self.conn.execute("SELECT phrase FROM src.results WHERE rowid = ?",
+                                                (last_rowid,)).fetchone()
+                for where, upsert in (("rowid <= ?", self.UPSERT_COUNT), ("rowid > ?", self.UPSERT)):
+                    self.conn.execute(f"""
+                        INSERT INTO results (phrase, count, updated_at, seeds)
+                        SELECT phrase, count, {updated_at}, {seeds} FROM src.results WHERE {where} {upsert}
+                    """, (merged_rowid,))
+                if regions and not self.regions():
+                    self.conn.execute("INSERT INTO meta (key, value) VALUES (?, ?)", (REGIONS_KEY, regions))
+                self.conn.execute(
+                    f"INSERT OR REPLACE INTO sources ({', '.join(SOURCE_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(SOURCE_COLUMNS))})",
+                    (source, version, rows, time.time(), last_rowid, last_phrase[0] if last_phrase else None))
+        finally:
+            self.conn.execute("DETACH DATABASE src")
+        return rows
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        """Строки (phrase, count, seeds, updated_at) порциями по chunk_size."""
+        cursor = self.conn.execute("SELECT phrase, count, seeds, updated_at FROM results")
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def top(self, n=100, contains=None):
+        """n самых частотных фраз: (phrase, count, seeds); contains — подстрока."""
+        where, params = ("WHERE instr(phrase, ?) > 0", [contains.lower()]) if contains else ("", [])
+        return self.conn.execute(
+            f"SELECT phrase, count, seeds FROM results {where} ORDER BY count DESC, phrase LIMIT ?",
+            (*params, int(n))).fetchall()
+
+    def count_distribution(self):
+        """Распределение показов по порядкам величины: (диапазон, фраз, сумма показов)."""
+        rows = self.conn.execute("""
+            SELECT length(CAST(MAX(count, 0) AS TEXT)) AS digits, COUNT(*), SUM(count)
+            FROM results GROUP BY digits ORDER BY digits
+        """).fetchall()
+        return [(_digits_bucket(digits), phrases, total) for digits, phrases, total in rows]
+
+    def term_frequency(self, n=100):
+        """n самых частых слов: (слово, фраз со словом, сумма их показов)."""
+        # Фраза разбивается по пробелам в JSON-массив (json_quote экранирует кавычки и обратную косую черту),
+        # слово, повторенное во фразе, считается один раз — как в ParquetStore.term_frequency
+        return self.conn.execute("""
+            SELECT word, COUNT(*) AS phrases, SUM(count) FROM (
+                SELECT DISTINCT results.rowid, COALESCE(results.count, 0) AS count, words.value AS word
+                FROM results, json_each('[' || replace(json_quote(phrase), ' ', '","') || ']') AS words
+                WHERE words.value != ''
+            ) GROUP BY word ORDER BY phrases DESC, word LIMIT ?
+        """, (int(n),)).fetchall()
+
+
+class ParquetStore:
+    """
+    Набор фраз в каталоге Parquet: part=NN/data.parquet, фраза попадает в партицию
+    по crc32. Запросы выполняются векторно средствами pyarrow и читают только
+    нужные столбцы. Каталог перезаписывается целиком (write_from); регионы
+    и список слитых БД хранятся в метаданных схемы (state).
+    """
+    kind = "parquet"
+
+    def __init__(self, path):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError("Для хранилища Parquet установите pyarrow: pip install pyarrow")
+        self.path = path
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def schema():
+        import pyarrow as pa
+        return pa.schema([("phrase", pa.string()), ("count", pa.int64()), ("seeds", pa.int32()),
+                          ("updated_at", pa.float64())])
+
+    def _files(self):
+        return sorted(glob.glob(os.path.join(glob.escape(self.path), "part=*", "*.parquet")))
+
+    def exists(self):
+        return bool(self._files())
+
+    def state(self):
+        """Регионы и слитые БД (см. SQLiteStore.state) из метаданных схемы; {} — нет данных."""
+        import pyarrow.parquet as pq
+        files = self._files()
+        if not files:
+            return {}
+        metadata = pq.read_schema(files[0]).metadata or {}
+        return json.loads(metadata[PARQUET_META_KEY]) if PARQUET_META_KEY in metadata else {}
+
+    def write_from(self, chunks, state=None):
+        """
+        Записывает каталог заново из порций строк (phrase, count, seeds, updated_at)
+        без повторов фраз, state — в метаданные схемы. Пишется во временный каталог,
+        затем подменяет старый.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = self.schema()
+        if state is not None:
+            schema = schema.with_metadata({PARQUET_META_KEY: json.dumps(state, ensure_ascii=False)})
+        tmp_path = tempfile.mkdtemp(prefix=".tmp-", dir=os.path.dirname(os.path.abspath(self.path)))
+        writers = {}
+        try:
+            for rows in chunks:
+                parts = [[] for _ in range(PARTITIONS)]
+                for row in rows:
+                    parts[zlib.crc32(row[0].encode("utf-8")) % PARTITIONS].append(row)
+                for part, part_rows in enumerate(parts):
+                    if not part_rows:
+                        continue
+                    writer = writers.get(part)
+                    if writer is None:
+                        os.makedirs(os.path.join(tmp_path, f"part={part:02d}"))
+                        writer = writers[part] = pq.ParquetWriter(
+                            os.path.join(tmp_path, f"part={part:02d}", "data.parquet"), schema)
+                    writer.write_table(pa.Table.from_pylist(
+                        [dict(zip(schema.names, row)) for row in part_rows], schema=schema))
+            for writer in writers.values():
+                writer.close()
+            writers.clear()
+            if os.path.exists(self.path):
+                shutil.rmtree(self.path)
+            os.replace(tmp_path, self.path)
+        finally:
+            for writer in writers.values():
+                writer.close()
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def _table(self, columns):
+        import pyarrow.parquet as pq
+        if not self.exists():
+            return self.schema().empty_table().select(columns)
+        return pq.read_table(self.path, columns=columns)
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        table = self._table(["phrase", "count", "seeds", "updated_at"])
+        for batch in table.to_batches(max_chunksize=chunk_size):
+            yield list(zip(*(column.to_pylist() for column in batch.columns)))
+
+    def count(self):
+        import pyarrow.parquet as pq
+        if not self.exists():
+            return 0
+        return sum(pq.ParquetFile(path).metadata.num_rows for path in self._files())
+
+    def top(self, n=100, contains=None):
+        import pyarrow.compute as pc
+        table = self._table(["phrase", "count", "seeds"])
+        if contains:
+            table = table.filter(pc.match_substring(table["phrase"], contains.lower()))
+        indices = pc.select_k_unstable(table, k=min(int(n), table.num_rows),
+                                       sort_keys=[("count", "descending"), ("phrase", "ascending")])
+        top = table.take(indices).sort_by([("count", "descending"), ("phrase", "ascending")])
+        return list(zip(*(top[name].to_pylist() for name in ("phrase", "count", "seeds"))))
+
+    def count_distribution(self):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        table = self._table(["count"])
+        counts = pc.max_element_wise(pc.fill_null(table["count"], 0), 0)
+        digits = pc.utf8_length(pc.cast(counts, pa.string()))
+        grouped = pa.table({"digits": digits, "count": counts}).group_by("digits").aggregate(
+            [("count", "count"), ("count", "sum")]).sort_by("digits")
+        return [(_digits_bucket(d), phrases, total) for d, phrases, total in
+                zip(*(grouped[name].to_pylist() for name in ("digits", "count_count", "count_sum")))]
+
+    def term_frequency(self, n=100):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        table = self._table(["phrase", "count"])
+        words = pc.utf8_split_whitespace(table["phrase"])
+        rows = pc.list_parent_indices(words)
+        pairs = pa.table({"row": rows, "word": pc.list_flatten(words)})
+        # Слово, повторенное во фразе, считается один раз
+        pairs = pairs.group_by(["row", "word"]).aggregate([])
+        pairs = pairs.append_column("count", pc.take(pc.fill_null(table["count"], 0), pairs["row"]))
+        grouped = pairs.group_by("word").aggregate([("row", "count"), ("count", "sum")])
+        indices = pc.select_k_unstable(grouped, k=min(int(n), grouped.num_rows),
+                                       sort_keys=[("row_count", "descending"), ("word", "ascending")])
+        top = grouped.take(indices).sort_by([("row_count", "descending"), ("word", "ascending")])
+        return list(zip(*(top[name].to_pylist() for name in ("word", "row_count", "count_sum"))))
+
+
+STORES = {store.kind: store for store in (SQLiteStore, ParquetStore)}
+
+
+def store_kind(path):
+    """parquet — для каталога или пути *.parquet, иначе sqlite."""
+    return "parquet" if os.path.isdir(path) or path.endswith(".parquet") else "sqlite"
+
+
+def open_store(path, kind=None):
+    return STORES[kind or store_kind(path)](path)
+
+
+def find_sources(paths):
+    """Файлы БД из списка путей: файлы, каталоги (все *.db внутри) и шаблоны glob."""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found += sorted(glob.glob(os.path.join(glob.escape(path), "**", "*.db"), recursive=True))
+        elif any(char in path for char in "*?["):
+            found += sorted(glob.glob(path, recursive=True))
+        else:
+            found.append(path)
+    return list(dict.fromkeys(found))
+
+
+def merge(sources, out_path, kind=None, on_source=None):
+    """
+    Сливает results БД `sources` в хранилище `out_path` без повторов фраз.
+    SQLite дополняется (не изменившиеся с прошлого слияния БД пропускаются); Parquet
+    пересобирается через временную БД SQLite вместе с прежним содержимым каталога.
+    on_source(path, rows) вызывается после каждой БД (rows=None — не изменилась).
+    Если БД собраны по разным регионам, ничего не сливается (ValueError).
+    Возвращает число фраз в хранилище.
+    """
+    kind = kind or store_kind(out_path)
+    # Само хранилище (если оно в каталоге источников) не сливается с собой
+    sources = [path for path in sources if os.path.abspath(path) != os.path.abspath(out_path)]
+    if kind == "sqlite":
+        with SQLiteStore(out_path) as store:
+            check_regions(sources, store.regions())
+            for path in sources:
+                rows = store.merge_db(path)
+                if on_source is not None:
+                    on_source(path, rows)
+            return store.count()
+
+    target = ParquetStore(out_path)
+    state = target.state()
+    check_regions(sources, state.get("regions"))
+    staging_dir = tempfile.mkdtemp(prefix="wordstat-merge-")
+    try:
+        with SQLiteStore(os.path.join(staging_dir, "staging.db")) as staging:
+            staging.load_state(state)
+            if target.exists():
+                for rows in target.iter_chunks():
+                    staging.write(rows)
+            merged = False
+            for path in sources:
+                rows = staging.merge_db(path)
+                merged = merged or rows is not None
+                if on_source is not None:
+                    on_source(path, rows)
+            if merged or not target.exists():
+                target.write_from(staging.iter_chunks(), staging.state())
+        return target.count()
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m wordstat.storage",
+                                     description="Слияние БД фраз и сводная аналитика (SQLite или Parquet).")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    merge_cmd = commands.add_parser("merge", help="слить БД фраз в одно хранилище без повторов")
+    merge_cmd.add_argument("sources", nargs="+", help="файлы БД, каталоги или шаблоны (*.db)")
+    merge_cmd.add_argument("-o", "--output", required=True,
+                           help="хранилище: файл SQLite или каталог Parquet (*.parquet или существующий каталог)")
+    merge_cmd.add_argument("--format", choices=STORE_KINDS, help="тип хранилища (по умолчанию — по пути)")
+
+    for name, help_text in (("top", "самые частотные фразы"), ("dist", "распределение показов"),
+                            ("terms", "самые частые слова")):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument("store", help="файл SQLite или каталог Parquet")
+        command.add_argument("--format", choices=STORE_KINDS)
+        if name != "dist":
+            command.add_argument("-n", type=int, default=100)
+        if name == "top":
+            command.add_argument("--contains", help="только фразы с подстрокой")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    started = time.perf_counter()
+    if args.command == "merge":
+        sources = find_sources(args.sources)
+
+        def on_source(path, rows):
+            print(f"{path}: {'не изменилась с прошлого слияния' if rows is None else f'{rows} фраз'}", flush=True)
+
+        try:
+            total = merge(sources, args.output, args.format, on_source)
+        except ValueError as e:
+            print(f"Ошибка: {e}", file=sys.stderr)
+            return 2
+        print(json.dumps({"store": args.output, "sources": len(sources), "phrases": total,
+                          "elapsed": round(time.perf_counter() - started, 3)}, ensure_ascii=False))
+        return 0
+
+    with open_store(args.store, args.format) as store:
+        if args.command == "top":
+            rows = store.top(args.n, args.contains)
+        elif args.command == "dist":
+            rows = store.count_distribution()
+        else:
+            rows = store.term_frequency(args.n)
+    for row in rows:
+        print("\t".join(str(value) for value in row))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
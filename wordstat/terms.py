@@ -0,0 +1,453 @@
+"""
+Семантическое ядро: леммы фраз, инвертированный индекс «лемма → фразы» в БД,
+частоты n-грамм с весом по показам и кластеризация фраз по общим леммам.
+
+Индекс (таблицы terms, word_terms, term_phrases) обновляется инкрементально —
+только по фразам, добавленным после прошлого обновления (Crawler делает это
+в конце каждого запуска). Лемматизируется словарь, а не фразы:
+каждое новое слово один раз, дальше — поиск в word_terms. Частоты и кластеры
+считаются векторно в NumPy по разреженной матрице «фраза × лемма» (CSR),
+загруженной из индекса.
+
+    python -m wordstat.terms фраза.db ngrams -n 2 --top 30
+    python -m wordstat.terms фраза.db clusters --csv clusters.csv
+    python -m wordstat.terms фраза.db search "купить недорого"
+"""
+import argparse
+import csv
+import importlib
+import re
+import sys
+import time
+
+from .normalize import OPERATORS_RE
+
+TOKEN_RE = re.compile(r"\w+")
+CYRILLIC_RE = re.compile(r"[а-я]+")
+# Служебные слова не индексируются: они связывают почти все фразы между собой
+STOP_WORDS = frozenset(
+    "а без в во для до если же за и из или к ко как ли на над не ни но о об обо от по под при про "
+    "с со то у что чтобы".split())
+# Окончания для отсечения, если pymorphy не установлен (длинные проверяются первыми)
+ENDINGS = tuple(sorted((
+    "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "ией", "ость", "ости", "ешь", "ишь",
+    "ий", "ый", "ой", "ая", "яя", "ое", "ее", "ые", "ие", "ых", "их", "ую", "юю", "ом", "ем", "ам", "ям",
+    "ах", "ях", "ов", "ев", "ей", "ию", "ия", "ья", "ье", "ьи", "ть", "ти", "ет", "ут", "ют", "ит", "ат", "ят",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+), key=len, reverse=True))
+CHUNK_SIZE = 20000
+MAX_DF = 0.3  # лемма из большей доли фраз (обычно слова исходной фразы) кластер не задает
+MIN_CLUSTER_SIZE = 3
+MAX_NGRAM = 3
+
+
+def tokenize(phrase):
+    """Слова фразы: нижний регистр, «ё» → «е», без операторов Wordstat и служебных слов."""
+    text = OPERATORS_RE.sub(" ", phrase.casefold().replace("ё", "е"))
+    return [word for word in TOKEN_RE.findall(text) if word not in STOP_WORDS]
+
+
+def stem(word):
+    """Грубая основа русского слова: отсекает самое длинное окончание, оставляя не меньше 3 букв."""
+    if len(word) < 4 or not CYRILLIC_RE.fullmatch(word):
+        return word
+    for ending in ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+class Lemmatizer:
+    """
+    Лемма слова: нормальная форма pymorphy3 (или pymorphy2), если он установлен,
+    иначе основа stem(). kind — "pymorphy", "stem" или None (лучший доступный).
+    """
+
+    def __init__(self, kind=None):
+        self.morph = None
+        if kind in (None, "pymorphy"):
+            for module in ("pymorphy3", "pymorphy2"):
+                try:
+                    self.morph = importlib.import_module(module).MorphAnalyzer()
+                    break
+                except ImportError:
+                    continue
+            if self.morph is None and kind == "pymorphy":
+                raise ImportError("Для лемматизации установите pymorphy3: pip install pymorphy3")
+        self.kind = "pymorphy" if self.morph is not None else "stem"
+
+    def __call__(self, word):
+        if self.morph is None:
+            return stem(word)
+        return self.morph.parse(word)[0].normal_form.replace("ё", "е")
+
+
+def setup_terms(conn):
+    """
+    Таблицы индекса: леммы, слово → лемма, лемма → фразы (rowid фразы в results
+    и позиция слова) и состояние обновления.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS terms (
+            id INTEGER PRIMARY KEY,
+            term TEXT UNIQUE NOT NULL,
+            label TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS word_terms (
+            word TEXT PRIMARY KEY,
+            term_id INTEGER
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS term_phrases (
+            term_id INTEGER,
+            phrase_id INTEGER,
+            pos INTEGER,
+            PRIMARY KEY (term_id, phrase_id, pos)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE TABLE IF NOT EXISTS terms_state (key TEXT PRIMARY KEY, value TEXT)")
+    conn.commit()
+
+
+def _has_index(conn):
+    """Таблицы индекса уже созданы (проверка без записи в БД)."""
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'terms_state'").fetchone() \
+        is not None
+
+
+def _state(conn):
+    return dict(conn.execute("SELECT key, value FROM terms_state").fetchall())
+
+
+def _index_valid(conn, state):
+    """Индекс соответствует results: последняя проиндексированная фраза на месте (rowid не менялись после VACUUM)."""
+    if "last_rowid" not in state:
+        return False
+    row = conn.execute("SELECT phrase FROM results WHERE rowid = ?", (int(state["last_rowid"]),)).fetchone()
+    return row is not None and row[0] == state.get("last_phrase")
+
+
+def index_status(conn):
+    """
+    Только чтение: (проиндексировано фраз, ждут индексации). Если индекс устарел
+    после VACUUM, все фразы считаются ждущими — refresh_index построит его заново.
+    """
+    total = conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+    state = _state(conn) if _has_index(conn) else {}
+    if not _index_valid(conn, state):
+        return 0, total
+    pending = conn.execute("SELECT COUNT(*) FROM results WHERE rowid > ?", (int(state["last_rowid"]),)).fetchone()[0]
+    return total - pending, pending
+
+
+def refresh_index(conn, lemmatizer=None, full=False):
+    """
+    Дополняет индекс фразами, добавленными в results после прошлого обновления
+    (новые фразы получают возрастающие rowid). Индекс строится заново при full=True,
+    смене лемматизатора или если rowid фраз изменились (VACUUM).
+    Пишет порциями по CHUNK_SIZE фраз, не задерживая парсинг в других процессах.
+    Возвращает число проиндексированных фраз.
+    """
+    setup_terms(conn)
+    lemmatizer = lemmatizer or Lemmatizer()
+    state = _state(conn)
+    if state and (full or state.get("lemmatizer") != lemmatizer.kind or not _index_valid(conn, state)):
+        with conn:
+            for table in ("terms", "word_terms", "term_phrases", "terms_state"):
+                conn.execute(f"DELETE FROM {table}")
+        state = {}
+
+    word_terms = dict(conn.execute("SELECT word, term_id FROM word_terms").fetchall())
+    lemma_terms = dict(conn.execute("SELECT term, id FROM terms").fetchall())
+    last_rowid, last_phrase = int(state.get("last_rowid", 0)), state.get("last_phrase")
+    total = 0
+    while True:
+        rows = conn.execute("SELECT rowid, phrase FROM results WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                            (last_rowid, CHUNK_SIZE)).fetchall()
+        if not rows:
+            break
+        postings, new_words = [], []
+        with conn:
+            for phrase_id, phrase in rows:
+                for pos, word in enumerate(tokenize(phrase)):
+                    term_id = word_terms.get(word)
+                    if term_id is None:
+                        lemma = lemmatizer(word)
+                        term_id = lemma_terms.get(lemma)
+                        if term_id is None:
+                            # Лемму мог добавить и другой процесс, обновляющий индекс той же БД
+                            conn.execute("INSERT OR IGNORE INTO terms (term, label) VALUES (?, ?)", (lemma, word))
+                            term_id = lemma_terms[lemma] = conn.execute(
+                                "SELECT id FROM terms WHERE term = ?", (lemma,)).fetchone()[0]
+                        word_terms[word] = term_id
+                        new_words.append((word, term_id))
+                    postings.append((term_id, phrase_id, pos))
+            conn.executemany("INSERT OR IGNORE INTO word_terms (word, term_id) VALUES (?, ?)", new_words)
+            conn.executemany("INSERT OR IGNORE INTO term_phrases (term_id, phrase_id, pos) VALUES (?, ?, ?)",
+                             postings)
+            last_rowid, last_phrase = rows[-1]
+            conn.executemany("INSERT OR REPLACE INTO terms_state (key, value) VALUES (?, ?)",
+                             [("lemmatizer", lemmatizer.kind), ("last_rowid", str(last_rowid)),
+                              ("last_phrase", last_phrase), ("refreshed_at", repr(time.time()))])
+        total += len(rows)
+    return total
+
+
+def search_phrases(conn, query, limit=100, lemmatizer=None):
+    """Фразы, содержащие все слова `query` в любой форме (по индексу), — самые частотные первыми."""
+    setup_terms(conn)
+    lemmatizer = lemmatizer or Lemmatizer(_state(conn).get("lemmatizer"))
+    term_ids = []
+    for word in tokenize(query):
+        row = conn.execute("SELECT id FROM terms WHERE term = ?", (lemmatizer(word),)).fetchone()
+        if row is None:
+            return []
+        term_ids.append(row[0])
+    if not term_ids:
+        return []
+    subquery = " INTERSECT ".join(["SELECT phrase_id FROM term_phrases WHERE term_id = ?"] * len(term_ids))
+    return conn.execute(f"""
+        SELECT phrase, count FROM results WHERE rowid IN ({subquery})
+        ORDER BY count DESC, phrase LIMIT ?
+    """, (*term_ids, int(limit))).fetchall()
+
+
+class TermIndex:
+    """
+    Индекс в памяти: фразы results и их леммы в виде CSR-матрицы «фраза × лемма»
+    (indptr, terms — id лемм фраз подряд в порядке слов). Все расчеты — NumPy.
+    """
+
+    def __init__(self, phrases, counts, indptr, terms, labels):
+        self.phrases = phrases  # np.ndarray[object]
+        self.counts = counts  # np.ndarray[int64]
+        self.indptr = indptr  # границы лемм фразы i: terms[indptr[i]:indptr[i + 1]]
+        self.terms = terms
+        self.labels = labels  # подпись леммы по id: первая встреченная форма слова
+        import numpy as np
+        self.rows = np.repeat(np.arange(len(phrases)), np.diff(indptr))  # номер фразы для каждого элемента terms
+
+    @classmethod
+    def load(cls, conn, min_count=None):
+        """
+        Загружает индекс из БД (фразы с показами не меньше min_count). Только чтение:
+        фразы, еще не попавшие в индекс (см. index_status), остаются без слов.
+        """
+        import numpy as np
+
+        where, params = ("WHERE count >= ?", (int(min_count),)) if min_count else ("", ())
+        results = conn.execute(f"SELECT rowid, phrase, count FROM results {where} ORDER BY rowid", params).fetchall()
+        phrase_ids = np.fromiter((row[0] for row in results), dtype=np.int64, count=len(results))
+        phrases = np.array([row[1] for row in results], dtype=object)
+        counts = np.fromiter((row[2] or 0 for row in results), dtype=np.int64, count=len(results))
+        indexed = _has_index(conn)
+        postings = np.array(conn.execute("SELECT phrase_id, pos, term_id FROM term_phrases").fetchall()
+                            if indexed else [], dtype=np.int64).reshape(-1, 3)
+        # rowid → номер фразы; постинги фраз, отсеянных min_count, отбрасываются
+        rows = np.searchsorted(phrase_ids, postings[:, 0])
+        keep = rows < len(phrase_ids)
+        keep[keep] = phrase_ids[rows[keep]] == postings[keep, 0]
+        rows, positions, term_ids = rows[keep], postings[keep, 1], postings[keep, 2]
+        order = np.lexsort((positions, rows))
+        rows, term_ids = rows[order], term_ids[order]
+        indptr = np.zeros(len(phrases) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(phrases)), out=indptr[1:])
+
+        label_rows = conn.execute("SELECT id, label FROM terms").fetchall() if indexed else []
+        labels = np.empty(max((row[0] for row in label_rows), default=0) + 1, dtype=object)
+        for term_id, label in label_rows:
+            labels[term_id] = label
+        return cls(phrases, counts, indptr, term_ids, labels)
+
+    def __len__(self):
+        return len(self.phrases)
+
+    def _ngram_codes(self, n):
+        """(номер фразы, код n-граммы) для всех n-грамм подряд идущих лемм, без повторов внутри фразы."""
+        import numpy as np
+        if not 1 <= n <= MAX_NGRAM:
+            raise ValueError(f"n-граммы поддерживаются для n от 1 до {MAX_NGRAM}")
+        size = len(self.labels)
+        starts = np.arange(max(0, len(self.terms) - n + 1))
+        # n-грамма не должна выходить за границу фразы
+        valid = self.rows[starts] == self.rows[starts + n - 1] if len(starts) else starts.astype(bool)
+        starts = starts[valid]
+        codes = np.zeros(len(starts), dtype=np.int64)
+        for offset in range(n):
+            codes = codes * size + self.terms[starts + offset]
+        rows = self.rows[starts]
+        order = np.lexsort((rows, codes))
+        codes, rows = codes[order], rows[order]
+        first = np.ones(len(codes), dtype=bool)
+        first[1:] = (codes[1:] != codes[:-1]) | (rows[1:] != rows[:-1])
+        return rows[first], codes[first]
+
+    def _decode(self, code, n):
+        size = len(self.labels)
+        ids = []
+        for _ in range(n):
+            code, term_id = divmod(int(code), size)
+            ids.append(term_id)
+        return " ".join(self.labels[term_id] for term_id in reversed(ids))
+
+    def ngrams(self, n=1, top=100, order="impressions"):
+        """
+        Самые частые n-граммы лемм: (n-грамма, фраз с ней, сумма показов этих фраз).
+        order — "impressions" или "phrases".
+        """
+        import numpy as np
+        rows, codes = self._ngram_codes(n)
+        if not len(codes):
+            return []
+        unique, inverse = np.unique(codes, return_inverse=True)
+        phrases = np.bincount(inverse)
+        impressions = np.bincount(inverse, weights=self.counts[rows]).astype(np.int64)
+        key = impressions if order == "impressions" else phrases
+        best = np.argsort(-key, kind="stable")[:int(top)]
+        return [(self._decode(unique[i], n), int(phrases[i]), int(impressions[i])) for i in best]
+
+    def _anchors(self, eligible_weight, exclude=None):
+        """Лемма с наибольшим весом в каждой фразе (-1 — нет подходящей); exclude — уже выбранные леммы."""
+        import numpy as np
+        score = eligible_weight[self.terms].astype(np.float64)
+        if exclude is not None:
+            score[self.terms == exclude[self.rows]] = -1
+        order = np.lexsort((-score, self.rows))
+        rows, terms, score = self.rows[order], self.terms[order], score[order]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = rows[1:] != rows[:-1]
+        anchors = np.full(len(self.phrases), -1, dtype=np.int64)
+        chosen = first & (score > 0)
+        anchors[rows[chosen]] = terms[chosen]
+        return anchors
+
+    def clusters(self, max_df=MAX_DF, min_size=MIN_CLUSTER_SIZE, levels=2):
+        """
+        Кластеры по общим леммам. Вес леммы — сумма показов фраз с ней; леммы,
+        встречающиеся больше чем в доле max_df фраз (слова исходной фразы), не
+        учитываются. Фраза попадает в кластер своей самой весомой леммы, при levels=2
+        — в подкластер по второй лемме. Кластеры меньше min_size фраз сливаются
+        с родительским (или попадают в «прочее»).
+        Возвращает (подпись кластера для каждой фразы, сводка: [(кластер, фраз, показов,
+        самая частотная фраза)] по убыванию показов).
+        """
+        import numpy as np
+        size = len(self.labels)
+        # Пары (фраза, лемма) без повторов слова во фразе
+        pairs = np.sort(self.rows * size + self.terms)
+        distinct = np.ones(len(pairs), dtype=bool)
+        distinct[1:] = pairs[1:] != pairs[:-1]
+        pairs = pairs[distinct]
+        rows, terms = np.divmod(pairs, size)
+        df = np.bincount(terms, minlength=size)
+        weight = np.bincount(terms, weights=self.counts[rows], minlength=size)
+        weight[df > max(1, max_df * len(self.phrases))] = 0
+        weight[df < min_size] = 0
+
+        first = self._anchors(weight)
+        key = np.where(first >= 0, first, -1)
+        if levels >= 2:
+            second = self._anchors(weight, exclude=first)
+            key = np.where((first >= 0) & (second >= 0), first * size + second, key)
+            # Мелкие подкластеры — в кластер первого уровня
+            unique, inverse, sizes = np.unique(key, return_inverse=True, return_counts=True)
+            key = np.where((sizes[inverse] < min_size) & (key >= size), first, key)
+        unique, inverse, sizes = np.unique(key, return_inverse=True, return_counts=True)
+        key = np.where(sizes[inverse] < min_size, -1, key)
+
+        unique, inverse = np.unique(key, return_inverse=True)
+        names = np.array([self._cluster_name(int(code)) for code in unique], dtype=object)
+        phrases = np.bincount(inverse)
+        impressions = np.bincount(inverse, weights=self.counts).astype(np.int64)
+        # Самая частотная фраза кластера: сортировка по (кластер, показы)
+        order = np.lexsort((-self.counts, inverse))
+        heads = order[np.searchsorted(inverse[order], np.arange(len(unique)))]
+        summary = sorted(
+            ((names[i], int(phrases[i]), int(impressions[i]), self.phrases[heads[i]]) for i in range(len(unique))),
+            key=lambda row: (row[0] == OTHER, -row[2]))
+        return names[inverse], summary
+
+    def _cluster_name(self, code):
+        """Подпись кластера: лемма первого уровня или «лемма / лемма» для подкластера."""
+        if code < 0:
+            return OTHER
+        if code < len(self.labels):
+            return self.labels[code]
+        first, second = divmod(code, len(self.labels))
+        return f"{self.labels[first]} / {self.labels[second]}"
+
+
+OTHER = "прочее"
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m wordstat.terms",
+                                     description="Семантическое ядро: индекс лемм, частоты n-грамм и кластеры фраз.")
+    parser.add_argument("db", help="файл БД фраз")
+    parser.add_argument("--lemmatizer", choices=("pymorphy", "stem"),
+                        help="по умолчанию — pymorphy3, если установлен, иначе отсечение окончаний")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    index = commands.add_parser("index", help="обновить индекс лемм (инкрементально)")
+    index.add_argument("--full", action="store_true", help="перестроить индекс заново")
+
+    ngrams = commands.add_parser("ngrams", help="самые частые n-граммы лемм с суммой показов")
+    ngrams.add_argument("-n", type=int, default=1, help=f"длина n-граммы (1–{MAX_NGRAM})")
+    ngrams.add_argument("--top", type=int, default=50)
+    ngrams.add_argument("--order", choices=("impressions", "phrases"), default="impressions")
+    ngrams.add_argument("--min-count", type=int, help="учитывать фразы с показами не меньше N")
+
+    clusters = commands.add_parser("clusters", help="кластеры фраз по общим леммам")
+    clusters.add_argument("--levels", type=int, choices=(1, 2), default=2)
+    clusters.add_argument("--max-df", type=float, default=MAX_DF,
+                          help="не учитывать леммы, встречающиеся в большей доле фраз")
+    clusters.add_argument("--min-size", type=int, default=MIN_CLUSTER_SIZE, help="минимальный размер кластера")
+    clusters.add_argument("--top", type=int, default=50, help="сколько кластеров вывести")
+    clusters.add_argument("--min-count", type=int, help="учитывать фразы с показами не меньше N")
+    clusters.add_argument("--csv", help="записать все фразы с кластерами в CSV")
+
+    search = commands.add_parser("search", help="фразы со всеми словами запроса в любой форме")
+    search.add_argument("query")
+    search.add_argument("--top", type=int, default=50)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    from .db import setup_db
+
+    conn = setup_db(args.db)
+    try:
+        lemmatizer = Lemmatizer(args.lemmatizer)
+        started = time.perf_counter()
+        indexed = refresh_index(conn, lemmatizer, full=getattr(args, "full", False))
+        print(f"Индекс: обработано фраз {indexed} за {time.perf_counter() - started:.2f} сек "
+              f"({lemmatizer.kind})", file=sys.stderr)
+        if args.command == "index":
+            return 0
+        if args.command == "search":
+            rows = search_phrases(conn, args.query, args.top, lemmatizer)
+        else:
+            index = TermIndex.load(conn, args.min_count)
+            if args.command == "ngrams":
+                rows = index.ngrams(args.n, args.top, args.order)
+            else:
+                labels, rows = index.clusters(args.max_df, args.min_size, args.levels)
+                rows = rows[:args.top]
+                if args.csv:
+                    with open(args.csv, "w", encoding="utf-8-sig", newline="") as f:
+                        writer = csv.writer(f)
+                        writer.writerow(("Фраза", "Показы", "Кластер"))
+                        writer.writerows(zip(index.phrases, index.counts.tolist(), labels))
+        for row in rows:
+            print("\t".join(str(value) for value in row))
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
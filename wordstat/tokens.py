@@ -0,0 +1,146 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from .ratelimit import TokenBucket
+
+# Дневная квота Wordstat сбрасывается в полночь по Москве (UTC+3, без перехода на летнее время)
+MOSCOW_TZ = timezone(timedelta(hours=3))
+DEFAULT_TOKEN_QPS = 10
+
+
+def next_moscow_midnight(now=None):
+    """Unix-время ближайшей полуночи по Москве после `now`."""
+    now = datetime.fromtimestamp(now if now is not None else time.time(), MOSCOW_TZ)
+    midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return midnight.timestamp()
+
+
+class TokenState:
+    """Состояние одного OAuth-токена: свой лимит QPS, остаток дневной квоты, паузы."""
+
+    def __init__(self, token, qps=DEFAULT_TOKEN_QPS):
+        self.token = token
+        self.bucket = TokenBucket(qps)
+        self.remaining = None  # неизвестно, пока не вызван /v1/userInfo
+        self.inflight = 0
+        self.paused_until = 0.0  # пауза после 429 (Retry-After)
+        self.retired_until = 0.0  # квота исчерпана — до полуночи по МСК
+        self.requests = 0
+
+    @property
+    def headroom(self):
+        """Сколько запросов еще можно отправить с токеном сегодня (inf, если квота неизвестна)."""
+        if self.remaining is None:
+            return float("inf")
+        return self.remaining - self.inflight
+
+    def retire(self, now=None):
+        self.retired_until = next_moscow_midnight(now)
+
+
+class TokenPool:
+    """
+    Пул OAuth-токенов. Каждый запрос отправляется с токеном, у которого больше
+    всего запаса квоты и свободен собственный лимит QPS; токены с исчерпанной
+    квотой выводятся из ротации до полуночи по Москве. Если остаток квоты
+    занят запросами в полете, acquire ждет их завершения: неудачный запрос
+    квоту не списывает, и она снова становится доступной.
+    """
+
+    def __init__(self, tokens, qps=DEFAULT_TOKEN_QPS):
+        if not tokens:
+            raise ValueError("Нужен хотя бы один токен")
+        self.states = [TokenState(token, qps) for token in tokens]
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)  # запрос завершен или изменилась квота
+
+    def __len__(self):
+        return len(self.states)
+
+    def _active(self, state, now):
+        """У токена осталась квота (возможно, целиком занятая запросами в полете)."""
+        if now < state.retired_until:
+            return False
+        if state.retired_until:
+            # Наступили новые сутки: квота восстановлена, но ее размер неизвестен
+            state.retired_until = 0.0
+            state.remaining = None
+        return state.remaining is None or state.remaining > 0
+
+    def acquire(self):
+        """
+        Выбирает токен для запроса и занимает для него слот лимита QPS.
+        Блокирует, пока такой токен не появится. Возвращает TokenState
+        или None, если квота всех токенов исчерпана (remaining == 0).
+        """
+        with self._released:
+            while True:
+                now = time.time()
+                active = [s for s in self.states if self._active(s, now)]
+                if not active:
+                    return None
+                candidates = [s for s in active if s.headroom > 0]
+                if not candidates:
+                    # Вся оставшаяся квота занята запросами в полете — ждем, спишут ли они ее
+                    self._released.wait()
+                    continue
+                candidates.sort(key=lambda s: s.headroom, reverse=True)
+                for state in candidates:
+                    if state.paused_until <= now and state.bucket.try_acquire():
+                        state.inflight += 1
+                        return state
+                wait = min(
+                    max(state.paused_until - now, 1 / state.bucket.rate) for state in candidates
+                )
+                self._released.wait(wait)
+
+    def release(self, state, charged):
+        """Запрос завершен; charged=True — запрос списан с квоты токена."""
+        with self._lock:
+            state.inflight -= 1
+            if charged:
+                state.requests += 1
+                if state.remaining is not None:
+                    state.remaining -= 1
+                    if state.remaining <= 0:
+                        state.retire()
+            self._released.notify_all()
+
+    def pause(self, state, seconds):
+        with self._lock:
+            state.paused_until = max(state.paused_until, time.time() + seconds)
+
+    def set_remaining(self, state, remaining):
+        """Обновляет остаток квоты токена (значение dailyLimitRemaining из /v1/userInfo)."""
+        with self._lock:
+            state.remaining = remaining
+            if remaining is not None and remaining <= 0:
+                state.retire()
+            else:
+                state.retired_until = 0.0
+            self._released.notify_all()
+
+    @property
+    def remaining_total(self):
+        """Суммарный известный остаток квоты по активным токенам (None, если хоть один неизвестен)."""
+        now = time.time()
+        total = 0
+        for state in self.states:
+            if now < state.retired_until:
+                continue
+            if state.remaining is None:
+                return None
+            total += state.remaining
+        return total
+
+    def stats(self):
+        return [
+            {
+                "token": state.token[:6] + "…",
+                "requests": state.requests,
+                "remaining": state.remaining,
+                "retired_until": state.retired_until or None,
+            }
+            for state in self.states
+        ]
@@ -0,0 +1,283 @@
+"""
+Фоновый исполнитель заданий парсинга: забирает задания из таблицы jobs
+(см. wordstat.jobs) и выполняет их Crawler'ом независимо от интерфейса.
+Закрытая вкладка или перезапуск скрипта Streamlit парсинг не прерывают.
+
+    python -m wordstat.worker --slots 4          # токен — из WORDSTAT_TOKEN
+
+Одновременно выполняется до `slots` заданий с общим клиентом (пулом токенов,
+соединений и кэшем ответов). Прогресс пишется в jobs не чаще раза в секунду.
+Если исполнитель упал, его задания через jobs.STALE_AFTER секунд без heartbeat
+возвращаются в очередь и продолжаются с очереди фраз в БД.
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from dataclasses import asdict
+
+from .cache import DEFAULT_TTL, ResponseCache
+from .client import NUM_PHRASES, WordstatClient
+from .crawler import MAX_ERRORS, STOP_CANCELLED, STOP_FIRST_FAILED, STOP_LIMIT, Crawler, CrawlStats
+from .engine import DEFAULT_CONCURRENCY, DEFAULT_QPS
+from .jobs import (CANCELLED, DEFAULT_JOBS_DB, DONE, FAILED, KIND_RECRAWL, cancel_requested, claim_job,
+                   finish_job, heartbeat, live_workers, reclaim_stale, remove_worker, requeue_job, setup_jobs_db,
+                   update_progress, worker_id)
+from .metrics import Metrics
+from .ratelimit import TokenBucket
+
+TOKEN_ENV = "WORDSTAT_TOKEN"
+DEFAULT_SLOTS = 2
+POLL_INTERVAL = 1.0  # как часто проверять очередь заданий и запросы отмены, сек
+PROGRESS_INTERVAL = 1.0  # как часто писать прогресс задания в jobs, сек
+MAX_EVENTS = 20  # сколько последних сообщений задания хранить в progress
+
+
+class JobRunner(threading.Thread):
+    """Поток, выполняющий одно задание; прогресс и сообщения пишет в jobs через свое соединение."""
+
+    def __init__(self, job, client, jobs_db, bucket=None, qps=DEFAULT_QPS):
+        super().__init__(name=f"job-{job['id']}", daemon=True)
+        self.job = job
+        self.client = client
+        self.jobs_db = jobs_db
+        self.bucket = bucket
+        self.qps = qps
+        self.crawler = None
+        self.shutdown = False  # True — исполнитель завершается, задание вернется в очередь
+        self._ready = threading.Event()
+
+    def stop(self, shutdown=False):
+        self.shutdown = self.shutdown or shutdown
+        self._ready.wait()
+        if self.crawler is not None:
+            self.crawler.stop()
+
+    def run(self):
+        job, params = self.job, self.job["params"] or {}
+        conn = setup_jobs_db(self.jobs_db)
+        progress = dict(self.job["progress"] or {})
+        # Задание, возвращенное в очередь, продолжает с очереди фраз и тратит только остаток лимита
+        done_before = progress.get("requests", 0)
+        max_requests = max(0, int(params.get("max_requests", 5)) - done_before)
+        events = list(progress.get("events", []))
+        last_write = [0.0]
+
+        def write(stats, message=None, force=False):
+            now = time.monotonic()
+            if not force and now - last_write[0] < PROGRESS_INTERVAL:
+                return
+            last_write[0] = now
+            progress.update({
+                "requests": done_before + stats.requests,
+                "max_requests": int(params.get("max_requests", 5)),
+                "phrases": stats.phrases,
+                "new_phrases": stats.new_phrases,
+                "cached": stats.cached,
+                "errors": stats.errors,
+                "collapsed": stats.collapsed,
+                "stale": stats.stale,
+                "eta": round(stats.eta, 1),
+                "events": events[-MAX_EVENTS:],
+            })
+            update_progress(conn, job["id"], progress, message)
+
+        def on_progress(stats):
+            write(stats)
+
+        def on_event(level, message):
+            events.append([level, message])
+            progress["events"] = events[-MAX_EVENTS:]
+            update_progress(conn, job["id"], progress, message)
+
+        # Свои метрики у каждого задания: клиент общий, и его счетчики копятся за все задания исполнителя
+        client = self.client
+        if isinstance(client.metrics, Metrics):
+            client = client.with_metrics(Metrics())
+        try:
+            if done_before and not max_requests:
+                # Лимит израсходован еще до возврата в очередь: Crawler.run отправил бы исходную фразу сверх лимита
+                stats = CrawlStats(max_requests=0, phrases=progress.get("phrases", 0), stop_reason=STOP_LIMIT)
+                finish_job(conn, job["id"], DONE, {**asdict(stats), "requests": done_before, "elapsed": 0.0})
+                return
+            self.crawler = Crawler(
+                client, job["db_path"], regions=params.get("regions"), policy=params.get("policy", "fifo"),
+                concurrency=params.get("concurrency", DEFAULT_CONCURRENCY), qps=self.qps,
+                max_errors=params.get("max_errors", MAX_ERRORS), on_progress=on_progress, on_event=on_event,
+                bucket=self.bucket, dedup=params.get("dedup"), collapse=params.get("collapse", True),
+                max_depth=params.get("max_depth"), max_branch_requests=params.get("max_branch_requests"),
+                min_branch_yield=params.get("min_branch_yield"), edges=params.get("edges", True),
+                terms=params.get("terms", True), min_yield=params.get("min_yield"),
+            )
+            self._ready.set()
+            if cancel_requested(conn, job["id"]):
+                self.crawler.stop()
+            if job["kind"] == KIND_RECRAWL:
+                stats = self.crawler.recrawl(max_requests, max_age=params.get("max_age"),
+                                             min_count=params.get("min_count"))
+            else:
+                stats = self.crawler.run(job["phrase"], max_requests)
+            write(stats, force=True)
+
+            if stats.stop_reason == STOP_CANCELLED and self.shutdown and not cancel_requested(conn, job["id"]):
+                requeue_job(conn, job["id"], "Исполнитель остановлен — задание продолжится при следующем запуске")
+                return
+            self.crawler.refresh_terms(stats)
+            result = {**asdict(stats), "requests": done_before + stats.requests, "elapsed": round(stats.elapsed, 3)}
+            if client.cache is not None:
+                # Каждый ответ задания — либо попадание в кэш, либо запрос к API
+                lookups = stats.cached + stats.requests
+                result["cache"] = {"hits": stats.cached, "misses": stats.requests,
+                                   "hit_rate": stats.cached / lookups if lookups else 0.0,
+                                   "size_bytes": client.cache.stats()["size_bytes"]}
+            if isinstance(client.metrics, Metrics):
+                result["metrics"] = client.metrics.snapshot()
+            if stats.stop_reason == STOP_CANCELLED:
+                finish_job(conn, job["id"], CANCELLED, result)
+            elif stats.stop_reason == STOP_FIRST_FAILED:
+                finish_job(conn, job["id"], FAILED, result, error=events[-1][1] if events else None)
+            else:
+                finish_job(conn, job["id"], DONE, result)
+        except Exception as e:
+            traceback.print_exc()
+            finish_job(conn, job["id"], FAILED, error=f"{type(e).__name__}: {e}")
+        finally:
+            self._ready.set()
+            conn.close()
+
+
+class Worker:
+    """Цикл исполнителя: heartbeat, возврат заданий упавших исполнителей, запуск и отмена заданий."""
+
+    def __init__(self, client, jobs_db=DEFAULT_JOBS_DB, slots=DEFAULT_SLOTS, qps=DEFAULT_QPS,
+                 poll_interval=POLL_INTERVAL, idle_exit=None):
+        self.client = client
+        self.jobs_db = jobs_db
+        self.slots = slots
+        self.qps = qps
+        self.poll_interval = poll_interval
+        self.idle_exit = idle_exit  # выйти, если заданий нет столько секунд (None — работать всегда)
+        self.id = worker_id()
+        # Общий лимит QPS на все задания исполнителя
+        self.bucket = TokenBucket(qps * client.token_count)
+        self.runners = {}
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        conn = setup_jobs_db(self.jobs_db)
+        idle_since = time.monotonic()
+        try:
+            while not self._stopping.is_set():
+                self.runners = {job_id: r for job_id, r in self.runners.items() if r.is_alive()}
+                heartbeat(conn, self.id, list(self.runners))
+                reclaim_stale(conn)
+
+                for job_id, runner in self.runners.items():
+                    if cancel_requested(conn, job_id):
+                        runner.stop()
+                while len(self.runners) < self.slots:
+                    job = claim_job(conn, self.id)
+                    if job is None:
+                        break
+                    runner = JobRunner(job, self.client, self.jobs_db, self.bucket, self.qps)
+                    self.runners[job["id"]] = runner
+                    runner.start()
+
+                if self.runners:
+                    idle_since = time.monotonic()
+                elif self.idle_exit is not None and time.monotonic() - idle_since >= self.idle_exit:
+                    break
+                self._stopping.wait(self.poll_interval)
+        finally:
+            # Незавершенные задания возвращаются в очередь, фразы остаются в очереди БД
+            for runner in self.runners.values():
+                runner.stop(shutdown=True)
+            for runner in self.runners.values():
+                runner.join()
+            remove_worker(conn, self.id)
+            conn.close()
+
+
+def ensure_worker(jobs_db=DEFAULT_JOBS_DB, tokens=None, args=(), log_path=None):
+    """
+    Запускает исполнитель отдельным процессом, если живого исполнителя для `jobs_db` нет.
+    Процесс не зависит от вызывающего (новая сессия), токены передаются через WORDSTAT_TOKEN,
+    args — дополнительные аргументы командной строки. Возвращает PID нового процесса или None.
+    """
+    conn = setup_jobs_db(jobs_db)
+    try:
+        if live_workers(conn):
+            return None
+        env = dict(os.environ)
+        if tokens:
+            env[TOKEN_ENV] = ",".join([tokens] if isinstance(tokens, str) else tokens)
+        log = open(log_path or os.path.splitext(jobs_db)[0] + ".log", "ab")
+        try:
+            kwargs = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP} if os.name == "nt" \
+                else {"start_new_session": True}
+            process = subprocess.Popen([sys.executable, "-m", "wordstat.worker", "--jobs-db", jobs_db, *args],
+                                       env=env, stdin=subprocess.DEVNULL, stdout=log, stderr=log, **kwargs)
+        finally:
+            log.close()
+        # Сразу отмечаем исполнитель живым, чтобы следующий вызов не запустил второй
+        heartbeat(conn, worker_id(process.pid), pid=process.pid)
+        return process.pid
+    finally:
+        conn.close()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m wordstat.worker",
+                                     description="Фоновый исполнитель заданий парсинга из таблицы jobs.")
+    parser.add_argument("--jobs-db", default=DEFAULT_JOBS_DB, help="БД заданий")
+    parser.add_argument("--token", action="append", dest="tokens",
+                        help=f"OAuth-токен (по умолчанию — из переменной {TOKEN_ENV}, несколько через запятую)")
+    parser.add_argument("--base-url", help="адрес API, например локального python -m wordstat.mockserver")
+    parser.add_argument("--slots", type=int, default=DEFAULT_SLOTS, help="сколько заданий выполнять одновременно")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="размер пула соединений на одно задание")
+    parser.add_argument("--qps", type=float, default=DEFAULT_QPS, help="лимит запросов в секунду на токен")
+    parser.add_argument("--num-phrases", type=int, default=NUM_PHRASES)
+    parser.add_argument("--cache", default="wordstat_cache.sqlite", help="файл кэша ответов")
+    parser.add_argument("--no-cache", action="store_true", help="не использовать кэш ответов")
+    parser.add_argument("--cache-ttl-days", type=float, default=DEFAULT_TTL / 86400)
+    parser.add_argument("--poll", type=float, default=POLL_INTERVAL, help="интервал опроса очереди заданий, сек")
+    parser.add_argument("--idle-exit", type=float, help="завершиться, если заданий нет N секунд")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if not args.tokens:
+        args.tokens = [t.strip() for t in os.environ.get(TOKEN_ENV, "").split(",") if t.strip()]
+    if not args.tokens:
+        parser.error(f"не задан токен: укажите --token или переменную окружения {TOKEN_ENV}")
+
+    cache = None if args.no_cache else ResponseCache(args.cache, ttl=args.cache_ttl_days * 86400)
+    client = WordstatClient(args.tokens, num_phrases=args.num_phrases, pool_size=args.concurrency * args.slots,
+                            cache=cache, qps_per_token=args.qps, base_url=args.base_url, metrics=Metrics())
+    worker = Worker(client, args.jobs_db, slots=args.slots, qps=args.qps, poll_interval=args.poll,
+                    idle_exit=args.idle_exit)
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+    print(f"Исполнитель {worker.id}: {args.jobs_db}, заданий одновременно: {args.slots}", flush=True)
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.stop()
+    finally:
+        client.close()
+        if cache is not None:
+            cache.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,40 +1,31 @@
 import streamlit as st
-import requests
 import pandas as pd
 import time
 import io
 
+from wordstat import CrawlEngine, WordstatClient
+from wordstat.dedup import FingerprintSet, IdQueue, PhraseIndex
+from wordstat.normalize import canonical_key
+
 # -------------------
 # Конфиг
 # -------------------
-API_URL = "https://api.wordstat.yandex.net/v1/topRequests"
 TOKEN = "сюда ваш токен"
 NUM_PHRASES = 2000
+QPS = 10  # Лимит API: 10 запросов в секунду
+CONCURRENCY = 10  # Сколько запросов держать в полете одновременно
 
 st.set_page_config(page_title="Yandex Wordstat Parser", layout="wide")
 st.title("🔍 Парсер Yandex Wordstat API")
 
 # -------------------
-# Функция API-запроса
+# Клиент API
 # -------------------
-def fetch_wordstat(phrase, region, token, no_region=False):
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Accept-Language": "ru",
-        "Content-Type": "application/json; charset=utf-8"
-    }
-    body = {"phrase": phrase, "numPhrases": NUM_PHRASES}
-    if not no_region:
-        body["regions"] = [int(region)]
-    try:
-        resp = requests.post(API_URL, headers=headers, json=body, timeout=30)
-        if resp.status_code != 200:
-            return []
-        data = resp.json()
-        return data.get("topRequests", [])
-    except Exception as e:
-        st.error(f"Ошибка: {e}")
-        return []
+@st.cache_resource
+def get_client(token):
+    """Один клиент (и пул соединений) на токен — переживает перезапуски скрипта Streamlit."""
+    return WordstatClient(token, num_phrases=NUM_PHRASES, pool_size=CONCURRENCY)
+
 
 # -------------------
 # Функция вывода таблицы и кнопок (всегда одна)
@@ -84,51 +75,77 @@ start_btn = st.button("🚀 Запустить парсинг")
 # Основная логика
 # -------------------
 if start_btn:
-    results = {}
-    query_queue = []
+    # Фразы хранятся компактно: ID фраз, отпечатки и одна строка UTF-8 вместо dict и очереди строк
+    results = PhraseIndex()
+    query_queue = IdQueue()
+    # Раскрываем одну фразу на канонический ключ (порядок слов, регистр, «ё/е», операторы)
+    canon_keys = FingerprintSet()
+    collapsed = 0
+
+    def enqueue(item):
+        global collapsed
+        phrase_id, is_new = results.add(item["phrase"], item["count"])
+        if not is_new:
+            return
+        if canon_keys.add(canonical_key(item["phrase"])):
+            query_queue.append(phrase_id)
+        else:
+            collapsed += 1
 
     progress = st.progress(0)
     status = st.empty()
 
     start_time = time.time()
+    client = get_client(TOKEN)
+    regions = None if no_region else [region]
 
     # --- Первый запрос
-    first = fetch_wordstat(phrase, region, TOKEN, no_region=no_region)
-    for item in first:
-        p = item["phrase"]
-        c = item["count"]
-        results[p] = c
-        query_queue.append(p)
+    # Исходная фраза уже раскрыта: ее повтор (или близкий дубль) в ответе в очередь не встает.
+    # В индекс фраз она попадет из ответа вместе с показами
+    canon_keys.add(canonical_key(phrase))
+    first = client.top_requests(phrase, regions)
+    if not first.ok:
+        st.error(f"Ошибка: {first.error}")
+    for item in first.items:
+        enqueue(item)
 
     # --- Рекурсивные запросы
-    done_requests = 0
-    while done_requests < max_requests and query_queue:
-        current = query_queue.pop(0)
-        wordstat = fetch_wordstat(current, region, TOKEN, no_region=no_region)
+    # До CONCURRENCY запросов одновременно, общий темп ограничен QPS
+    def next_phrase():
+        return results.phrase(query_queue.popleft()) if query_queue else None
+
+    def on_result(current, result, elapsed):
+        global done_requests
+        for item in result.items:
+            enqueue(item)
+
+        # Прогресс и оценка времени — только по успешным запросам к API: ответы из кэша мгновенны,
+        # а ошибки фраз не раскрывают
+        if not result.ok or result.cached:
+            return
         done_requests += 1
-
-        for item in wordstat:
-            p = item["phrase"]
-            c = item["count"]
-            if p not in results:
-                results[p] = c
-                query_queue.append(p)
-
-        elapsed = time.time() - start_time
-        avg_time = elapsed / done_requests
+        elapsed_total = time.time() - start_time
+        avg_time = elapsed_total / done_requests
         eta = avg_time * (max_requests - done_requests)
 
-        progress.progress(done_requests / max_requests)
+        progress.progress(min(done_requests / max_requests, 1.0))
         status.text(f"Запрос {done_requests}/{max_requests} | Осталось ~ {eta:.1f} сек")
 
-        time.sleep(1)
+    done_requests = 0
+    engine = CrawlEngine(
+        lambda p: client.top_requests(p, regions),
+        concurrency=CONCURRENCY,
+        qps=QPS,
+    )
+    engine.run(next_phrase, on_result, max_requests)
 
     # сохраняем результат в сессию
-    df = pd.DataFrame([{"Фраза": k, "Показы": v} for k, v in results.items()])
+    df = pd.DataFrame(results.items(), columns=["Фраза", "Показы"])
     df = df.sort_values("Показы", ascending=False).reset_index(drop=True)
     st.session_state["df"] = df
     st.session_state["last_phrase"] = phrase
     st.success(f"✅ Готово! Собрано {len(results)} уникальных фраз.")
+    st.caption(f"Близких дублей не отправлено в API: {collapsed}. Память индекса фраз: {(results.nbytes + query_queue.nbytes) / 1024:.0f} КБ.")
 
 # -------------------
 # Отрисовка таблицы (всегда одна, из сессии)
@@ -1,20 +1,41 @@
 import streamlit as st
-import requests
 import pandas as pd
-import time
-import io
-import sqlite3
 import os
 import re
+from pathlib import Path
+
+from wordstat import ResponseCache, WordstatClient, WordstatError
+from wordstat.crawler import (MAX_ERRORS, STOP_ERRORS, STOP_LEASED, STOP_LIMIT, STOP_PRUNED, STOP_QUOTA,
+                              STOP_SATURATED)
+from wordstat.db import sanitize_filename, setup_db
+from wordstat.explorer import branch_yield, depth_summary, query_results
+from wordstat.export import FORMATS as EXPORT_FORMATS, checkpoint, db_version, export_results, remove_exports
+from wordstat.jobs import (ACTIVE_STATUSES, CANCELLED, DONE, KIND_CRAWL, KIND_RECRAWL, RUNNING, get_job, list_jobs,
+                           request_cancel, setup_jobs_db, submit_job)
+from wordstat.planner import LIMIT_FRONTIER, LIMIT_MIN_YIELD, forecast_db
+from wordstat.scheduling import POLICIES
+from wordstat.terms import MIN_CLUSTER_SIZE, TermIndex, index_status, refresh_index
+from wordstat.worker import ensure_worker
 
 # -------------------
 # Конфиг
 # -------------------
-API_URL = "https://api.wordstat.yandex.net/v1/topRequests"
-USER_INFO_URL = "https://api.wordstat.yandex.net/v1/userInfo"
-TOKEN = "тут ваш апи код"  # ВНИМАНИЕ: это публичный токен, замените его
+TOKEN = "тут ваш апи код"  # ВНИМАНИЕ: это публичный токен, замените его (можно указать список токенов)
 NUM_PHRASES = 2000
-MAX_ERRORS = 3  # Максимальное количество последовательных ошибок API
+CACHE_PATH = "wordstat_cache.sqlite"  # Общий кэш ответов API для всех БД фраз
+CACHE_TTL_DAYS = 30  # Wordstat отдает данные за 30 дней
+CACHE_MAX_MB = 1024
+QPS = 10  # Лимит API: 10 запросов в секунду
+CONCURRENCY = 10  # Сколько запросов держать в полете одновременно
+JOBS_DB = "wordstat_jobs.sqlite"  # Задания для фонового исполнителя (python -m wordstat.worker)
+WORKER_SLOTS = 2  # Сколько заданий исполнитель выполняет одновременно
+JOBS_REFRESH_SEC = 2  # Как часто обновлять прогресс заданий на странице
+RESULT_ORDERS = {
+    "count_desc": "Показы ↓",
+    "count_asc": "Показы ↑",
+    "phrase_asc": "Фраза А→Я",
+    "phrase_desc": "Фраза Я→А",
+}
 
 st.set_page_config(page_title="Yandex Wordstat Parser", layout="wide")
 st.title("🔍 Парсер Yandex Wordstat API с SQLite ")
@@ -23,185 +44,233 @@ st.title("🔍 Парсер Yandex Wordstat API с SQLite ")
 # -------------------
 # Функции работы с API
 # -------------------
-# -------------------
-# Функции работы с API
-# -------------------
-# -------------------
-# Функции работы с API
-# -------------------
-def fetch_user_info(token):
-    """
-    Получает информацию о квоте пользователя, выполняя ТОЛЬКО POST-запрос,
-    который был определен как рабочий.
-    """
-    # URL для этого метода уже должен быть определен в конфиге: USER_INFO_URL
-    # (USER_INFO_URL = "https://api.wordstat.yandex.net/v1/userInfo")
+@st.cache_resource
+def get_response_cache():
+    """Дисковый кэш ответов, общий для всех запусков и БД фраз."""
+    return ResponseCache(CACHE_PATH, ttl=CACHE_TTL_DAYS * 24 * 3600, max_bytes=CACHE_MAX_MB * 1024 * 1024)
 
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Accept-Language": "ru",
-    }
 
-    if not token:
-        st.error("Токен API пуст.")
-        return None
-
-    try:
-        # Выполняем сразу POST-запрос
-        resp = requests.post(USER_INFO_URL, headers=headers, timeout=10)
+@st.cache_resource
+def get_client(token):
+    """Один клиент (и пул соединений) на токен — переживает перезапуски скрипта Streamlit."""
+    return WordstatClient(token, num_phrases=NUM_PHRASES, pool_size=CONCURRENCY, cache=get_response_cache())
 
-        if resp.status_code == 200:
-            data = resp.json()
-            return data.get("userInfo", {}).get("dailyLimitRemaining")
-        else:
-            # Выводим код ошибки, если POST не сработал
-            st.error(f"Не удалось получить информацию о квоте. Код: {resp.status_code}.")
-            return None
 
-    except Exception as e:
-        st.error(f"Ошибка при запросе /v1/userInfo: {e}")
+def fetch_user_info(client):
+    """Получает остаток дневной квоты пользователя (суммарно по всем токенам)."""
+    try:
+        if client.token_count > 1:
+            return client.refresh_quota()
+        return client.user_info().get("dailyLimitRemaining")
+    except WordstatError as e:
+        st.error(str(e))
         return None
 
 
-def fetch_wordstat(phrase, region, token, no_region=False):
-    # URL для этого метода уже должен быть определен в конфиге: API_URL
-    # (API_URL = "https://api.wordstat.yandex.net/v1/topRequests")
-
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Accept-Language": "ru",
-        "Content-Type": "application/json; charset=utf-8"
-    }
-    body = {"phrase": phrase, "numPhrases": NUM_PHRASES}  # NUM_PHRASES должен быть в конфиге
-    if not no_region:
-        body["regions"] = [int(region)]
+# -------------------
+# Функции работы с SQLite
+# -------------------
+@st.cache_data(max_entries=64, show_spinner=False)
+def load_results_page(db_name, db_ver, contains, regex, min_count, max_count, order, limit, offset):
+    """
+    Страница результатов с фильтрами, выполненными в SQLite. Кэшируется по запросу
+    и версии БД (db_ver), поэтому повторные перерисовки не обращаются к БД.
+    """
+    conn = setup_db(db_name)
     try:
-        resp = requests.post(API_URL, headers=headers, json=body, timeout=30)
-        if resp.status_code != 200:
-            st.warning(f"Ошибка API для запроса '{phrase}': Код {resp.status_code}. Пропускаем.")
-            return []
-        data = resp.json()
-        return data.get("topRequests", [])
-    except Exception as e:
-        st.error(f"Ошибка при запросе '{phrase}': {e}")
-        return []
-
+        rows, total = query_results(conn, contains, regex, min_count, max_count, order, limit, offset)
+    finally:
+        conn.close()
+    return pd.DataFrame(rows, columns=["Фраза", "Показы"]), total
 
 
+@st.cache_data(max_entries=16, show_spinner=False)
+def load_crawl_stats(db_name, db_ver):
+    """Отдача веток и фразы по глубине (граф обхода) — кэшируются до изменения БД."""
+    conn = setup_db(db_name)
+    try:
+        branches = branch_yield(conn)
+        depths = depth_summary(conn)
+    finally:
+        conn.close()
+    return (pd.DataFrame(branches, columns=["Ветка", "Запросов", "Новых фраз", "Фраз на запрос", "В очереди"]),
+            pd.DataFrame(depths, columns=["Глубина", "Фраз", "Раскрыто", "В очереди"]))
 
 
-def fetch_wordstat(phrase, region, token, no_region=False):
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Accept-Language": "ru",
-        "Content-Type": "application/json; charset=utf-8"
-    }
-    body = {"phrase": phrase, "numPhrases": NUM_PHRASES}
-    if not no_region:
-        body["regions"] = [int(region)]
+@st.cache_data(max_entries=4, show_spinner="Строим семантическое ядро...")
+def load_semantic_core(db_name, db_ver, levels, min_size):
+    """
+    Частые слова и словосочетания (леммы) и кластеры фраз по индексу лемм, расчет
+    кэшируется до изменения БД. Только чтение: индекс дополняет исполнитель в конце
+    запуска, а вручную — кнопка «Обновить индекс» (rebuild_semantic_core).
+    """
+    conn = setup_db(db_name)
     try:
-        resp = requests.post(API_URL, headers=headers, json=body, timeout=30)
-        # 429 Too Many Requests, 503 Service Unavailable и другие ошибки
-        if resp.status_code != 200:
-            st.warning(f"Ошибка API для запроса '{phrase}': Код {resp.status_code}. Пропускаем.")
-            return []
-        data = resp.json()
-        return data.get("topRequests", [])
-    except Exception as e:
-        st.error(f"Ошибка при запросе '{phrase}': {e}")
-        return []
+        status = index_status(conn)
+        index = TermIndex.load(conn)
+    finally:
+        conn.close()
+    columns = ["Фраз", "Показов"]
+    words = pd.DataFrame(index.ngrams(1, 100), columns=["Слово", *columns])
+    bigrams = pd.DataFrame(index.ngrams(2, 100), columns=["Словосочетание", *columns])
+    labels, summary = index.clusters(min_size=min_size, levels=levels)
+    clusters = pd.DataFrame(summary, columns=["Кластер", *columns, "Главная фраза"])
+    members = pd.DataFrame({"Фраза": index.phrases, "Показы": index.counts, "Кластер": labels})
+    return status, words, bigrams, clusters, members
 
 
-# -------------------
-# Функции работы с SQLite
-# -------------------
-def sanitize_filename(phrase):
-    """Очищает фразу для использования в качестве имени файла."""
-    phrase = re.sub(r'[\\/:*?"<>|]', '', phrase)
-    return phrase.strip().replace(' ', '_')[:50] + ".db"
-
-
-def setup_db(db_name):
-    """Подключается к БД и создает две таблицы: results и queue."""
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS results (
-            phrase TEXT PRIMARY KEY,
-            count INTEGER
-        )
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS queue (
-            phrase TEXT PRIMARY KEY,
-            status TEXT DEFAULT 'PENDING' 
-        )
-    """)
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_status_queue ON queue (status)")
-    conn.commit()
-    return conn
+def rebuild_semantic_core(db_name):
+    """Дополняет индекс лемм по кнопке: пишет в БД, поэтому не во время обычной перерисовки."""
+    conn = setup_db(db_name)
+    try:
+        refresh_index(conn)
+    finally:
+        conn.close()
 
 
-def insert_result_and_queue(conn, phrase, count, is_processed=False):
-    """Вставляет фразу в results и в queue."""
-    conn.execute("INSERT OR IGNORE INTO results (phrase, count) VALUES (?, ?)", (phrase, count))
-    status = 'PROCESSED' if is_processed else 'PENDING'
-    conn.execute("INSERT OR IGNORE INTO queue (phrase, status) VALUES (?, ?)", (phrase, status))
+def db_in_work(db_name):
+    """БД сейчас парсит задание исполнителя — писать в нее из интерфейса не нужно."""
+    conn = setup_jobs_db(JOBS_DB)
+    try:
+        jobs = list_jobs(conn, statuses=ACTIVE_STATUSES)
+    finally:
+        conn.close()
+    return any(os.path.abspath(job["db_path"]) == os.path.abspath(db_name) for job in jobs)
 
 
-def update_queue_status(conn, phrase, status='PROCESSED'):
-    """Обновляет статус фразы в таблице queue."""
-    conn.execute("UPDATE queue SET status = ? WHERE phrase = ?", (status, phrase))
+@st.cache_data(max_entries=32, show_spinner=False)
+def load_forecast(db_name, db_ver, budget, min_yield):
+    """Прогноз запуска по истории БД (wordstat.planner) — кэшируется до изменения БД."""
+    return forecast_db(db_name, budget, concurrency=CONCURRENCY, qps=QPS,
+                       tokens=1 if isinstance(TOKEN, str) else len(TOKEN), min_yield=min_yield)
 
 
-def get_all_results_df(conn):
-    """Загружает все результаты из БД в DataFrame."""
-    return pd.read_sql_query("SELECT phrase AS Фраза, count AS Показы FROM results ORDER BY Показы DESC", conn)
+# -------------------
+# Функция вывода таблицы и кнопок
+# -------------------
+def export_reader(db_name, fmt):
+    """
+    Файлы экспорта создаются потоково из БД только по нажатию кнопки и кэшируются до изменения БД.
+    Отдаются байтами: файл закрывается сразу после чтения.
+    """
+    return lambda: Path(export_results(db_name, fmt)).read_bytes()
 
 
-def get_db_phrase_count(conn):
-    """Возвращает текущее количество уникальных фраз из таблицы results."""
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(phrase) FROM results")
-    return cursor.fetchone()[0]
+def db_reader(db_name):
+    def read():
+        checkpoint(db_name)
+        return Path(db_name).read_bytes()
+    return read
 
 
-# -------------------
-# Функция вывода таблицы и кнопок (без изменений)
-# -------------------
-def render_results(df: pd.DataFrame, db_name: str):
+def render_results(db_name: str):
     st.subheader("📊 Результаты")
+
+    # Фильтры, сортировка и постраничный вывод выполняются в SQLite
+    f1, f2, f3, f4 = st.columns([3, 3, 1, 1])
+    with f1:
+        contains = st.text_input("Содержит", key="flt_contains").strip()
+    with f2:
+        regex = st.text_input("Регулярное выражение", key="flt_regex").strip()
+    with f3:
+        min_count = st.number_input("Показы от", min_value=0, value=None, step=1, key="flt_min")
+    with f4:
+        max_count = st.number_input("Показы до", min_value=0, value=None, step=1, key="flt_max")
+    s1, s2, s3 = st.columns([2, 1, 1])
+    with s1:
+        order = st.selectbox("Сортировка", list(RESULT_ORDERS), format_func=RESULT_ORDERS.get, key="flt_order")
+    with s2:
+        page_size = st.selectbox("Строк на странице", [50, 100, 500, 1000], index=1, key="flt_page_size")
+    with s3:
+        page = st.number_input("Страница", min_value=1, value=1, step=1, key="flt_page")
+
+    try:
+        df, total = load_results_page(db_name, db_version(db_name), contains or None, regex or None,
+                                      min_count, max_count, order, page_size, (page - 1) * page_size)
+    except re.error as e:
+        st.error(f"Некорректное регулярное выражение: {e}")
+        return
+    pages = max(1, -(-total // page_size))
+    st.caption(f"Найдено фраз: {total} | Страница {min(page, pages)} из {pages}")
     st.dataframe(df, use_container_width=True)
 
-    col1, col2, col3 = st.columns(3)
+    # Какие ветки обхода приносят больше новых фраз на потраченный запрос
+    branches, depths = load_crawl_stats(db_name, db_version(db_name))
+    if not branches.empty:
+        with st.expander("🌿 Отдача веток и глубина обхода"):
+            st.caption("Ветка — фраза из ответа на исходный запрос со всеми фразами, найденными от нее.")
+            st.dataframe(branches, use_container_width=True)
+            st.dataframe(depths, use_container_width=True)
+
+    # Группировка фраз по общим словам прямо в приложении, без выгрузки в сторонние программы
+    with st.expander("🧩 Семантическое ядро"):
+        st.caption("Слова приводятся к начальной форме; показы — сумма по фразам со словом. "
+                   "Кластер — самое весомое слово фразы (и второе — для подкластера).")
+        if st.toggle("Построить", key="core_on"):
+            c1, c2 = st.columns(2)
+            with c1:
+                levels = st.radio("Уровни кластеров", [1, 2], index=1, horizontal=True, key="core_levels")
+            with c2:
+                min_size = st.number_input("Фраз в кластере от", min_value=2, value=MIN_CLUSTER_SIZE, step=1,
+                                           key="core_min_size")
+            (indexed, pending), words, bigrams, clusters, members = load_semantic_core(
+                db_name, db_version(db_name), levels, min_size)
+            if pending:
+                busy = db_in_work(db_name)
+                st.info(f"В индексе лемм {indexed} фраз, еще не проиндексировано {pending}. "
+                        + ("Индекс дополнится, когда завершится парсинг этой БД." if busy else
+                           "Обычно индекс дополняется в конце парсинга."))
+                if st.button("🔄 Обновить индекс", key="core_rebuild", disabled=busy):
+                    with st.spinner("Обновляем индекс лемм..."):
+                        rebuild_semantic_core(db_name)
+                    st.rerun()
+            t1, t2, t3 = st.tabs(["Кластеры", "Слова", "Словосочетания"])
+            with t1:
+                st.dataframe(clusters, use_container_width=True)
+                st.download_button(
+                    "📥 Фразы с кластерами (CSV)",
+                    lambda: members.to_csv(index=False).encode("utf-8-sig"),
+                    file_name=f"{db_name.replace('.db', '')}_clusters.csv",
+                    mime=EXPORT_FORMATS["csv"],
+                    key="clusters_btn"
+                )
+            with t2:
+                st.dataframe(words, use_container_width=True)
+            with t3:
+                st.dataframe(bigrams, use_container_width=True)
+
+    base_name = db_name.replace('.db', '')
+    col1, col2, col3, col4 = st.columns(4)
 
-    csv_data = df.to_csv(index=False).encode("utf-8")
     with col1:
         st.download_button(
             "📥 Скачать CSV",
-            csv_data,
-            file_name=f"{db_name.replace('.db', '')}.csv",
-            mime="text/csv",
+            export_reader(db_name, "csv"),
+            file_name=f"{base_name}.csv",
+            mime=EXPORT_FORMATS["csv"],
             key="csv_btn"
         )
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="Wordstat")
     with col2:
         st.download_button(
             "📊 Скачать Excel",
-            output.getvalue(),
-            file_name=f"{db_name.replace('.db', '')}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            export_reader(db_name, "xlsx"),
+            file_name=f"{base_name}.xlsx",
+            mime=EXPORT_FORMATS["xlsx"],
             key="excel_btn"
         )
     with col3:
+        st.download_button(
+            "🧱 Скачать Parquet",
+            export_reader(db_name, "parquet"),
+            file_name=f"{base_name}.parquet",
+            mime=EXPORT_FORMATS["parquet"],
+            key="parquet_btn"
+        )
+    with col4:
         if os.path.exists(db_name):
-            with open(db_name, "rb") as f:
-                db_bytes = f.read()
             st.download_button(
                 "💾 Скачать SQLite DB",
-                db_bytes,
+                db_reader(db_name),
                 file_name=db_name,
                 mime="application/octet-stream",
                 key="sqlite_btn"
@@ -210,12 +279,115 @@ def render_results(df: pd.DataFrame, db_name: str):
             st.info("Файл БД не найден для скачивания.")
 
 
+# -------------------
+# Фоновые задания
+# -------------------
+def start_worker():
+    """Запускает фоновый исполнитель заданий, если он еще не запущен (переживает перезапуски Streamlit)."""
+    ensure_worker(JOBS_DB, TOKEN, args=[
+        "--slots", str(WORKER_SLOTS), "--concurrency", str(CONCURRENCY), "--qps", str(QPS),
+        "--num-phrases", str(NUM_PHRASES), "--cache", CACHE_PATH, "--cache-ttl-days", str(CACHE_TTL_DAYS),
+    ])
+
+
+def show_job_result(job):
+    """Итог завершенного задания: кэш, метрики, сэкономленные запросы и финальное сообщение."""
+    result = job["result"] or {}
+    if job["status"] == CANCELLED:
+        st.info(f"⏹ Парсинг остановлен. Собрано {result.get('phrases', 0)} фраз; "
+                f"необработанные фразы остались в очереди БД.")
+        return
+    if job["status"] != DONE:
+        st.error(f"❌ {job['error'] or 'Парсинг завершился ошибкой.'}")
+        return
+
+    # Статистика кэша ответов
+    cache_stats = result.get("cache")
+    if cache_stats:
+        st.caption(
+            f"Кэш ответов: {cache_stats['hits']} попаданий из {cache_stats['hits'] + cache_stats['misses']} "
+            f"({cache_stats['hit_rate']:.0%}), размер {cache_stats['size_bytes'] / 1024 / 1024:.1f} МБ.")
+    # Куда ушло время: сеть, разбор JSON, запись в SQLite, ожидание лимитов (за это задание)
+    metrics = result.get("metrics")
+    if metrics:
+        with st.expander("⏱ Метрики задания"):
+            st.dataframe(pd.DataFrame.from_dict(metrics["stages"], orient="index"), use_container_width=True)
+            st.caption(" | ".join(f"{name}: {value}" for name, value in {**metrics["counters"],
+                                                                           **metrics["gauges"]}.items()))
+    if result.get("collapsed"):
+        st.caption(f"Близких дублей (порядок слов, регистр, «ё/е», операторы) не отправлено в API: "
+                   f"{result['collapsed']} — столько запросов сэкономлено.")
+
+    # Финальное сообщение
+    max_requests = (job["params"] or {}).get("max_requests")
+    if result.get("stop_reason") == STOP_LIMIT:
+        st.success(f"✅ Установленный лимит запросов ({max_requests}) достигнут. Собрано {result['phrases']} фраз.")
+    elif result.get("stop_reason") == STOP_SATURATED:
+        st.success(f"✅ Отдача упала ниже {(job['params'] or {}).get('min_yield')} новых фраз на запрос — парсинг "
+                   f"остановлен, чтобы не тратить квоту. Собрано {result['phrases']} фраз.")
+    elif result.get("stop_reason") == STOP_PRUNED:
+        st.info(f"ℹ️ Оставшиеся фразы за ограничениями обхода (глубина, лимиты веток) и остались в очереди. "
+                f"Собрано {result['phrases']} фраз. Чтобы продолжить, ослабьте ограничения.")
+    elif result.get("stop_reason") == STOP_LEASED:
+        st.info(f"ℹ️ Свободных фраз не осталось: остаток очереди разбирает другое задание или процесс на этой БД. "
+                f"Собрано {result['phrases']} фраз.")
+    elif result.get("stop_reason") in (STOP_ERRORS, STOP_QUOTA):
+        st.warning(f"⚠️ Парсинг остановлен из-за лимита API. Собрано {result['phrases']} фраз. Возобновите позже.")
+    else:
+        st.success(f"✅ Парсинг завершен! Вся очередь обработана. Собрано {result.get('phrases', 0)} фраз.")
+
+
+@st.fragment(run_every=JOBS_REFRESH_SEC)
+def render_jobs():
+    """Прогресс заданий. Перерисовывается сам каждые JOBS_REFRESH_SEC секунд, не перезапуская страницу."""
+    conn = setup_jobs_db(JOBS_DB)
+    try:
+        active = list_jobs(conn, statuses=ACTIVE_STATUSES)
+        job_id = st.session_state.get("job_id")
+        own = get_job(conn, job_id) if job_id else None
+    finally:
+        conn.close()
+
+    if active:
+        st.subheader("⏳ Задания")
+    for job in reversed(active):
+        progress = job["progress"] or {}
+        total = progress.get("max_requests") or (job["params"] or {}).get("max_requests") or 1
+        title = job["phrase"] if job["kind"] == KIND_CRAWL else f"обновление {job['db_path']}"
+        c1, c2 = st.columns([5, 1])
+        with c1:
+            st.progress(min(progress.get("requests", 0) / total, 1.0), text=f"#{job['id']} {title}")
+            if job["status"] == RUNNING:
+                st.text(f"Запрос {progress.get('requests', 0)}/{total} | Фраз: {progress.get('phrases', 0)} "
+                        f"| Осталось ~ {progress.get('eta', 0):.1f} сек ")
+            else:
+                st.text("В очереди")
+            if job["message"]:
+                st.caption(job["message"])
+        with c2:
+            if st.button("⏹ Остановить", key=f"cancel_{job['id']}", disabled=bool(job["cancel_requested"])):
+                conn = setup_jobs_db(JOBS_DB)
+                try:
+                    request_cancel(conn, job["id"])
+                finally:
+                    conn.close()
+
+    if own is None or own["status"] in ACTIVE_STATUSES:
+        return
+    # Задание сессии завершилось — один раз перезапускаем страницу, чтобы обновить таблицу результатов
+    if st.session_state.get("job_finished") != own["id"]:
+        st.session_state["job_finished"] = own["id"]
+        st.rerun()
+    show_job_result(own)
+
+
 # -------------------
 # UI и Основная логика
 # -------------------
 
 # --- 🆕 Вывод оставшейся квоты в основной части UI
-remaining_quota = fetch_user_info(TOKEN)
+client = get_client(TOKEN)
+remaining_quota = fetch_user_info(client)
 
 # --- Параметры парсинга
 col1, col2, col3 = st.columns([3, 1, 1])
@@ -235,188 +407,114 @@ with col3:
 
 
 max_requests = st.number_input("Максимум рекурсивных запросов (N).", value=5, step=1, min_value=1)
+policy_name = st.selectbox(
+    "Порядок обхода очереди",
+    list(POLICIES),
+    format_func=lambda name: POLICIES[name].label,
+)
+with st.expander("🌿 Ограничения обхода"):
+    l1, l2, l3, l4 = st.columns(4)
+    with l1:
+        max_depth = st.number_input("Максимальная глубина", min_value=0, value=None, step=1,
+                                    help="0 — только исходный запрос, 1 — и фразы из его ответа и т.д.")
+    with l2:
+        max_branch_requests = st.number_input("Запросов на ветку", min_value=1, value=None, step=1,
+                                              help="Ветка — фраза из ответа на исходный запрос и все ее потомки.")
+    with l3:
+        min_branch_yield = st.number_input("Мин. новых фраз на запрос", min_value=0.0, value=None, step=10.0,
+                                           help="Ветки с меньшей отдачей после 5 запросов не раскрываются.")
+    with l4:
+        min_yield = st.number_input("Остановить при отдаче ниже", min_value=0.0, value=None, step=10.0,
+                                    help="Парсинг остановится, когда последние 20 запросов принесут в среднем "
+                                         "меньше стольких новых фраз.")
+
+# --- Прогноз по истории БД: сколько новых фраз и времени даст лимит запросов
+if phrase:
+    forecast_db_name = sanitize_filename(phrase)
+    forecast = load_forecast(forecast_db_name, db_version(forecast_db_name), max_requests, min_yield)
+    limit_note = {LIMIT_FRONTIER: " Очередь закончится раньше лимита.",
+                  LIMIT_MIN_YIELD: " Отдача упадет ниже порога раньше лимита."}.get(forecast.limit, "")
+    st.caption(
+        f"📈 Прогноз: ~{forecast.new_phrases} новых фраз за ~{forecast.seconds:.0f} сек, квота ~{forecast.quota} "
+        f"запросов (из кэша ~{forecast.cache_hit_rate:.0%}). Отдача: {forecast.yield_now:g} → {forecast.yield_end:g} "
+        f"новых фраз на запрос.{limit_note}"
+        + ("" if forecast.history else " Истории запусков нет — оценка приблизительная."))
 st.caption(f"Лимит квоты сбросится в полночь по МСК. Парсинг остановится после {MAX_ERRORS} последовательных ошибок.")
 
 # --- Логика кнопки очистки
 if "current_db" in st.session_state and os.path.exists(st.session_state["current_db"]):
-    if st.button(f"🗑️ Удалить БД: {st.session_state['current_db']}"):
-        os.remove(st.session_state["current_db"])
+    delete_busy = db_in_work(st.session_state["current_db"])
+    if st.button(f"🗑️ Удалить БД: {st.session_state['current_db']}", disabled=delete_busy,
+                 help="БД сейчас парсит исполнитель — остановите задание, чтобы удалить ее." if delete_busy else None):
+        # В режиме WAL рядом с БД лежат журналы -wal и -shm — удаляем и их
+        for path in (st.session_state["current_db"], st.session_state["current_db"] + "-wal",
+                     st.session_state["current_db"] + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+        remove_exports(st.session_state["current_db"])
         del st.session_state["current_db"]
-        if "df" in st.session_state:
-            del st.session_state["df"]
         st.success("База данных удалена. Перезапустите парсинг.")
         st.rerun()
 
+# --- Повторный обход: обновить показы устаревших фраз вместо удаления БД
+recrawl_btn = False
+if "current_db" in st.session_state and os.path.exists(st.session_state["current_db"]):
+    with st.expander("🔄 Обновить устаревшие данные"):
+        r1, r2 = st.columns(2)
+        with r1:
+            max_age_days = st.number_input("Старше, дней", value=30, step=1, min_value=0)
+        with r2:
+            min_count = st.number_input("Показы от", value=0, step=1, min_value=0, key="recrawl_min")
+        st.caption("Заново запрашиваются только обработанные фразы, показы которых старше порога; "
+                   "прежние значения сохраняются в истории (таблица observations).")
+        recrawl_btn = st.button("🔄 Обновить")
+
 start_btn = st.button("🚀 Запустить парсинг")
 
-# --- Основная логика выполнения
-if start_btn:
-    if not phrase:
+# --- Основная логика: парсинг выполняет фоновый исполнитель, страница только ставит задание
+if start_btn or recrawl_btn:
+    if start_btn and not phrase:
         st.error("Пожалуйста, введите исходный запрос.")
         st.stop()
 
-    # 1. Формирование имени БД и подключение
-    db_name = sanitize_filename(phrase)
+    # 1. Формирование имени БД
+    db_name = sanitize_filename(phrase) if start_btn else st.session_state["current_db"]
     st.session_state["current_db"] = db_name
-    conn = setup_db(db_name)
-
-    # 2. Загрузка очереди для возобновления парсинга
-    with st.spinner("Загрузка очереди из БД..."):
-        query_queue = pd.read_sql_query("SELECT phrase FROM queue WHERE status = 'PENDING'", conn)['phrase'].tolist()
-        queue_set = set(query_queue)
-
-    progress = st.progress(0)
-    status = st.empty()
-    start_time = time.time()
-    total_phrases = get_db_phrase_count(conn)
-    consecutive_errors = 0
-
-    # --- Первый запрос (если очередь пуста)
-    # --- Первый запрос (если очередь пуста)
-    if not query_queue:
-
-        current_phrase = phrase
-
-        first = fetch_wordstat(current_phrase, region, TOKEN, no_region=no_region)
-
-        # Проверка: Если первый запрос сразу ошибочен (429/503), не начинаем
-        if not first:
-            st.error("❌ Первый запрос завершился ошибкой. Парсинг не может быть начат.")
-            conn.close()
-            st.stop()
-
-        # 1. Получаем частотность исходной фразы (она должна быть первой в массиве)
-        # Убеждаемся, что элемент существует и содержит нужную фразу
-        initial_phrase_count = first[0].get('count', 0) if first and first[0].get('phrase') == current_phrase else 0
-
-        # 2. Вставляем ИСХОДНУЮ фразу с ее частотностью и сразу ставим статус 'PROCESSED'.
-        insert_result_and_queue(conn, current_phrase, initial_phrase_count, is_processed=True)
-
-        # 3. Обрабатываем ВСЕ 2000 фраз. INSERT OR IGNORE позаботится о дедупликации.
-        for item in first:
-            p = item["phrase"]
-            c = item["count"]
-
-            # Вставляем/обновляем в results, и добавляем PENDING в queue (кроме уже PROCESSED)
-            insert_result_and_queue(conn, p, c, is_processed=False)
-
-            # Добавляем в оперативную очередь только PENDING
-            if p not in queue_set:
-                query_queue.append(p)
-                queue_set.add(p)
-
-        conn.commit()
-        total_phrases = get_db_phrase_count(conn)
-    else:
-        st.info(f"Возобновление парсинга. Очередь: {len(query_queue)} фраз.")
-
-    # --- Рекурсивные запросы
-    done_requests = 0
-
-    # Цикл работает, пока:
-    # 1. Мы не превысили установленный пользователем лимит API-запросов (max_requests).
-    # 2. В очереди есть фразы, ожидающие обработки.
-    while done_requests < max_requests and query_queue:
-        # Берем фразу для обработки
-        current_phrase = query_queue.pop(0)
-        queue_set.discard(current_phrase)
-
-        # Пропускаем, если фраза уже была обработана (важно для возобновления)
-        status_check = conn.execute("SELECT status FROM queue WHERE phrase = ?", (current_phrase,)).fetchone()
-        if status_check and status_check[0] == 'PROCESSED':
-            continue
-
-        # 1. Выполняем запрос к API.
-        # В ответ приходит список 'wordstat' до 2000 фраз.
-        wordstat = fetch_wordstat(current_phrase, region, TOKEN, no_region=no_region)
-        done_requests += 1  # Увеличиваем счетчик API-запросов
-
-        # 2. Логика контроля ошибок (429/503)
-        if not wordstat:
-            consecutive_errors += 1
-
-            if consecutive_errors >= MAX_ERRORS:
-                st.error(f"❌ Достигнут лимит последовательных ошибок ({MAX_ERRORS}). Парсинг остановлен.")
-                break
-
-                # При ошибке возвращаем фразу в конец очереди, чтобы попробовать снова
-            st.warning(
-                f"⚠️ Ошибка API. Фраза '{current_phrase}' осталась в PENDING. Счет: {consecutive_errors}/{MAX_ERRORS}. Ожидание...")
-            query_queue.append(current_phrase)
-            queue_set.add(current_phrase)
-            time.sleep(5)
-            continue
 
+    # 2. Задание в очередь; исполнитель запускается отдельным процессом, если еще не запущен
+    params = {"regions": None if no_region else [region], "max_requests": max_requests, "policy": policy_name,
+              "concurrency": CONCURRENCY, "max_errors": MAX_ERRORS, "max_depth": max_depth,
+              "max_branch_requests": max_branch_requests, "min_branch_yield": min_branch_yield,
+              "min_yield": min_yield}
+    jobs_conn = setup_jobs_db(JOBS_DB)
+    try:
+        if start_btn:
+            job_id = submit_job(jobs_conn, KIND_CRAWL, db_name, phrase, **params)
         else:
-            consecutive_errors = 0
-
-            # 3. Обработка результатов и пополнение очереди
-            # Перебираем ВСЕ полученные от API фразы (макс. 2000)
-            for item in wordstat:
-                p = item["phrase"]
-                c = item["count"]
-
-                # Сохраняем результат и добавляем в очередь как PENDING
-                insert_result_and_queue(conn, p, c, is_processed=False)
-
-                # Добавляем в оперативную очередь, только если фраза еще не там
-                if p not in queue_set:
-                    query_queue.append(p)
-                    queue_set.add(p)
-
-            # 4. СОХРАНЕНИЕ ПОЗИЦИИ: Помечаем текущую фразу как обработанную
-            update_queue_status(conn, current_phrase, 'PROCESSED')
-            conn.commit()
-            if remaining_quota is not None and remaining_quota > 0:
-                remaining_quota -= 1
-                quota_placeholder.metric(label="Остаток дневной квоты", value=f"{remaining_quota} запросов")
-
-            # 5. Обновление прогресса и ETA
-        total_phrases = get_db_phrase_count(conn)
-        elapsed = time.time() - start_time
-        avg_time = elapsed / done_requests
-        eta = avg_time * (max_requests - done_requests) if done_requests < max_requests else 0
-
-        progress.progress(done_requests / max_requests)
-        status.text(
-            f"Запрос {done_requests}/{max_requests} | Фраз: {total_phrases} | Осталось ~ {eta:.1f} сек ")
-
-        # 6. Пауза между запросами (для контроля QPS)
-        time.sleep(0.15)
-
-        # 3. Загрузка финального результата и завершение
-    df = get_all_results_df(conn)
-    conn.close()
-
-    # сохраняем результат в сессию
-    st.session_state["df"] = df
-    st.session_state["db_name"] = db_name
+            job_id = submit_job(jobs_conn, KIND_RECRAWL, db_name, **params, max_age=max_age_days * 86400,
+                                min_count=min_count or None)
+    finally:
+        jobs_conn.close()
+    start_worker()
+    st.session_state["job_id"] = job_id
+    st.session_state.pop("job_finished", None)
 
-    # Финальное сообщение
-    if done_requests == max_requests:
-        st.success(f"✅ Установленный лимит запросов ({max_requests}) достигнут. Собрано {len(df)} фраз.")
-    elif consecutive_errors >= MAX_ERRORS:
-        st.warning(f"⚠️ Парсинг остановлен из-за лимита API. Собрано {len(df)} фраз. Возобновите позже.")
-    elif not query_queue:
-        st.success(f"✅ Парсинг завершен! Вся очередь обработана. Собрано {len(df)} фраз.")
-    else:
-        st.success(f"✅ Готово! Собрано {len(df)} уникальных фраз.")
+# -------------------
+# Задания парсинга: прогресс читается из БД заданий, страницу можно закрывать
+# -------------------
+render_jobs()
 
 # -------------------
-# Отрисовка таблицы (всегда одна, из сессии)
+# Отрисовка таблицы (всегда одна, из БД текущей сессии)
 # -------------------
-if "df" in st.session_state and not st.session_state["df"].empty:
-    render_results(st.session_state["df"], st.session_state["db_name"])
-elif "current_db" in st.session_state and os.path.exists(st.session_state["current_db"]):
+if "current_db" in st.session_state and os.path.exists(st.session_state["current_db"]):
     try:
         conn = setup_db(st.session_state["current_db"])
-        df = get_all_results_df(conn)
+        has_results = conn.execute("SELECT 1 FROM results LIMIT 1").fetchone() is not None
         conn.close()
-        if not df.empty:
-            st.session_state["df"] = df
-            st.session_state["db_name"] = st.session_state["current_db"]
-            render_results(st.session_state["df"], st.session_state["db_name"])
+        if has_results:
+            render_results(st.session_state["current_db"])
         else:
             st.info(f"База данных {st.session_state['current_db']} существует, но пуста. Запустите парсинг.")
     except Exception as e:
-        st.error(f"Не удалось загрузить данные из SQLite ({st.session_state['current_db']}): {e}")
\ No newline at end of file
+        st.error(f"Не удалось загрузить данные из SQLite ({st.session_state['current_db']}): {e}")